@@ -0,0 +1,445 @@
+import sys
+import os
+import json
+import re
+
+import numpy as np
+
+import Results
+
+
+# Columns of the summary table, one row for every compared methods, alias
+# name and metric.
+SUMMARY_COLUMNS = ["Compared methods",
+                   "Alias name",
+                   "Metric",
+                   "Count",
+                   "Mean",
+                   "Standard deviation",
+                   "Minimum",
+                   "First quartile",
+                   "Median",
+                   "Third quartile",
+                   "Interquartile range",
+                   "Maximum",
+                   "Pass rate",
+                   ]
+
+# Relative accuracy of the quantiles of the summary table.
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+
+def pass_criteria(config):
+    """
+    Reading the pass criteria of the metrics from the configuration file.
+    Execution is halted if a criterion is not valid.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    criteria : dict
+        (operator, threshold) by metric column, from "Pass criteria" (Ex.
+        {"Volumetric Dice similarity coefficient": ">= 0.8"}), empty if it is
+        missing (default).
+    
+    """
+    criteria = {}
+    for column, criterion in config.get("Pass criteria", {}).items():
+        match = re.fullmatch(r"\s*(<=|>=|<|>)\s*([-+0-9.eE]+)\s*",
+                             str(criterion),
+                             )
+        if match is None:
+            sys.exit(f"{criterion} is not a pass criterion of {column} (Ex. "
+                     "\">= 0.8\"), execution halted"
+                     )
+        criteria[column] = (match.group(1), float(match.group(2)))
+    
+    return criteria
+
+def create_sketch():
+    """
+    Creating an empty quantile sketch.
+    
+    Values are counted in buckets whose bounds grow geometrically, so that
+    every quantile is known within SKETCH_RELATIVE_ACCURACY of its value
+    and sketches use little memory whatever the number of values.
+    
+    Returns
+    -------
+    sketch : dict
+        Counts of the positive ("positive") and negative ("negative") values
+        by bucket index, of the zeros ("zero") and of all the values
+        ("count").
+    
+    """
+    sketch = {"positive": {},
+              "negative": {},
+              "zero": 0,
+              "count": 0,
+              }
+    
+    return sketch
+
+def add_to_sketch(sketch,
+                  value,
+                  count=1,
+                  ):
+    """
+    Adding a value to a quantile sketch, or removing it if count is -1.
+    
+    Parameters
+    ----------
+    sketch : dict
+        Sketch created by create_sketch.
+    value : float
+        Value to add.
+    count : int, optional
+        Number of times the value is added, -1 to remove it. Default is 1.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+    sketch["count"] += count
+    if value == 0:
+        sketch["zero"] += count
+        return
+    
+    buckets = sketch["positive"] if value > 0 else sketch["negative"]
+    index = str(int(np.ceil(np.log(abs(value)) / np.log(gamma))))
+    buckets[index] = buckets.get(index, 0) + count
+    if buckets[index] == 0:
+        del buckets[index]
+
+def sketch_quantile(sketch,
+                    quantile,
+                    ):
+    """
+    Estimating a quantile of the values of a sketch.
+    
+    Parameters
+    ----------
+    sketch : dict
+        Sketch created by create_sketch.
+    quantile : float
+        Quantile between 0 and 1 (Ex. 0.5 for the median).
+    
+    Returns
+    -------
+    value : float
+        Estimate of the quantile, NaN if the sketch is empty.
+    
+    """
+    if sketch["count"] <= 0:
+        return np.nan
+    
+    gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+    rank = quantile * (sketch["count"] - 1)
+    
+    # Buckets are visited from the smallest value, negative values first.
+    buckets = ([(-2 * gamma ** int(index) / (gamma + 1), count)
+                for index, count in sorted(sketch["negative"].items(),
+                                           key=lambda item: -int(item[0]),
+                                           )
+                ]
+               + [(0.0, sketch["zero"])]
+               + [(2 * gamma ** int(index) / (gamma + 1), count)
+                  for index, count in sorted(sketch["positive"].items(),
+                                             key=lambda item: int(item[0]),
+                                             )
+                  ]
+               )
+    cumulative_count = 0
+    for value, count in buckets:
+        cumulative_count += count
+        if cumulative_count > rank:
+            return value
+    
+    return buckets[-1][0]
+
+def create_aggregate(config):
+    """
+    Creating the empty cohort statistics of the results.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    aggregate : dict
+        Pass criteria ("pass_criteria", see pass_criteria) and statistics of
+        every metric by compared methods and alias name ("groups").
+    
+    """
+    aggregate = {"pass_criteria": {column: list(criterion)
+                                   for column, criterion
+                                   in pass_criteria(config).items()
+                                   },
+                 "groups": {},
+                 }
+    
+    return aggregate
+
+def update_aggregate(aggregate,
+                     rows,
+                     columns,
+                     sign=1,
+                     ):
+    """
+    Adding results rows to the cohort statistics, or removing them if sign
+    is -1.
+    
+    Count, mean and variance are updated with Welford's algorithm, quantiles
+    with a sketch (see create_sketch), so that rows are never read again.
+    NaN metrics (Ex. skipped comparisons) are not counted.
+    
+    Parameters
+    ----------
+    aggregate : dict
+        Statistics created by create_aggregate.
+    rows : list
+        Results rows.
+    columns : list
+        Columns of the results rows.
+    sign : int, optional
+        1 (default) to add the rows, -1 to remove them.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    metric_columns = [column for column in columns
+                      if column not in Results.TEXT_COLUMNS
+                      and column not in Results.CATEGORY_COLUMNS
+                      ]
+    methods_position = columns.index("Compared methods")
+    alias_position = columns.index("Alias name")
+    for row in rows:
+        group = aggregate["groups"].setdefault(
+            str(row[methods_position]),
+            {},
+            ).setdefault(str(row[alias_position]),
+                         {},
+                         )
+        for column in metric_columns:
+            value = float(row[columns.index(column)])
+            if np.isnan(value):
+                continue
+            stats = group.setdefault(column,
+                                     {"count": 0,
+                                      "mean": 0.0,
+                                      "m2": 0.0,
+                                      "passed": 0,
+                                      "sketch": create_sketch(),
+                                      },
+                                     )
+            
+            # Welford's update, and its inverse for removed values.
+            count = stats["count"] + sign
+            if count <= 0:
+                stats["count"], stats["mean"], stats["m2"] = 0, 0.0, 0.0
+            else:
+                delta = value - stats["mean"]
+                mean = stats["mean"] + sign * delta / count
+                stats["m2"] = max(stats["m2"] + sign * delta * (value - mean),
+                                  0.0,
+                                  )
+                stats["count"], stats["mean"] = count, mean
+            add_to_sketch(stats["sketch"],
+                          value,
+                          sign,
+                          )
+            
+            if column in aggregate["pass_criteria"]:
+                operator, threshold = aggregate["pass_criteria"][column]
+                passed = {"<=": value <= threshold,
+                          ">=": value >= threshold,
+                          "<": value < threshold,
+                          ">": value > threshold,
+                          }[operator]
+                stats["passed"] += sign * int(passed)
+
+def aggregate_summary_rows(aggregate):
+    """
+    Creating the summary table of the cohort statistics.
+    
+    Parameters
+    ----------
+    aggregate : dict
+        Statistics created by create_aggregate.
+    
+    Returns
+    -------
+    rows : list
+        One row for every compared methods, alias name and metric, with the
+        SUMMARY_COLUMNS. Pass rate is NaN for metrics without a pass
+        criterion.
+    
+    """
+    rows = []
+    for compared_methods, aliases in aggregate["groups"].items():
+        for alias_name, metrics in aliases.items():
+            for column, stats in metrics.items():
+                if stats["count"] <= 0:
+                    continue
+                quartiles = [sketch_quantile(stats["sketch"], quantile)
+                             for quantile in (0, 0.25, 0.5, 0.75, 1)
+                             ]
+                if stats["count"] > 1:
+                    deviation = np.sqrt(stats["m2"] / (stats["count"] - 1))
+                else:
+                    deviation = np.nan
+                if column in aggregate["pass_criteria"]:
+                    pass_rate = stats["passed"] / stats["count"]
+                else:
+                    pass_rate = np.nan
+                rows.append([compared_methods,
+                             alias_name,
+                             column,
+                             stats["count"],
+                             stats["mean"],
+                             deviation,
+                             quartiles[0],
+                             quartiles[1],
+                             quartiles[2],
+                             quartiles[3],
+                             quartiles[3] - quartiles[1],
+                             quartiles[4],
+                             pass_rate,
+                             ],
+                            )
+    
+    return rows
+
+def aggregate_state_path(results_path):
+    """
+    Returning the path of the file where the cohort statistics of a results
+    file are kept.
+    
+    Parameters
+    ----------
+    results_path : str
+        Path to the results file (Ex. "path/to/results.xlsx").
+    
+    Returns
+    -------
+    state_path : str
+        Path to the JSON file of the statistics (Ex.
+        "path/to/results_summary.json").
+    
+    """
+    root, _ = os.path.splitext(results_path)
+    
+    return f"{root}_summary.json"
+
+def summary_results_path(results_path):
+    """
+    Returning the path of the summary table written next to the results file.
+    
+    Parameters
+    ----------
+    results_path : str
+        Path to the results file (Ex. "path/to/results.xlsx").
+    
+    Returns
+    -------
+    summary_path : str
+        Path to the summary table, in the same format of the results (Ex.
+        "path/to/results_summary.xlsx").
+    
+    """
+    root, extension = os.path.splitext(results_path)
+    
+    return f"{root}_summary{extension}"
+
+def load_aggregate(state_path,
+                   config,
+                   ):
+    """
+    Reading the cohort statistics saved by save_aggregate.
+    
+    Parameters
+    ----------
+    state_path : str
+        Path to the JSON file of the statistics.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    aggregate : dict or None
+        Saved statistics, None if the file does not exist or its pass
+        criteria are not those of the configuration file.
+    
+    """
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path) as state_file:
+        aggregate = json.load(state_file)
+    if aggregate["pass_criteria"] != create_aggregate(config)["pass_criteria"]:
+        return None
+    
+    return aggregate
+
+def save_aggregate(aggregate,
+                   state_path,
+                   ):
+    """
+    Saving the cohort statistics, replacing the previous file only when the
+    new one is complete.
+    
+    Parameters
+    ----------
+    aggregate : dict
+        Statistics created by create_aggregate.
+    state_path : str
+        Path to the JSON file of the statistics.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, "w") as state_file:
+        json.dump(aggregate,
+                  state_file,
+                  )
+    os.replace(temp_path,
+               state_path,
+               )
+
+def write_summary(aggregate,
+                  summary_path,
+                  ):
+    """
+    Writing the summary table of the cohort statistics.
+    
+    Parameters
+    ----------
+    aggregate : dict
+        Statistics created by create_aggregate.
+    summary_path : str
+        Path to the summary table, its extension sets the format.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    writer = Results.open_results_writer(summary_path,
+                                         SUMMARY_COLUMNS,
+                                         )
+    Results.write_results(writer,
+                          aggregate_summary_rows(aggregate),
+                          )
+    Results.close_results_writer(writer)
@@ -0,0 +1,1100 @@
+import argparse
+import sys
+import os
+import subprocess
+import time
+import statistics
+
+
+# Modules that must not be imported at start-up.
+HEAVY_MODULES = ["pandas",
+                 "pydicom",
+                 "rt_utils",
+                 "surface_distance",
+                 ]
+
+# Folder of the program scripts.
+PROGRAM_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Box phantoms whose metrics are known analytically (see
+# translated_box_metrics). Every ROI is a box given as first row, first
+# column, first slice and number of rows, columns and slices; ROI names are
+# those of config.json.
+PHANTOM_CASES = {"Phantom-Translated": {"Bladder": (20, 20, 5, 20, 20, 10),
+                                        "Bladder_MBS": (20, 20, 5, 20, 20, 10),
+                                        "Bladder_DL": (20, 22, 5, 20, 20, 10),
+                                        "CTV": (10, 12, 4, 12, 16, 8),
+                                        "Prostate_MBS": (10, 12, 5, 12, 16, 8),
+                                        },
+                 }
+
+# Rows, columns and slices of the phantom CT series.
+PHANTOM_SHAPE = (64, 64, 20)
+
+# Pixel spacing and slice thickness in millimeters of the phantom CT series.
+PHANTOM_SPACING = (1.0, 1.0, 2.0)
+
+# Regression corpus with the expected metrics and the stage budgets.
+GOLDEN_PATH = os.path.join(PROGRAM_FOLDER,
+                           "tests",
+                           "golden.json",
+                           )
+
+# Test patient of Tests.py, whose real RTSTRUCT file is in the regression
+# corpus.
+TEST_PATIENT_PATH = os.path.join("tests",
+                                 "test_patient",
+                                 )
+
+# Variants of the test patient covering a feature each: ROIs removed from
+# the RTSTRUCT file ("absent"), ROIs left without contours ("empty") and
+# settings replacing those of the configuration file ("config"). Variants
+# only compare manual and MBS segments, so that the corpus stays fast.
+TEST_PATIENT_CASES = {"Test-Patient": {},
+                      "Test-Patient-Absent-Empty": {
+                          "absent": ["Retto",
+                                     "Bladder_MBS",
+                                     ],
+                          "empty": ["FemoreSinistro",
+                                    "FemoralHead (Right)_MBS",
+                                    ],
+                          "config": {"Compared methods": ["Manual-MBS"]},
+                          },
+                      "Test-Patient-Resampled": {
+                          "config": {"Compared methods": ["Manual-MBS"],
+                                     "Resampling spacing (mm)": [2.0,
+                                                                 2.0,
+                                                                 2.0,
+                                                                 ],
+                                     },
+                          },
+                      "Test-Patient-Additional-Metrics": {
+                          "config": {"Compared methods": ["Manual-MBS"],
+                                     "Additional metrics": [
+                                         "Jaccard index",
+                                         "Added path length",
+                                         "Mean surface distance",
+                                         "Median surface distance",
+                                         "Volume difference",
+                                         "Sensitivity",
+                                         "Precision",
+                                         "Hausdorff distance reference to "
+                                         "compared",
+                                         "Hausdorff distance compared to "
+                                         "reference",
+                                         ],
+                                     },
+                          },
+                      }
+
+# Smallest budgets of a stage, so that the fastest stages are not failed by
+# the noise of the timer and of the allocator.
+MIN_BUDGETS = {"seconds": 0.5,
+               "peak_mb": 10.0,
+               }
+
+# Factor of the regression corpus budgets always checked by Tests.py, large
+# enough for slower machines so that only gross regressions fail.
+LOOSE_BUDGET_FACTOR = 10.0
+
+# Metrics columns compared with the regression corpus.
+GOLDEN_COLUMNS = ["Compared methods",
+                  "Alias name",
+                  "95% Hausdorff distance (mm)",
+                  "Volumetric Dice similarity coefficient",
+                  "Surface Dice similarity coefficient",
+                  "Skipped reason",
+                  ]
+
+
+def time_command(command,
+                 repeats=5,
+                 ):
+    """
+    Measuring the wall time of a command run in a new process.
+    
+    Parameters
+    ----------
+    command : list
+        Command and its arguments (Ex. [sys.executable, "Main.py", "--help"]).
+    repeats : int, optional
+        Number of runs. Default is 5.
+    
+    Returns
+    -------
+    times : list
+        Wall time of every run in seconds.
+    
+    """
+    times = []
+    for run in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command,
+                       cwd=PROGRAM_FOLDER,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=False,
+                       )
+        times.append(time.perf_counter() - start)
+    
+    return times
+
+def imported_heavy_modules(module):
+    """
+    Finding which heavy modules are imported together with a module.
+    
+    Parameters
+    ----------
+    module : str
+        Name of the module to import (Ex. "HD_DSC").
+    
+    Returns
+    -------
+    heavy_modules : list
+        Heavy modules loaded after importing the module.
+    
+    """
+    code = (f"import sys, {module}; "
+            f"print(','.join(m for m in {HEAVY_MODULES} if m in sys.modules))"
+            )
+    output = subprocess.run([sys.executable, "-c", code],
+                            cwd=PROGRAM_FOLDER,
+                            capture_output=True,
+                            text=True,
+                            check=True,
+                            ).stdout.strip()
+    
+    return [name for name in output.split(",") if name]
+
+def startup_benchmark(repeats=5):
+    """
+    Measuring start-up time of quick invocations and comparing it with the
+    import time of the heavy libraries.
+    
+    Parameters
+    ----------
+    repeats : int, optional
+        Number of runs of every command. Default is 5.
+    
+    Returns
+    -------
+    results : dict
+        Median wall time in seconds of every benchmarked command.
+    
+    """
+    commands = {"import HD_DSC": [sys.executable, "-c", "import HD_DSC"],
+                "Main.py --help": [sys.executable, "Main.py", "--help"],
+                "Main.py (argument error)": [sys.executable, "Main.py"],
+                "import heavy libraries": [sys.executable,
+                                           "-c",
+                                           "import " + ", ".join(HEAVY_MODULES),
+                                           ],
+                }
+    results = {}
+    for name, command in commands.items():
+        results[name] = statistics.median(time_command(command,
+                                                       repeats,
+                                                       ),
+                                          )
+        print(f"{name:<30} {results[name]:.3f} s")
+    
+    return results
+
+def distance_backends_benchmark(patient_folder_path,
+                                config_path,
+                                repeats=5,
+                                ):
+    """
+    Measuring compute_metrics with every distance backend on the comparisons
+    of a patient and checking that the metrics do not change.
+    
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the patient folder (Ex. "patients/Pelvic-Ref002"), copied in
+        a temporary folder before being loaded.
+    config_path : str
+        Path to the configuration file.
+    repeats : int, optional
+        Number of runs of every backend. Default is 5.
+    
+    Returns
+    -------
+    results : dict
+        Median wall time in seconds of all the comparisons by backend.
+    
+    """
+    import tempfile
+    import shutil
+    import numpy as np
+    import HD_DSC
+    
+    config = HD_DSC.read_config(config_path)
+    with tempfile.TemporaryDirectory() as temp_folder_path:
+        patient_folder = os.path.basename(os.path.normpath(patient_folder_path))
+        shutil.copytree(patient_folder_path,
+                        os.path.join(temp_folder_path, patient_folder),
+                        )
+        patient = HD_DSC.load_patient(temp_folder_path,
+                                      patient_folder,
+                                      )
+        patient_data = patient["patient_data"]
+        manual_segments = HD_DSC.extract_manual_segments(
+            patient_data.get_roi_names(),
+            config,
+            )
+        ref_segs, comp_segs = HD_DSC.create_segments_matrices(manual_segments,
+                                                              config,
+                                                              )
+        
+        # Labelmaps are created once, only metrics are timed.
+        contoured = HD_DSC.contoured_segments(patient_data.ds)
+        labelmaps = {}
+        pairs = []
+        for ref_names, comp_names in zip(ref_segs, comp_segs):
+            for ref_name, comp_name in zip(ref_names, comp_names):
+                if HD_DSC.skipped_reason(ref_name,
+                                         comp_name,
+                                         patient_data.get_roi_names(),
+                                         contoured,
+                                         ):
+                    continue
+                for name in (ref_name, comp_name):
+                    if name not in labelmaps:
+                        labelmaps[name] = HD_DSC.create_labelmap(
+                            patient["ct_folder_path"],
+                            patient["rtstruct_file_path"],
+                            name,
+                            patient_data,
+                            )
+                pairs.append((labelmaps[ref_name], labelmaps[comp_name]))
+        voxel_spacing_mm = HD_DSC.spacing_and_tolerance(
+            patient["ct_folder_path"],
+            patient_data.series_data,
+            )[0]
+    
+    results = {}
+    expected = None
+    for backend in HD_DSC.DISTANCE_BACKENDS:
+        if HD_DSC.distance_backend({"Distance backend": backend}) != backend:
+            continue
+        times = []
+        for run in range(repeats + 1):
+            start = time.perf_counter()
+            metrics = [HD_DSC.compute_metrics(ref_labelmap,
+                                              comp_labelmap,
+                                              None,
+                                              voxel_spacing_mm=voxel_spacing_mm,
+                                              backend=backend,
+                                              )
+                       for ref_labelmap, comp_labelmap in pairs
+                       ]
+            times.append(time.perf_counter() - start)
+        
+        # The first run also compiles the Numba kernels, it is not counted.
+        results[backend] = statistics.median(times[1:])
+        if expected is None:
+            expected = np.array(metrics)
+        difference = np.max(np.abs(np.array(metrics) - expected))
+        print(f"{backend:<30} {results[backend]:.3f} s",
+              f"({len(pairs)} comparisons, first run {times[0]:.3f} s,",
+              f"greatest metric difference {difference:.2g})",
+              )
+    
+    return results
+
+def write_box_phantom(input_folder_path,
+                      case,
+                      boxes,
+                      ):
+    """
+    Writing a synthetic patient, whose CT series is empty and whose
+    RTSTRUCT file contains one box per ROI.
+    
+    Contours are the rectangles through the centers of the border voxels of
+    every box, so that rasterizing them gives back the boxes exactly. UIDs
+    are derived from the case name, so that the files are always the same.
+    
+    Parameters
+    ----------
+    input_folder_path : str
+        Folder where the patient folder is created.
+    case : str
+        Name of the patient folder, also used as patient ID.
+    boxes : dict
+        Box of every ROI by name (see PHANTOM_CASES).
+    
+    Returns
+    -------
+    patient_folder_path : str
+        Path to the patient folder, with its CT and RTSTRUCT folders.
+    
+    """
+    import numpy as np
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.sequence import Sequence
+    from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+    
+    rows, columns, n_slices = PHANTOM_SHAPE
+    pixel_spacing = PHANTOM_SPACING[:2]
+    thickness = PHANTOM_SPACING[2]
+    patient_folder_path = os.path.join(input_folder_path, case)
+    for folder in ("CT", "RTSTRUCT"):
+        os.makedirs(os.path.join(patient_folder_path, folder))
+    
+    def uid(*names):
+        return generate_uid(entropy_srcs=[case, *map(str, names)])
+    
+    def new_dataset(sop_class_uid, sop_instance_uid):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = sop_class_uid
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = sop_class_uid
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.PatientID = case
+        ds.PatientName = case
+        ds.StudyInstanceUID = uid("study")
+        ds.FrameOfReferenceUID = uid("frame of reference")
+        return ds
+    
+    # Empty CT slices.
+    ct_uids = []
+    for index in range(n_slices):
+        ct_uids.append(uid("ct", index))
+        ds = new_dataset(pydicom.uid.CTImageStorage, ct_uids[-1])
+        ds.Modality = "CT"
+        ds.SeriesInstanceUID = uid("ct series")
+        ds.InstanceNumber = index + 1
+        ds.ImagePositionPatient = [0.0, 0.0, index * thickness]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.PixelSpacing = list(pixel_spacing)
+        ds.SliceThickness = thickness
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.PixelData = np.zeros((rows, columns), dtype=np.int16).tobytes()
+        pydicom.dcmwrite(os.path.join(patient_folder_path,
+                                      "CT",
+                                      f"CT{index:03d}.dcm",
+                                      ),
+                         ds,
+                         write_like_original=False,
+                         )
+    
+    # One closed planar rectangle per slice of every box. Columns move
+    # along x and rows along y.
+    ds = new_dataset(pydicom.uid.RTStructureSetStorage, uid("rtstruct"))
+    ds.Modality = "RTSTRUCT"
+    ds.SeriesInstanceUID = uid("rtstruct series")
+    frame_of_reference = Dataset()
+    frame_of_reference.FrameOfReferenceUID = ds.FrameOfReferenceUID
+    ds.ReferencedFrameOfReferenceSequence = Sequence([frame_of_reference])
+    ds.StructureSetROISequence = Sequence()
+    ds.ROIContourSequence = Sequence()
+    ds.RTROIObservationsSequence = Sequence()
+    for number, (name, box) in enumerate(boxes.items(), start=1):
+        first_row, first_column, first_slice, n_rows, n_columns, depth = box
+        x = [(first_column + offset) * pixel_spacing[1]
+             for offset in (0, n_columns - 1)
+             ]
+        y = [(first_row + offset) * pixel_spacing[0]
+             for offset in (0, n_rows - 1)
+             ]
+        roi = Dataset()
+        roi.ROINumber = number
+        roi.ROIName = name
+        roi.ReferencedFrameOfReferenceUID = ds.FrameOfReferenceUID
+        roi.ROIGenerationAlgorithm = "MANUAL"
+        ds.StructureSetROISequence.append(roi)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ROIDisplayColor = [255, 0, 0]
+        roi_contour.ContourSequence = Sequence()
+        for index in range(first_slice, first_slice + depth):
+            contour_image = Dataset()
+            contour_image.ReferencedSOPClassUID = pydicom.uid.CTImageStorage
+            contour_image.ReferencedSOPInstanceUID = ct_uids[index]
+            contour = Dataset()
+            contour.ContourImageSequence = Sequence([contour_image])
+            contour.ContourGeometricType = "CLOSED_PLANAR"
+            contour.NumberOfContourPoints = 4
+            contour.ContourData = [coordinate
+                                   for point in ((x[0], y[0]),
+                                                 (x[1], y[0]),
+                                                 (x[1], y[1]),
+                                                 (x[0], y[1]),
+                                                 )
+                                   for coordinate in (*point,
+                                                      index * thickness,
+                                                      )
+                                   ]
+            roi_contour.ContourSequence.append(contour)
+        ds.ROIContourSequence.append(roi_contour)
+        observation = Dataset()
+        observation.ObservationNumber = number
+        observation.ReferencedROINumber = number
+        observation.RTROIInterpretedType = "ORGAN"
+        ds.RTROIObservationsSequence.append(observation)
+    pydicom.dcmwrite(os.path.join(patient_folder_path,
+                                  "RTSTRUCT",
+                                  "RS.dcm",
+                                  ),
+                     ds,
+                     write_like_original=False,
+                     )
+    
+    return patient_folder_path
+
+def write_test_patient_variant(input_folder_path,
+                               case,
+                               variant,
+                               ):
+    """
+    Copying the test patient, whose RTSTRUCT file loses the absent ROIs of
+    the variant and the contours of its empty ROIs.
+    
+    Parameters
+    ----------
+    input_folder_path : str
+        Folder where the patient folder is created.
+    case : str
+        Name of the patient folder.
+    variant : dict
+        Variant of the test patient (see TEST_PATIENT_CASES).
+    
+    Returns
+    -------
+    patient_folder_path : str
+        Path to the patient folder, with its CT and RTSTRUCT folders.
+    
+    """
+    import shutil
+    import pydicom
+    from pydicom.sequence import Sequence
+    
+    patient_folder_path = os.path.join(input_folder_path, case)
+    shutil.copytree(os.path.join(PROGRAM_FOLDER, TEST_PATIENT_PATH),
+                    patient_folder_path,
+                    )
+    rtstruct_folder_path = os.path.join(patient_folder_path, "RTSTRUCT")
+    rtstruct_file_path = os.path.join(rtstruct_folder_path,
+                                      os.listdir(rtstruct_folder_path)[0],
+                                      )
+    ds = pydicom.dcmread(rtstruct_file_path)
+    numbers = {roi.ROIName: roi.ROINumber
+               for roi in ds.StructureSetROISequence
+               }
+    absent = variant.get("absent", [])
+    empty = variant.get("empty", [])
+    for name in absent + empty:
+        if name not in numbers:
+            raise ValueError(f"{name} is not a ROI of the test patient")
+    absent_numbers = {numbers[name] for name in absent}
+    empty_numbers = {numbers[name] for name in empty}
+    
+    # Absent ROIs are removed from every sequence, empty ROIs keep their
+    # names but not their contours.
+    ds.StructureSetROISequence = Sequence([
+        roi for roi in ds.StructureSetROISequence
+        if roi.ROINumber not in absent_numbers
+        ])
+    ds.ROIContourSequence = Sequence([
+        roi_contour for roi_contour in ds.ROIContourSequence
+        if roi_contour.ReferencedROINumber not in absent_numbers
+        ])
+    ds.RTROIObservationsSequence = Sequence([
+        observation for observation in ds.RTROIObservationsSequence
+        if observation.ReferencedROINumber not in absent_numbers
+        ])
+    for roi_contour in ds.ROIContourSequence:
+        if roi_contour.ReferencedROINumber in empty_numbers:
+            del roi_contour.ContourSequence
+    ds.save_as(rtstruct_file_path)
+    
+    return patient_folder_path
+
+def translated_box_metrics(reference_box,
+                           compared_box,
+                           voxel_spacing_mm=PHANTOM_SPACING,
+                           ):
+    """
+    Computing analytically the metrics of two boxes of the same size, one
+    translated along a single axis by at most the surface Dice tolerance.
+    
+    Volumetric Dice is the fraction of the box length that still overlaps.
+    Every distance between the two surfaces is at most the translation and
+    the faces across the translation are exactly that far, so 95% Hausdorff
+    distance is the translation (as long as those faces are more than 5% of
+    the surface) and surface Dice is 1.
+    
+    Parameters
+    ----------
+    reference_box : tuple
+        Reference box (see PHANTOM_CASES).
+    compared_box : tuple
+        Compared box.
+    voxel_spacing_mm : tuple, optional
+        Voxel dimensions in millimeters along rows, columns and slices.
+        Default is PHANTOM_SPACING.
+    
+    Returns
+    -------
+    metrics : tuple
+        95% Hausdorff distance, volumetric Dice and surface Dice.
+    
+    """
+    if reference_box[3:] != compared_box[3:]:
+        raise ValueError("Boxes must have the same size")
+    shifts = [compared - reference
+              for reference, compared in zip(reference_box[:3],
+                                             compared_box[:3],
+                                             )
+              ]
+    moved = [axis for axis, shift in enumerate(shifts) if shift]
+    if not moved:
+        return 0.0, 1.0, 1.0
+    axis = moved[0]
+    distance = abs(shifts[axis]) * voxel_spacing_mm[axis]
+    if len(moved) > 1 or distance > max(voxel_spacing_mm):
+        raise ValueError("Boxes must be translated along one axis by at most"
+                         " the surface Dice tolerance")
+    length = reference_box[3 + axis]
+    
+    return distance, (length - abs(shifts[axis])) / length, 1.0
+
+def phantom_rows(boxes,
+                 config,
+                 ):
+    """
+    Computing analytically the expected rows of a box phantom.
+    
+    Parameters
+    ----------
+    boxes : dict
+        Box of every ROI by name (see PHANTOM_CASES).
+    config : dict
+        Configuration whose compared methods and segments names are used.
+    
+    Returns
+    -------
+    rows : list
+        Values of GOLDEN_COLUMNS of every comparison, with NaN metrics and
+        "reference absent" or "compared absent" for absent segments.
+    
+    """
+    import HD_DSC
+    
+    manual_segments = HD_DSC.extract_manual_segments(list(boxes),
+                                                     config,
+                                                     )
+    ref_segs, comp_segs = HD_DSC.create_segments_matrices(manual_segments,
+                                                          config,
+                                                          )
+    compared_methods = [comparison[0]
+                        for comparison in HD_DSC.parse_compared_methods(config)
+                        ]
+    rows = []
+    for methods, method_name in enumerate(compared_methods):
+        for segment, alias in enumerate(config["Alias names"]):
+            reason = HD_DSC.skipped_reason(ref_segs[methods][segment],
+                                           comp_segs[methods][segment],
+                                           list(boxes),
+                                           set(boxes),
+                                           )
+            if reason:
+                metrics = (float("nan"),) * 3
+            else:
+                metrics = translated_box_metrics(
+                    boxes[ref_segs[methods][segment]],
+                    boxes[comp_segs[methods][segment]],
+                    )
+            rows.append([method_name, alias, *metrics, reason])
+    
+    return rows
+
+def golden_columns(config):
+    """
+    Finding the columns of the regression corpus compared for a
+    configuration.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    columns : list
+        GOLDEN_COLUMNS with the columns of the additional metrics of config
+        before the skipped reason.
+    
+    """
+    import HD_DSC
+    
+    return (GOLDEN_COLUMNS[:-1]
+            + [HD_DSC.ADDITIONAL_METRICS[name]
+               for name in HD_DSC.additional_metrics(config)
+               ]
+            + GOLDEN_COLUMNS[-1:])
+
+def golden_case(patient_folder_path,
+                config,
+                ):
+    """
+    Analysing a patient of the regression corpus, measuring duration and
+    peak memory of every stage.
+    
+    The patient is copied in a temporary folder, then loaded ("load"),
+    analysed ("metrics") and its results are written ("save"). Garbage is
+    collected before every stage. Peak memory is the greatest memory
+    allocated by Python and numpy during the stage above the memory
+    allocated at its start, traced by tracemalloc.
+    
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the patient folder.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    rows : list
+        Values of the golden_columns of config of every comparison.
+    stages : dict
+        Duration in seconds ("seconds") and peak memory in megabytes
+        ("peak_mb") of every stage.
+    
+    """
+    import tempfile
+    import shutil
+    import gc
+    import tracemalloc
+    import HD_DSC
+    import Results
+    
+    stages = {}
+    
+    def start_stage():
+        gc.collect()
+        tracemalloc.reset_peak()
+        return time.perf_counter(), tracemalloc.get_traced_memory()[0]
+    
+    def end_stage(stage, start):
+        stages[stage] = {"seconds": time.perf_counter() - start[0],
+                         "peak_mb": ((tracemalloc.get_traced_memory()[1]
+                                      - start[1])
+                                     / 2**20),
+                         }
+        return start_stage()
+    
+    # Loading moves the patient files, so a copy of the patient is analysed.
+    with tempfile.TemporaryDirectory() as temp_folder_path:
+        patient_folder = os.path.basename(
+            os.path.normpath(patient_folder_path),
+            )
+        shutil.copytree(patient_folder_path,
+                        os.path.join(temp_folder_path, patient_folder),
+                        )
+        columns = HD_DSC.results_columns(config)
+        
+        # Every stage starts from a garbage collection.
+        tracemalloc.start()
+        try:
+            start = start_stage()
+            patient = HD_DSC.load_patient(temp_folder_path,
+                                          patient_folder,
+                                          )
+            start = end_stage("load", start)
+            rows = HD_DSC.analyse_patient(patient,
+                                          config,
+                                          interactive=False,
+                                          )
+            start = end_stage("metrics", start)
+            writer = Results.open_results_writer(
+                os.path.join(temp_folder_path, "results.csv"),
+                columns,
+                )
+            Results.write_results(writer,
+                                  rows,
+                                  )
+            Results.close_results_writer(writer)
+            end_stage("save", start)
+        finally:
+            tracemalloc.stop()
+    
+    rows = [[row[columns.index(column)] for column in golden_columns(config)]
+            for row in rows
+            ]
+    
+    return rows, stages
+
+def golden_corpus(config_path,
+                  repeats=1,
+                  ):
+    """
+    Analysing every patient of the regression corpus: the test patient and
+    its variants of TEST_PATIENT_CASES and the box phantoms of
+    PHANTOM_CASES.
+    
+    Parameters
+    ----------
+    config_path : str
+        Path to the configuration file.
+    repeats : int, optional
+        Number of analyses of every patient. Default is 1.
+    
+    Returns
+    -------
+    cases : dict
+        For every case, compared columns ("columns", see golden_columns),
+        rows of the last analysis ("rows"), and median duration and
+        greatest peak memory of every stage ("stages"), see golden_case.
+        Phantoms also have their analytic rows ("expected").
+    
+    """
+    import tempfile
+    import HD_DSC
+    
+    config = HD_DSC.read_config(config_path)
+    cases = {}
+    configs = {}
+    with tempfile.TemporaryDirectory() as cases_folder_path:
+        patient_folder_paths = {}
+        for case, variant in TEST_PATIENT_CASES.items():
+            if "absent" in variant or "empty" in variant:
+                patient_folder_paths[case] = write_test_patient_variant(
+                    cases_folder_path,
+                    case,
+                    variant,
+                    )
+            else:
+                patient_folder_paths[case] = os.path.join(PROGRAM_FOLDER,
+                                                          TEST_PATIENT_PATH,
+                                                          )
+            configs[case] = {**config, **variant.get("config", {})}
+        for case, boxes in PHANTOM_CASES.items():
+            patient_folder_paths[case] = write_box_phantom(
+                cases_folder_path,
+                case,
+                boxes,
+                )
+            configs[case] = config
+            cases[case] = {"expected": phantom_rows(boxes,
+                                                    config,
+                                                    )}
+        
+        # A first analysis, not measured, imports the libraries, so that
+        # stages are measured without the import times.
+        golden_case(patient_folder_paths[next(iter(PHANTOM_CASES))],
+                    config,
+                    )
+        for case, patient_folder_path in patient_folder_paths.items():
+            runs = [golden_case(patient_folder_path,
+                                configs[case],
+                                )
+                    for run in range(repeats)
+                    ]
+            cases.setdefault(case, {})["columns"] = golden_columns(
+                configs[case],
+                )
+            cases[case]["rows"] = runs[-1][0]
+            cases[case]["stages"] = {
+                stage: {"seconds": statistics.median(run[1][stage]["seconds"]
+                                                     for run in runs
+                                                     ),
+                        "peak_mb": max(run[1][stage]["peak_mb"]
+                                       for run in runs
+                                       ),
+                        }
+                for stage in runs[0][1]
+                }
+    
+    return cases
+
+def update_golden_corpus(config_path,
+                         golden_path=GOLDEN_PATH,
+                         repeats=3,
+                         ):
+    """
+    Writing the expected metrics and the stage budgets of the regression
+    corpus from the current program.
+    
+    Expected metrics of the phantoms are their analytic values, the
+    program must match them before they are written. Budgets are the
+    measured durations and peak memories, at least MIN_BUDGETS.
+    
+    Parameters
+    ----------
+    config_path : str
+        Path to the configuration file.
+    golden_path : str, optional
+        Path to the regression corpus file. Default is GOLDEN_PATH.
+    repeats : int, optional
+        Number of analyses of every patient. Default is 3.
+    
+    Returns
+    -------
+    golden : dict
+        Written regression corpus.
+    
+    """
+    import json
+    
+    cases = golden_corpus(config_path,
+                          repeats,
+                          )
+    golden = {"config": os.path.relpath(config_path,
+                                        PROGRAM_FOLDER,
+                                        ).replace("\\", "/"),
+              "cases": {},
+              }
+    for case, results in cases.items():
+        if "expected" in results:
+            differences = compare_golden_rows(results["expected"],
+                                              results["rows"],
+                                              columns=results["columns"],
+                                              )
+            if differences:
+                sys.exit(f"{case} differs from its analytic metrics: "
+                         + "; ".join(differences))
+        golden["cases"][case] = {
+            "columns": results["columns"],
+            "rows": [[None if value != value else value for value in row]
+                     for row in results.get("expected", results["rows"])
+                     ],
+            "budgets": {stage: {key: round(max(stats[key], MIN_BUDGETS[key]),
+                                           3,
+                                           )
+                                for key in MIN_BUDGETS
+                                }
+                        for stage, stats in results["stages"].items()
+                        },
+            }
+    with open(golden_path, "w", encoding="utf-8") as golden_file:
+        json.dump(golden,
+                  golden_file,
+                  indent=4,
+                  )
+        golden_file.write("\n")
+    
+    return golden
+
+def compare_golden_rows(expected_rows,
+                        rows,
+                        rtol=1e-6,
+                        columns=GOLDEN_COLUMNS,
+                        ):
+    """
+    Finding the rows whose metrics drifted from the expected ones.
+    
+    Parameters
+    ----------
+    expected_rows : list
+        Expected values of the columns of every comparison, NaN metrics
+        may be None.
+    rows : list
+        Observed values, in the same order.
+    rtol : float, optional
+        Relative tolerance of the metrics. Default is 1e-6.
+    columns : list, optional
+        Names of the compared columns (see golden_columns). Default is
+        GOLDEN_COLUMNS.
+    
+    Returns
+    -------
+    differences : list
+        Description of every difference, empty if there are none.
+    
+    """
+    import math
+    
+    if len(expected_rows) != len(rows):
+        return [f"{len(rows)} rows instead of {len(expected_rows)}"]
+    differences = []
+    for expected_row, row in zip(expected_rows, rows):
+        for column, expected, value in zip(columns,
+                                           expected_row,
+                                           row,
+                                           ):
+            if isinstance(value, str) or isinstance(expected, str):
+                same = expected == value
+            else:
+                expected = float("nan") if expected is None else expected
+                same = (math.isnan(expected) and math.isnan(value)
+                        or math.isclose(expected,
+                                        value,
+                                        rel_tol=rtol,
+                                        abs_tol=1e-9,
+                                        ))
+            if not same:
+                differences.append(f"{row[0]} {row[1]} {column}: {value} "
+                                   f"instead of {expected}")
+    
+    return differences
+
+def check_golden_corpus(golden_path=GOLDEN_PATH,
+                        budget_factor=2.0,
+                        ):
+    """
+    Analysing the regression corpus and comparing metrics and stages with
+    the expected ones.
+    
+    Parameters
+    ----------
+    golden_path : str, optional
+        Path to the regression corpus file (see update_golden_corpus).
+        Default is GOLDEN_PATH.
+    budget_factor : float, optional
+        A stage fails if its duration or peak memory is greater than its
+        budget times this factor. If None only the metrics are checked.
+        Default is 2.
+    
+    Returns
+    -------
+    failures : list
+        Description of every drifted metric and exceeded budget, empty if
+        the corpus passed.
+    
+    """
+    import json
+    
+    with open(golden_path, encoding="utf-8") as golden_file:
+        golden = json.load(golden_file)
+    cases = golden_corpus(os.path.join(PROGRAM_FOLDER,
+                                       golden["config"],
+                                       ))
+    
+    failures = []
+    for case, expected in golden["cases"].items():
+        if case not in cases:
+            failures.append(f"{case}: missing from the corpus")
+            continue
+        if expected["columns"] != cases[case]["columns"]:
+            failures.append(f"{case}: columns {cases[case]['columns']} "
+                            f"instead of {expected['columns']}")
+            continue
+        failures += [f"{case}: {difference}"
+                     for difference in compare_golden_rows(
+                         expected["rows"],
+                         cases[case]["rows"],
+                         columns=expected["columns"],
+                         )
+                     ]
+        
+        # Durations depend on the machine, so budgets may be left out
+        if budget_factor is None:
+            continue
+        for stage, budget in expected["budgets"].items():
+            stats = cases[case]["stages"][stage]
+            for key, unit in (("seconds", "s"), ("peak_mb", "MB")):
+                if stats[key] > budget[key] * budget_factor:
+                    failures.append(f"{case}: {stage} took {stats[key]:.3g} "
+                                    f"{unit}, budget {budget[key]} {unit} "
+                                    f"x {budget_factor}")
+    
+    return failures
+
+def main(argv):
+    """
+    Running the benchmarks of the program.
+    
+    Parameters
+    ----------
+    argv : char **
+        Pointer to the pointer to the array where command line arguments are
+        stored in the memory.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks")
+    parser.add_argument(dest="benchmark",
+                        choices=["startup", "distances", "golden"],
+                        help="Benchmark to run",
+                        )
+    parser.add_argument("-r", "--repeats",
+                        dest="repeats",
+                        metavar="N",
+                        type=int,
+                        default=5,
+                        required=False,
+                        help="Number of runs of every measure",
+                        )
+    parser.add_argument("-p", "--patient",
+                        dest="patient_folder_path",
+                        metavar="PATH",
+                        default=os.path.join(PROGRAM_FOLDER,
+                                             "patients",
+                                             "Pelvic-Ref002",
+                                             ),
+                        required=False,
+                        help="Patient folder of the distances benchmark",
+                        )
+    parser.add_argument("-c", "--config",
+                        dest="config_path",
+                        metavar="PATH",
+                        default=os.path.join(PROGRAM_FOLDER,
+                                             "config.json",
+                                             ),
+                        required=False,
+                        help="Configuration file of the distances benchmark",
+                        )
+    parser.add_argument("--update",
+                        dest="update",
+                        action="store_true",
+                        help="Rewrite the regression corpus expected metrics"
+                        " and budgets from the current program",
+                        )
+    parser.add_argument("--budget-factor",
+                        dest="budget_factor",
+                        metavar="FACTOR",
+                        type=float,
+                        default=2.0,
+                        required=False,
+                        help="Factor of the regression corpus budgets above"
+                        " which a stage fails",
+                        )
+    
+    args = parser.parse_args(argv)
+    
+    if args.benchmark == "startup":
+        for module in ("HD_DSC", "Main", "Service"):
+            print(f"Heavy modules imported by {module}:",
+                  imported_heavy_modules(module) or "none",
+                  )
+        startup_benchmark(args.repeats)
+    elif args.benchmark == "distances":
+        distance_backends_benchmark(args.patient_folder_path,
+                                    args.config_path,
+                                    args.repeats,
+                                    )
+    elif args.update:
+        update_golden_corpus(args.config_path,
+                             repeats=args.repeats,
+                             )
+        print(f"Regression corpus written in {GOLDEN_PATH}")
+    else:
+        failures = check_golden_corpus(budget_factor=args.budget_factor)
+        for failure in failures:
+            print(failure)
+        if failures:
+            sys.exit(f"{len(failures)} regression corpus failures")
+        print("Regression corpus OK")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
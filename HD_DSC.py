@@ -2,15 +2,103 @@ import argparse
 import sys
 import os
 import shutil
+import copy
+import functools
 import json
+import re
+import hashlib
+import fnmatch
+import threading
+import queue
+import time
+import socket
+import sqlite3
+import traceback
+import multiprocessing
+from contextlib import closing, contextmanager, ExitStack
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 
 import numpy as np
-import pandas as pd
 
-import pydicom
-from rt_utils import RTStructBuilder
-import surface_distance as sd
+import Aggregate
+import PipelineMetrics
+import Progress
+import Results
 
+# pandas, pydicom, rt_utils and surface_distance are slow to import, so they
+# are imported only inside the functions that need them.
+
+
+# Configuration lists of manual segments names, in the same order of the
+# alias names, used when the configuration file does not provide them.
+DEFAULT_MANUAL_NAMES_LISTS = ["Prostate names",
+                              "Rectum names",
+                              "Bladder names",
+                              "Left femur names",
+                              "Right femur names",
+                              ]
+
+# Automatic segmentation methods used when the configuration file does not
+# provide them. The segments of every method are in "<method> segments".
+DEFAULT_AUTOMATIC_METHODS = ["MBS",
+                             "DL",
+                             ]
+
+# Name of the manual segmentation method in the compared methods.
+MANUAL_METHOD = "Manual"
+
+# Prefix of the configuration names that are regular expressions.
+REGEX_PREFIX = "re:"
+
+# Additional metrics that can be selected in the configuration file and
+# their results columns, in the order they are written.
+ADDITIONAL_METRICS = {"Jaccard index": "Jaccard index",
+                      "Added path length": "Added path length (mm)",
+                      "Mean surface distance": "Mean surface distance (mm)",
+                      "Median surface distance":
+                          "Median surface distance (mm)",
+                      "Volume difference": "Volume difference (cm3)",
+                      "Sensitivity": "Sensitivity",
+                      "Precision": "Precision",
+                      "Hausdorff distance reference to compared":
+                          "95% Hausdorff distance reference to compared (mm)",
+                      "Hausdorff distance compared to reference":
+                          "95% Hausdorff distance compared to reference (mm)",
+                      }
+
+# Additional metrics that need the exact distances of all the surface
+# elements, computed at full resolution also in coarse to fine mode.
+ALL_DISTANCES_METRICS = ["Mean surface distance",
+                         "Median surface distance",
+                         ]
+
+# Additional metrics that need the surface distances, which are not computed
+# when surface Dice is computed without the Hausdorff distance.
+SURFACE_DISTANCES_METRICS = ["Added path length",
+                             "Mean surface distance",
+                             "Median surface distance",
+                             "Hausdorff distance reference to compared",
+                             "Hausdorff distance compared to reference",
+                             ]
+
+# Tables of the areas of the surface elements by neighbour code, by voxel
+# spacing, filled by surface_area_table.
+SURFACE_AREA_TABLES = {}
+
+# Backends computing the surface distances at full resolution, the first is
+# the default.
+DISTANCE_BACKENDS = ["surface-distance",
+                     "numpy",
+                     "numba",
+                     ]
+
+# Compiled kernels of the "numba" distance backend, filled by numba_kernels.
+NUMBA_KERNELS = {}
+
+# Side of the cells of the "numba" nearest surface element search, in
+# greatest voxel dimensions.
+NUMBA_CELL_SIZE = 2
 
 def is_empty(folder_path):
     """
@@ -36,6 +124,7 @@ def is_empty(folder_path):
     
 def patient_info(rtstruct_file_path,
                  information,
+                 rtstruct_dataset=None,
                  ):
     """
     This function extracts patient informations from RTSTRUCT file.
@@ -47,6 +136,9 @@ def patient_info(rtstruct_file_path,
     information : str
         Name of the information that you want to extract from the RTSTRUCT.dcm
         file (Ex: "PatientID").
+    rtstruct_dataset : pydicom.dataset.FileDataset, optional
+        Already read RTSTRUCT dataset (see read_rtstruct). If None (default)
+        the file is read.
 
     Returns
     -------
@@ -57,21 +149,168 @@ def patient_info(rtstruct_file_path,
 
     """
     try:
-        rtstruct_dataset = pydicom.dcmread(rtstruct_file_path)
+        if rtstruct_dataset is None:
+            rtstruct_dataset = read_rtstruct(rtstruct_file_path)
         info = rtstruct_dataset[information].value
         return info
     except KeyError:
         sys.exit(f"There is no {information} in the RTSTRUCT file provided.")
         
-def read_ct_slices(ct_folder_path):
+def read_rtstruct(rtstruct_file_path,
+                  specific_tags=None,
+                  force=False,
+                  ):
+    """
+    Reading an RTSTRUCT file once for all the information needed.
+    
+    pydicom decodes an element only when it is accessed: metadata are read
+    with rtstruct_metadata without decoding the contours, whose points are
+    kept as the bytes of the file until contour_points converts them.
+    
+    Parameters
+    ----------
+    rtstruct_file_path : str
+        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm").
+    specific_tags : list, optional
+        Keywords of the only elements to read (Ex. ["PatientID"]). If None
+        (default) the whole file is read.
+    force : bool, optional
+        If True files without the DICOM preamble are read too. Default is
+        False.
+    
+    Returns
+    -------
+    rtstruct_dataset : pydicom.dataset.FileDataset
+        RTSTRUCT dataset.
+    
+    """
+    import pydicom
+    
+    with open(rtstruct_file_path, "rb") as rtstruct_file:
+        rtstruct_dataset = pydicom.dcmread(rtstruct_file,
+                                           specific_tags=specific_tags,
+                                           force=force,
+                                           )
+        PipelineMetrics.increment_metric("hd_dsc_dicom_read_bytes_total",
+                                         rtstruct_file.tell(),
+                                         )
+    PipelineMetrics.increment_metric("hd_dsc_dicom_read_files_total")
+    
+    return rtstruct_dataset
+
+def rtstruct_metadata(rtstruct_dataset):
+    """
+    Extracting patient ID, frame of reference UID and ROIs of an RTSTRUCT
+    dataset, without decoding its contours.
+    
+    Parameters
+    ----------
+    rtstruct_dataset : pydicom.dataset.FileDataset
+        RTSTRUCT dataset (Ex. patient_data.ds).
+    
+    Returns
+    -------
+    metadata : dict
+        Patient ID ("patient_id"), frame of reference UID
+        ("frame_of_reference_uid"), both None if missing, ROI names in the
+        order of the file ("roi_names") and ROI number by name
+        ("roi_numbers", the first one if a name is repeated).
+    
+    """
+    rois = rtstruct_dataset.get("StructureSetROISequence", [])
+    roi_numbers = {}
+    for roi in rois:
+        roi_numbers.setdefault(roi.ROIName, roi.ROINumber)
+    metadata = {"patient_id": rtstruct_dataset.get("PatientID"),
+                "frame_of_reference_uid":
+                    rtstruct_dataset.get("FrameOfReferenceUID"),
+                "roi_names": [roi.ROIName for roi in rois],
+                "roi_numbers": roi_numbers,
+                }
+    
+    return metadata
+
+def raw_contour_data(contour):
+    """
+    Returning the contour points of an item of a ContourSequence without
+    decoding them.
+    
+    Parameters
+    ----------
+    contour : pydicom.dataset.Dataset
+        Item of the ContourSequence of an ROI.
+    
+    Returns
+    -------
+    contour_data : bytes or list
+        Backslash separated coordinates as stored in the file, or the already
+        decoded values if ContourData was accessed or set before. Empty if
+        the contour has no points.
+    
+    """
+    element = contour.get_item("ContourData")
+    if element is None or element.value is None:
+        return b""
+    
+    return element.value
+
+def contour_points(contour):
+    """
+    Converting the points of an item of a ContourSequence to a float array
+    in a single step.
+    
+    It gives the same values of ContourData, without creating a Python
+    number for every coordinate.
+    
+    Parameters
+    ----------
+    contour : pydicom.dataset.Dataset
+        Item of the ContourSequence of an ROI.
+    
+    Returns
+    -------
+    points : numpy.ndarray
+        Contour points, one row per point with its x, y and z coordinates in
+        millimeters.
+    
+    """
+    contour_data = raw_contour_data(contour)
+    if isinstance(contour_data, bytes):
+        contour_data = (contour_data.split(b"\\") if contour_data.strip()
+                        else []
+                        )
+    
+    return np.array(contour_data,
+                    dtype=np.float64,
+                    ).reshape(-1, 3)
+
+def read_ct_slices(ct_folder_path,
+                   max_workers=None,
+                   stop_before_pixels=False,
+                   read_stats=None,
+                   ):
     """
     This function creates the CT volume from the DICOM series.
+    
+    Files are read concurrently by a pool of threads, since reading is
+    latency bound on network file systems. The read throughput of the series
+    (of its headers only, if pixel data are not read) is printed and the
+    bytes read are added to the pipeline metrics.
 
     Parameters
     ----------
     ct_folder_path : str
         Path to the folder containing DICOM series files
         (Ex: path/to/CTfolder).
+    max_workers : int, optional
+        Number of files read at the same time. If None (default) the number
+        of threads is chosen by concurrent.futures.ThreadPoolExecutor.
+    stop_before_pixels : bool, optional
+        If True only the headers of the slices are read, without pixel data.
+        Default is False.
+    read_stats : dict, optional
+        If given, the number of files read and of bytes actually read are
+        added to its "n_files" and "n_bytes" values.
 
     Returns
     -------
@@ -79,18 +318,55 @@ def read_ct_slices(ct_folder_path):
         Ordered list of the slices that compose the CT volume.
 
     """
-    ct_images = os.listdir(ct_folder_path)
-    slices = []
+    import pydicom
     
-    # Reading each ct image using pydicom and storing the results in a list.
-    for ct_image in ct_images:
-        ct_file_path = os.path.join(ct_folder_path,
-                                    ct_image,
-                                    )
-        single_slice = pydicom.read_file(ct_file_path,
-                                         force=True,
-                                         )
-        slices.append(single_slice)
+    ct_file_paths = [os.path.join(ct_folder_path,
+                                  ct_image,
+                                  )
+                     for ct_image in os.listdir(ct_folder_path)
+                     ]
+    
+    # Header reads stop before the pixel data, the bytes actually read are
+    # counted.
+    def read_slice(ct_file_path):
+        with open(ct_file_path, "rb") as ct_file:
+            single_slice = pydicom.read_file(
+                ct_file,
+                force=True,
+                stop_before_pixels=stop_before_pixels,
+                )
+            return single_slice, ct_file.tell()
+    
+    # Reading each ct image using pydicom, map keeps the order of the files.
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        read_slices = list(executor.map(read_slice,
+                                        ct_file_paths,
+                                        ),
+                           )
+    elapsed = time.perf_counter() - start
+    slices = [single_slice for single_slice, _ in read_slices]
+    n_bytes = sum(size for _, size in read_slices)
+    PipelineMetrics.increment_metric("hd_dsc_dicom_read_bytes_total",
+                                     n_bytes,
+                                     )
+    PipelineMetrics.increment_metric("hd_dsc_dicom_read_files_total",
+                                     len(ct_file_paths),
+                                     )
+    if read_stats is not None:
+        read_stats["n_files"] = (read_stats.get("n_files", 0)
+                                 + len(ct_file_paths)
+                                 )
+        read_stats["n_bytes"] = read_stats.get("n_bytes", 0) + n_bytes
+    
+    # Header reads are reported as such, since they read only the start of
+    # the files.
+    print_read_throughput(ct_folder_path,
+                          len(ct_file_paths),
+                          n_bytes,
+                          elapsed,
+                          stop_before_pixels,
+                          )
         
     # Sorting every image in the list.
     slices = sorted(slices,
@@ -98,7 +374,241 @@ def read_ct_slices(ct_folder_path):
                     )
     return slices
 
-def spacing_and_tolerance(ct_folder_path):
+def load_ct_volume(ct_folder_path,
+                   max_workers=None,
+                   ):
+    """
+    Creating the CT volume as a single 3D array.
+    
+    The array of shape (rows, columns, number of slices) is allocated once
+    and every file is read a single time, decoding its pixels directly into
+    the array. Each dataset is released as soon as its pixels are decoded,
+    so the whole series is never kept in memory. Slices are then put in the
+    order of read_ct_slices in place, one slice at a time.
+    Stored pixel values are not rescaled, Hounsfield units are computed only
+    when needed with hounsfield_units.
+    
+    Parameters
+    ----------
+    ct_folder_path : str
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder).
+    max_workers : int, optional
+        Number of files read at the same time (see read_ct_slices).
+    
+    Returns
+    -------
+    volume : dict
+        Dictionary with the stored pixel values ("voxels", numpy.int16 array,
+        numpy.uint16 if pixels are unsigned with 16 bits stored so that no
+        value wraps), rescale slope and intercept of every slice
+        ("rescale_slope" and "rescale_intercept"), position of the first
+        voxel in mm ("origin"), voxel dimensions in mm along the three array
+        axes ("spacing"), direction cosines of the array axes as columns of a
+        3x3 matrix ("direction") and the 4x4 matrix from voxel indices to
+        patient coordinates in mm ("affine").
+    
+    """
+    import pydicom
+    
+    ct_file_paths = [os.path.join(ct_folder_path,
+                                  ct_image,
+                                  )
+                     for ct_image in os.listdir(ct_folder_path)
+                     ]
+    
+    # Every file is read once, the bytes actually read are counted.
+    def read_slice(index):
+        with open(ct_file_paths[index], "rb") as ct_file:
+            single_slice = pydicom.read_file(ct_file,
+                                             force=True,
+                                             )
+            return single_slice, ct_file.tell()
+    
+    # Only the header values needed after decoding are kept.
+    def slice_header(single_slice):
+        return SimpleNamespace(
+            ImagePositionPatient=single_slice.ImagePositionPatient,
+            ImageOrientationPatient=single_slice.ImageOrientationPatient,
+            PixelSpacing=single_slice.PixelSpacing,
+            SliceThickness=single_slice.get("SliceThickness"),
+            RescaleSlope=float(single_slice.get("RescaleSlope", 1)),
+            RescaleIntercept=float(single_slice.get("RescaleIntercept", 0)),
+            )
+    
+    def decode_slice(index):
+        single_slice, n_bytes = read_slice(index)
+        voxels[:, :, index] = single_slice.pixel_array
+        return slice_header(single_slice), n_bytes
+    
+    # The first file gives the size and the type of the array. Unsigned
+    # pixels with 16 bits stored do not fit in int16.
+    start = time.perf_counter()
+    first_slice, first_bytes = read_slice(0)
+    if first_slice.PixelRepresentation == 0 and first_slice.BitsStored >= 16:
+        dtype = np.uint16
+    else:
+        dtype = np.int16
+    voxels = np.empty((first_slice.Rows,
+                       first_slice.Columns,
+                       len(ct_file_paths),
+                       ),
+                      dtype=dtype,
+                      )
+    voxels[:, :, 0] = first_slice.pixel_array
+    read_slices = [(slice_header(first_slice), first_bytes)]
+    del first_slice
+    
+    # Decoding every file into the slice of the same index.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        read_slices += executor.map(decode_slice,
+                                    range(1, len(ct_file_paths)),
+                                    )
+    elapsed = time.perf_counter() - start
+    headers = [header for header, _ in read_slices]
+    n_bytes = sum(size for _, size in read_slices)
+    PipelineMetrics.increment_metric("hd_dsc_dicom_read_bytes_total",
+                                     n_bytes,
+                                     )
+    PipelineMetrics.increment_metric("hd_dsc_dicom_read_files_total",
+                                     len(ct_file_paths),
+                                     )
+    print_read_throughput(ct_folder_path,
+                          len(ct_file_paths),
+                          n_bytes,
+                          elapsed,
+                          )
+    
+    # Sorting the slices as read_ct_slices, following every cycle of the
+    # permutation so that only one slice is copied at a time.
+    order = sorted(range(len(headers)),
+                   key=lambda index: headers[index].ImagePositionPatient[2],
+                   )
+    done = [False] * len(order)
+    for cycle_start in range(len(order)):
+        if done[cycle_start] or order[cycle_start] == cycle_start:
+            continue
+        first_voxels = voxels[:, :, cycle_start].copy()
+        index = cycle_start
+        while order[index] != cycle_start:
+            voxels[:, :, index] = voxels[:, :, order[index]]
+            done[index] = True
+            index = order[index]
+        voxels[:, :, index] = first_voxels
+        done[index] = True
+    headers = [headers[index] for index in order]
+    
+    # Voxel dimensions along the axes of series_geometry, the slices axis is
+    # turned towards increasing slice indices.
+    geometry = series_geometry(headers)
+    direction = geometry["axes"].T.copy()
+    if len(headers) > 1:
+        slice_spacing = ((geometry["slice_positions"][-1]
+                          - geometry["slice_positions"][0])
+                         / (len(headers) - 1)
+                         )
+    else:
+        slice_spacing = float(headers[0].SliceThickness or 1)
+    if slice_spacing < 0:
+        direction[:, 2] = -direction[:, 2]
+        slice_spacing = -slice_spacing
+    spacing = np.array([float(headers[0].PixelSpacing[0]),
+                        float(headers[0].PixelSpacing[1]),
+                        slice_spacing,
+                        ],
+                       )
+    affine = np.eye(4)
+    affine[:3, :3] = direction * spacing
+    affine[:3, 3] = geometry["origin"]
+    
+    volume = {"voxels": voxels,
+              "rescale_slope": np.array([header.RescaleSlope
+                                         for header in headers
+                                         ],
+                                        ),
+              "rescale_intercept": np.array([header.RescaleIntercept
+                                             for header in headers
+                                             ],
+                                            ),
+              "origin": geometry["origin"],
+              "spacing": spacing,
+              "direction": direction,
+              "affine": affine,
+              }
+    
+    return volume
+
+def hounsfield_units(volume,
+                     slice_index=None,
+                     ):
+    """
+    Applying rescale slope and intercept to the stored pixel values.
+    
+    Parameters
+    ----------
+    volume : dict
+        CT volume created by load_ct_volume.
+    slice_index : int, optional
+        If given, only this slice is rescaled. If None (default) the whole
+        volume is rescaled.
+    
+    Returns
+    -------
+    hu : numpy.ndarray
+        Pixel values in Hounsfield units (float32).
+    
+    """
+    if slice_index is None:
+        return (volume["voxels"].astype(np.float32)
+                * volume["rescale_slope"].astype(np.float32)
+                + volume["rescale_intercept"].astype(np.float32)
+                )
+    
+    return (volume["voxels"][:, :, slice_index].astype(np.float32)
+            * np.float32(volume["rescale_slope"][slice_index])
+            + np.float32(volume["rescale_intercept"][slice_index])
+            )
+
+def print_read_throughput(series_path,
+                          n_files,
+                          n_bytes,
+                          elapsed,
+                          headers_only=False,
+                          ):
+    """
+    Printing the read throughput of a DICOM series in MB/s and files/s.
+
+    Parameters
+    ----------
+    series_path : str
+        Path to the series that has been read.
+    n_files : int
+        Number of files read.
+    n_bytes : int
+        Number of bytes actually read.
+    elapsed : float
+        Reading time in seconds.
+    headers_only : bool, optional
+        If True only the headers of the files were read. Default is False.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Avoiding divisions by zero for empty or very small series.
+    elapsed = max(elapsed, 1e-9)
+    megabytes = n_bytes / 1024**2
+    what = "headers of " if headers_only else ""
+    print(f"Read {what}{n_files} files ({megabytes:.1f} MB) from",
+          f"{series_path} in",
+          f"{elapsed:.2f} s: {megabytes / elapsed:.1f} MB/s,",
+          f"{n_files / elapsed:.1f} files/s",
+          )
+
+def spacing_and_tolerance(ct_folder_path,
+                          slices=None,
+                          ):
     """
     Computing voxel spacing of the loaded DICOM series.
 
@@ -107,6 +617,9 @@ def spacing_and_tolerance(ct_folder_path):
     ct_folder_path : str
         Path to the folder containing DICOM series files
         (Ex: path/to/CTfolder).
+    slices : list, optional
+        Already loaded slices of the CT volume. If None (default) the slices
+        are read from ct_folder_path.
 
     Returns
     -------
@@ -116,8 +629,9 @@ def spacing_and_tolerance(ct_folder_path):
         Greatest voxel dimension in millimeters.
 
     """
-    # Creating CT volume
-    slices = read_ct_slices(ct_folder_path)
+    # Creating CT volume if it has not been already loaded.
+    if slices is None:
+        slices = read_ct_slices(ct_folder_path)
     
     # Computing pixel spacing.
     pixel_spacing_mm = list(map(float,
@@ -159,6 +673,8 @@ def extract_all_segments(ct_folder_path,
         (Ex. [Prostate, Bladder, Rectum])
 
     """
+    from rt_utils import RTStructBuilder
+    
     # Reading current patient files.
     patient_data = RTStructBuilder.create_from(ct_folder_path, 
                                                rtstruct_file_path,
@@ -170,8 +686,276 @@ def extract_all_segments(ct_folder_path,
     return all_segments
     
 
+def load_patient_data(ct_folder_path,
+                      rtstruct_file_path,
+                      max_workers=None,
+                      rtstruct_dataset=None,
+                      read_stats=None,
+                      ):
+    """
+    Reading the CT series and the RTSTRUCT file of the current patient.
+    
+    It is equivalent to RTStructBuilder.create_from, but the CT series is
+    read concurrently with read_ct_slices. Labelmaps only need the geometry of
+    the slices, so pixel data are not read.
+
+    Parameters
+    ----------
+    ct_folder_path : str
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder).
+    rtstruct_file_path : str
+        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm").
+    max_workers : int, optional
+        Number of CT files read at the same time (see read_ct_slices).
+    rtstruct_dataset : pydicom.dataset.FileDataset, optional
+        Already read RTSTRUCT dataset (see read_rtstruct). If None (default)
+        the file is read.
+    read_stats : dict, optional
+        Files and bytes read from the CT series (see read_ct_slices).
+
+    Returns
+    -------
+    patient_data : rt_utils.RTStruct
+        Loaded patient files.
+
+    """
+    from rt_utils import RTStructBuilder, RTStruct
+    
+    series_data = read_ct_slices(ct_folder_path,
+                                 max_workers,
+                                 stop_before_pixels=True,
+                                 read_stats=read_stats,
+                                 )
+    if rtstruct_dataset is None:
+        rtstruct_dataset = read_rtstruct(rtstruct_file_path)
+    
+    # Same checks done by RTStructBuilder.create_from
+    RTStructBuilder.validate_rtstruct(rtstruct_dataset)
+    RTStructBuilder.validate_rtstruct_series_references(rtstruct_dataset,
+                                                        series_data,
+                                                        )
+    patient_data = RTStruct(series_data,
+                            rtstruct_dataset,
+                            )
+    
+    return patient_data
+
+def automatic_methods(config):
+    """
+    Returning the names of the automatic segmentation methods.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    methods : list
+        Names of the automatic methods (Ex. ["MBS", "DL"]). The segments of
+        every method are stored in the configuration list "<method> segments".
+
+    """
+    return config.get("Automatic methods",
+                      DEFAULT_AUTOMATIC_METHODS,
+                      )
+
+def manual_names_lists(config):
+    """
+    Returning the configuration lists of manual segments names.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    names_lists : list
+        Keys of the configuration lists of manual segments names, in the same
+        order of the alias names (Ex. ["Prostate names", "Rectum names"]).
+
+    """
+    return config.get("Manual names lists",
+                      DEFAULT_MANUAL_NAMES_LISTS,
+                      )
+
+def normalize_segment_name(name,
+                           case_insensitive=False,
+                           ):
+    """
+    Normalizing a segment name for the lookup in the segments index.
+
+    Parameters
+    ----------
+    name : str
+        Name of the segment (Ex. " Prostate").
+    case_insensitive : bool, optional
+        If True the name is also converted to lower case. Default is False.
+
+    Returns
+    -------
+    normalized_name : str
+        Name without leading and trailing spaces (Ex. "Prostate").
+
+    """
+    normalized_name = name.strip()
+    if case_insensitive:
+        normalized_name = normalized_name.casefold()
+    
+    return normalized_name
+
+def add_to_segment_index(segment_index,
+                         name,
+                         category,
+                         alias_index,
+                         ):
+    """
+    Adding a configuration name to the segments index.
+    
+    Names starting with "re:" are regular expressions that must match the
+    whole segment name, the execution is halted if one is not valid. If a
+    name is already in the index the first category is kept.
+
+    Parameters
+    ----------
+    segment_index : dict
+        Segments index created by compile_segment_index.
+    name : str
+        Segment name or regular expression.
+    category : str
+        Configuration list of the name (Ex. "Prostate names").
+    alias_index : int or None
+        Position of the corresponding alias name, None for categories without
+        alias (Ex. "External names").
+
+    Returns
+    -------
+    None.
+
+    """
+    case_insensitive = segment_index["case_insensitive"]
+    if name.startswith(REGEX_PREFIX):
+        flags = re.IGNORECASE if case_insensitive else 0
+        try:
+            pattern = re.compile(name[len(REGEX_PREFIX):].strip(),
+                                 flags,
+                                 )
+        except re.error as error:
+            sys.exit(f"{name!r} in {category} is not a valid regular "
+                     f"expression ({error}), execution halted"
+                     )
+        segment_index["patterns"].append((pattern,
+                                          (category, alias_index),
+                                          ),
+                                         )
+    else:
+        segment_index["names"].setdefault(normalize_segment_name(name,
+                                                                 case_insensitive,
+                                                                 ),
+                                          (category, alias_index),
+                                          )
+
+def compile_segment_index(config):
+    """
+    Creating the index from segment names to their configuration list.
+    
+    The configuration is read once and every name is stored in a dictionary,
+    so that every segment is then found with a single lookup. The priority of
+    the lists is: the segments of the automatic methods (Ex. "MBS segments",
+    "DL segments"), "External names" and then the manual names lists in the
+    order of the alias names.
+    Names are compared without leading and trailing spaces and, if the
+    configuration value "Case insensitive names" is true, without considering
+    the case.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    segment_index : dict
+        Dictionary with the map from normalized names to (category, alias
+        index) ("names"), the list of regular expressions with their
+        (category, alias index) ("patterns") and the case option
+        ("case_insensitive").
+
+    """
+    segment_index = {"names": {},
+                     "patterns": [],
+                     "case_insensitive": config.get("Case insensitive names",
+                                                    False,
+                                                    ),
+                     }
+    
+    # Automatic segments are in the same order of the alias names.
+    for method in automatic_methods(config):
+        category = f"{method} segments"
+        for alias_index, name in enumerate(config.get(category, [])):
+            add_to_segment_index(segment_index,
+                                 name,
+                                 category,
+                                 alias_index,
+                                 )
+    
+    for name in config.get("External names", []):
+        add_to_segment_index(segment_index,
+                             name,
+                             "External names",
+                             None,
+                             )
+    
+    for alias_index, category in enumerate(manual_names_lists(config)):
+        for name in config.get(category, []):
+            add_to_segment_index(segment_index,
+                                 name,
+                                 category,
+                                 alias_index,
+                                 )
+    
+    return segment_index
+
+def lookup_segment(name,
+                   segment_index,
+                   ):
+    """
+    Finding the configuration list of a segment name.
+    
+    Exact names are searched first, then regular expressions in order.
+
+    Parameters
+    ----------
+    name : str
+        Name of the segment (Ex. "Prostata").
+    segment_index : dict
+        Segments index created by compile_segment_index.
+
+    Returns
+    -------
+    match : tuple or None
+        (category, alias index) of the segment (Ex. ("Prostate names", 0)),
+        None if the segment is not in the configuration.
+
+    """
+    normalized_name = normalize_segment_name(name,
+                                             segment_index["case_insensitive"],
+                                             )
+    match = segment_index["names"].get(normalized_name)
+    if match is not None:
+        return match
+    
+    for pattern, match in segment_index["patterns"]:
+        if pattern.fullmatch(name.strip()):
+            return match
+    
+    return None
+
 def find_unknown_segments(all_segments,
                           config,
+                          segment_index=None,
                           ):
     """
     Creates a list of current patient's segments that are not in the
@@ -184,6 +968,9 @@ def find_unknown_segments(all_segments,
         (Ex. [Prostate, Bladder, Rectum]).
     config : dict
         Dictionary containing lists of possible manual segments names.
+    segment_index : dict, optional
+        Segments index created by compile_segment_index. If None (default)
+        it is created from config.
 
     Returns
     -------
@@ -192,34 +979,19 @@ def find_unknown_segments(all_segments,
         (Ex. Spinal cord, Brainstem)
 
     """
-    # Creating the list that will contain the unkown segments
-    unknown_segments = []
+    if segment_index is None:
+        segment_index = compile_segment_index(config)
     
     # Finding the unkown segments and storing them in a list 
-    for name in all_segments:
-        if name in config["MBS segments"]:
-            continue
-        elif name in config["DL segments"]:
-            continue
-        elif name in config["External names"]:
-            continue
-        elif name in config["Prostate names"]:
-            continue
-        elif name in config["Rectum names"]:
-            continue
-        elif name in config["Bladder names"]:
-            continue
-        elif name in config["Left femur names"]:
-            continue
-        elif name in config["Right femur names"]:
-            continue
-        else:
-            unknown_segments.append(name)
+    unknown_segments = [name for name in all_segments
+                        if lookup_segment(name, segment_index) is None
+                        ]
             
     return unknown_segments
 
 def user_selection(unknown_segments,
                    config,
+                   segment_index=None,
                    ):
     """
     Asking the user if uknown segments must be kept or not.
@@ -227,8 +999,10 @@ def user_selection(unknown_segments,
     Segments that are not in any list of the configuration file are shown to
     the user.
     If the user chooses to keep the segments he needs also to choose in which
-    list of the configuration file they must be saved.
-    Otherwise they will be discarded.
+    list of the configuration file they must be saved, entering the number
+    of its alias name (alias names depend on the configuration file, so they
+    have no fixed letters).
+    Otherwise they will be discarded. Invalid answers are asked again.
 
     Parameters
     ----------
@@ -236,52 +1010,63 @@ def user_selection(unknown_segments,
         List of segments names that are not in the configuration file.
     config : dict
         Dictionary containing lists of possible manual segments names.
+    segment_index : dict, optional
+        Segments index created by compile_segment_index, the kept segments
+        are added to it too.
 
     Returns
     -------
     None.
 
     """
+    names_lists = manual_names_lists(config)
+    choices = ", ".join(f"{alias_index} ({alias_name})"
+                        for alias_index, alias_name
+                        in enumerate(config["Alias names"])
+                        )
+    
     # Asking to the user if the unknown segments must be kept or not, if yes
     # asking in which list of names they should be put.
     for name in unknown_segments:
         line = f"Do you want to keep {name}? Enter Y (yes) or N (no) \n"
-        to_keep = input(line).upper()
-        if to_keep == "Y":
-            line1 = (f"To which alias name is {name} associated? Enter P")
-            line2 = ("(Prostate), A (Anorectum), B (Bladder), L (Left")
-            line3 = ("femur) R (Right femur) \n")
-            what_is = input(line1+line2+line3).upper()
-            if what_is == "P":
-                config["Prostate names"].append(name)
-                print(name,"added to Prostate names in config.json")
-            elif what_is == "A":
-                config["Rectum names"].append(name)
-                print(name,"added to Rectum names in config.json")
-            elif what_is == "B":
-                config["Bladder names"].append(name)
-                print(name,"added to Bladder names in config.json")
-            elif what_is == "L":
-                config["Left femur names"].append(name)
-                print(name,"added to Left femur names in config.json")
-            elif what_is == "R":
-                config["Right femur names"].append(name)
-                print(name,"added to Right femur names in config.json")
-        elif to_keep == "N":
+        to_keep = input(line).strip().upper()
+        while to_keep not in ("Y", "N"):
+            to_keep = input(line).strip().upper()
+        if to_keep == "N":
             continue
         
+        line = (f"To which alias name is {name} associated? Enter the "
+                f"number of the alias name: {choices} \n"
+                )
+        what_is = input(line).strip()
+        while not (what_is.isdigit() and int(what_is) < len(names_lists)):
+            print(f"{what_is!r} is not the number of an alias name")
+            what_is = input(line).strip()
+        alias_index = int(what_is)
+        category = names_lists[alias_index]
+        config.setdefault(category, []).append(name)
+        print(name,f"added to {category} in config.json")
+        if segment_index is not None:
+            add_to_segment_index(segment_index,
+                                 name,
+                                 category,
+                                 alias_index,
+                                 )
+        
 def extract_manual_segments(all_segments,
                             config,
+                            segment_index=None,
                             ):
     """
     Creating the list of manual segments.
     
     The list of all segments in the image is extracted from patient data.
     Then, the manual_segments list is created starting from the list of alias
-    names and is initially filled with zeros.
-    Every element of all_segments is compared with the lists of names in the 
-    config.json file and inserted in the correct place of the manual_segments
-    list.
+    names and is initially filled with None, which marks the structures that
+    are absent.
+    Every element of all_segments is searched in the segments index of the
+    config.json file and inserted in the correct place of the
+    manual_segments list.
 
     Parameters
     ----------
@@ -290,41 +1075,200 @@ def extract_manual_segments(all_segments,
         (Ex. [Prostate, Bladder, Rectum]).
     config : dict
         Dictionary containing lists of possible manual segments names.
+    segment_index : dict, optional
+        Segments index created by compile_segment_index. If None (default)
+        it is created from config.
 
     Returns
     -------
     manual_segments: list
-        List containing current patient manual segments names.
+        List containing current patient manual segments names, None for the
+        structures without a manual segment.
 
     """
+    if segment_index is None:
+        segment_index = compile_segment_index(config)
+    names_lists = manual_names_lists(config)
+    
     # Creates the list of manual segments
-    manual_segments = [0 for i in range(len(config["Alias names"]))]
+    manual_segments = [None for i in range(len(config["Alias names"]))]
     # Puts every manual segment in the correct place of the list
     for name in all_segments:
-        if name in config["MBS segments"]:
-            continue
-        elif name in config["DL segments"]:
-            continue
-        elif name in config["External names"]:
-            continue
-        elif name in config["Prostate names"]:
-            manual_segments[0] = name
-        elif name in config["Rectum names"]:
-            manual_segments[1] = name
-        elif name in config["Bladder names"]:
-            manual_segments[2] = name
-        elif name in config["Left femur names"]:
-            manual_segments[3] = name
-        elif name in config["Right femur names"]:
-            manual_segments[4] = name
-        else:
+        match = lookup_segment(name,
+                               segment_index,
+                               )
+        if match is None or match[0] not in names_lists:
             continue
+        manual_segments[match[1]] = name
         
     return manual_segments
 
+def contoured_segments(rtstruct_dataset):
+    """
+    Finding the segments of an RTSTRUCT file that have at least one contour
+    point, without decoding the contour points.
+    
+    Parameters
+    ----------
+    rtstruct_dataset : pydicom.dataset.FileDataset
+        RTSTRUCT dataset (Ex. patient_data.ds).
+    
+    Returns
+    -------
+    segment_names : set
+        Names of the segments with contours.
+    
+    """
+    contoured_numbers = set()
+    for roi_contour in rtstruct_dataset.get("ROIContourSequence", []):
+        if any(len(raw_contour_data(contour))
+               for contour in roi_contour.get("ContourSequence", [])
+               ):
+            contoured_numbers.add(roi_contour.ReferencedROINumber)
+    
+    return {roi.ROIName
+            for roi in rtstruct_dataset.get("StructureSetROISequence", [])
+            if roi.ROINumber in contoured_numbers
+            }
+
+def contour_fingerprints(rtstruct_dataset):
+    """
+    Computing a fingerprint of the contours of every segment of an RTSTRUCT
+    file.
+    
+    The fingerprint is the SHA-1 hash of the contour points, so it changes
+    only if the contours of the segment are edited.
+    
+    Parameters
+    ----------
+    rtstruct_dataset : pydicom.dataset.FileDataset
+        RTSTRUCT dataset (Ex. patient_data.ds).
+    
+    Returns
+    -------
+    fingerprints : dict
+        Hexadecimal fingerprint by segment name.
+    
+    """
+    hashes = {}
+    for roi_contour in rtstruct_dataset.get("ROIContourSequence", []):
+        roi_hash = hashlib.sha1()
+        for contour in roi_contour.get("ContourSequence", []):
+            points = contour_points(contour).ravel()
+            # The number of points separates consecutive contours.
+            roi_hash.update(np.int64(len(points)).tobytes())
+            roi_hash.update(points.tobytes())
+        hashes[roi_contour.ReferencedROINumber] = roi_hash.hexdigest()
+    
+    # Segments without contours have the hash of no points.
+    fingerprints = {roi.ROIName: hashes.get(roi.ROINumber,
+                                            hashlib.sha1().hexdigest(),
+                                            )
+                    for roi in rtstruct_dataset.get("StructureSetROISequence",
+                                                    [],
+                                                    )
+                    }
+    
+    return fingerprints
+
+def reused_metrics(previous_row,
+                   reference_segment,
+                   compared_segment,
+                   fingerprints,
+                   metric_columns,
+                   ):
+    """
+    Returning the previous metrics of a comparison if its segments did not
+    change.
+    
+    Parameters
+    ----------
+    previous_row : dict or None
+        Row of the comparison in the previous results (see
+        previous_results), None if there is not one.
+    reference_segment : str or None
+        Name of the reference segment.
+    compared_segment : str or None
+        Name of the segment to compare.
+    fingerprints : dict
+        Current fingerprints by segment name (see contour_fingerprints).
+    metric_columns : list
+        Columns of the metrics to reuse.
+    
+    Returns
+    -------
+    values : list or None
+        Previous values of the metrics, None if they must be computed again
+        (segments or contours changed, or metrics not in the previous
+        results).
+    
+    """
+    if previous_row is None:
+        return None
+    for name_column, fingerprint_column, segment_name in (
+            ("Reference segment name",
+             Results.FINGERPRINT_COLUMNS[0],
+             reference_segment,
+             ),
+            ("Compared segment name",
+             Results.FINGERPRINT_COLUMNS[1],
+             compared_segment,
+             ),
+            ):
+        if (previous_row.get(name_column) != (segment_name or "")
+                or previous_row.get(fingerprint_column)
+                != fingerprints.get(segment_name, "")):
+            return None
+    if any(column not in previous_row for column in metric_columns):
+        return None
+    
+    return [previous_row[column] for column in metric_columns]
+
+def skipped_reason(reference_segment,
+                   compared_segment,
+                   all_segments,
+                   contoured,
+                   ):
+    """
+    Finding why a comparison can not be performed.
+    
+    A segment is absent if the structure has no segment of its method
+    (None) or the RTSTRUCT file does not have it, and empty if it has no
+    contour points.
+    
+    Parameters
+    ----------
+    reference_segment : str or None
+        Name of the reference segment.
+    compared_segment : str or None
+        Name of the segment to compare.
+    all_segments : list
+        Names of all the segments of the RTSTRUCT file.
+    contoured : set
+        Names of the segments with contours (see contoured_segments).
+    
+    Returns
+    -------
+    reason : str
+        Reason codes separated by ", " (Ex. "reference absent, compared
+        empty"), empty if the comparison can be performed.
+    
+    """
+    reasons = []
+    for role, segment_name in (("reference", reference_segment),
+                               ("compared", compared_segment),
+                               ):
+        if segment_name is None or segment_name not in all_segments:
+            reasons.append(f"{role} absent")
+        elif segment_name not in contoured:
+            reasons.append(f"{role} empty")
+    
+    return ", ".join(reasons)
+
 def create_labelmap(ct_folder_path,
                     rtstruct_file_path,
                     segment_name,
+                    patient_data=None,
                     ):
     """
     Creating the binary labelmap for the current segment.
@@ -339,6 +1283,9 @@ def create_labelmap(ct_folder_path,
     segment_name : str
         Name of the segment
         (Ex. "Prostate")
+    patient_data : rt_utils.RTStruct, optional
+        Already loaded patient files. If None (default) they are read from
+        ct_folder_path and rtstruct_file_path.
      
     Returns
     -------
@@ -347,10 +1294,13 @@ def create_labelmap(ct_folder_path,
         1 inside).
 
     """
-    # Reading current patient files.
-    patient_data = RTStructBuilder.create_from(ct_folder_path, 
-                                               rtstruct_file_path,
-                                               )
+    from rt_utils import RTStructBuilder
+    
+    # Reading current patient files if they have not been already loaded.
+    if patient_data is None:
+        patient_data = RTStructBuilder.create_from(ct_folder_path, 
+                                                   rtstruct_file_path,
+                                                   )
     
     # Binary labelmap creation
     labelmap = patient_data.get_roi_mask_by_name(segment_name)
@@ -360,6 +1310,12 @@ def create_labelmap(ct_folder_path,
 def compute_metrics(reference_labelmap,
                     compared_labelmap,
                     ct_folder_path,
+                    slices=None,
+                    voxel_spacing_mm=None,
+                    coarse_to_fine=False,
+                    additional_metrics=None,
+                    backend="surface-distance",
+                    hausdorff=True,
                     ):
     """
     Computing Hausdorff distance (hd), volumetric Dice similarity coefficient
@@ -369,6 +1325,8 @@ def compute_metrics(reference_labelmap,
     are computed.
     Surface Dice tolerance is set equal to the greatest voxel dimension.
     Percent value of Hausdorff distance is set to 95.
+    Labelmaps are cropped to the bounding box of their union first, which
+    does not change the metrics.
     
 
     Parameters
@@ -377,8 +1335,33 @@ def compute_metrics(reference_labelmap,
         3D binary array of the reference segment.
     compared_labelmap: numpy.ndarray
         3D binary array of the segment to compare.
-    voxel_spacing_mm : list
-        Voxel dimensions (Ex. [1, 1, 3])
+    ct_folder_path : str
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder).
+    slices : list, optional
+        Already loaded slices of the CT volume, used to compute voxel spacing
+        without reading the series again.
+    voxel_spacing_mm : list, optional
+        Voxel spacing of the labelmaps in millimeters, if they are not on the
+        CT grid (Ex. resampled labelmaps). If None (default) the spacing of
+        the CT series is used.
+    coarse_to_fine : bool, optional
+        If True surface distances are computed by
+        coarse_to_fine_surface_distances, which gives the same metrics faster.
+        Default is False.
+    additional_metrics : dict, optional
+        Dictionary whose keys are the names of the additional metrics to
+        compute (see ADDITIONAL_METRICS), their values are set by the
+        function from the same surface distances. Default is None.
+    backend : str, optional
+        One of DISTANCE_BACKENDS, computing the surface distances when they
+        are not computed coarse to fine (see surface_distances). Default is
+        "surface-distance".
+    hausdorff : bool, optional
+        If False the Hausdorff distance is NaN and, unless an additional
+        metric needs the surface distances (see SURFACE_DISTANCES_METRICS),
+        surface Dice is computed by banded_surface_dice without them.
+        Default is True.
 
     Returns
     -------
@@ -392,205 +1375,2121 @@ def compute_metrics(reference_labelmap,
         Value of the Hausdorff distance between the two compared segments.
 
     """
+    import surface_distance as sd
+    
     # Computing voxel spacing and tolerance
-    voxel_spacing_mm, tolerance = spacing_and_tolerance(ct_folder_path)
+    if voxel_spacing_mm is None:
+        voxel_spacing_mm, tolerance = spacing_and_tolerance(ct_folder_path,
+                                                            slices,
+                                                            )
+    else:
+        tolerance = max(voxel_spacing_mm)
     
-    # Metrics computation
-    surf_dists = sd.compute_surface_distances(reference_labelmap,
-                                              compared_labelmap,
-                                              voxel_spacing_mm,
-                                              )
+    # Only the box around the two segments is needed.
+    reference_labelmap, compared_labelmap = crop_to_union(reference_labelmap,
+                                                          compared_labelmap,
+                                                          )
+    
+    # Metrics computation. Without Hausdorff distance, surface Dice only
+    # needs the surface elements within the tolerance. Additional metrics
+    # using all the distances need them exact.
+    if not hausdorff and not any(name in SURFACE_DISTANCES_METRICS
+                                 for name in (additional_metrics or {})
+                                 ):
+        surf_dists = None
+    elif coarse_to_fine and not any(name in ALL_DISTANCES_METRICS
+                                  for name in (additional_metrics or {})
+                                  ):
+        surf_dists = coarse_to_fine_surface_distances(reference_labelmap,
+                                                      compared_labelmap,
+                                                      voxel_spacing_mm,
+                                                      tolerance,
+                                                      )
+    else:
+        surf_dists = surface_distances(reference_labelmap,
+                                       compared_labelmap,
+                                       voxel_spacing_mm,
+                                       backend,
+                                       )
     
    
-    surface_dice = sd.compute_surface_dice_at_tolerance(surf_dists,
-                                                        tolerance_mm=tolerance,
-                                                        )
+    if surf_dists is None:
+        surface_dice = banded_surface_dice(reference_labelmap,
+                                           compared_labelmap,
+                                           voxel_spacing_mm,
+                                           tolerance,
+                                           )
+    else:
+        surface_dice = sd.compute_surface_dice_at_tolerance(
+            surf_dists,
+            tolerance_mm=tolerance,
+            )
     
     volume_dice = sd.compute_dice_coefficient(reference_labelmap,
                                               compared_labelmap,
                                               )
     
-    hausdorff_distance = sd.compute_robust_hausdorff(surf_dists,
-                                                     percent=95,
-                                                     )
+    if hausdorff:
+        hausdorff_distance = sd.compute_robust_hausdorff(surf_dists,
+                                                         percent=95,
+                                                         )
+    else:
+        hausdorff_distance = np.nan
+    
+    if additional_metrics:
+        additional_metrics.update(additional_metric_values(
+            list(additional_metrics),
+            surf_dists,
+            overlap_counts(reference_labelmap,
+                           compared_labelmap,
+                           ),
+            voxel_spacing_mm,
+            tolerance,
+            ))
     
     return surface_dice, volume_dice, hausdorff_distance
 
-def store_patients(input_folder_path):
+def overlap_counts(reference_labelmap,
+                   compared_labelmap,
+                   ):
     """
-    Searching input directory for patient folders and storing their names in
-    a list.
-
+    Counting the voxels of two labelmaps and of their intersection.
+    
     Parameters
     ----------
-    input_folder_path : str
-        Path to the folder where patients are stored.
-
+    reference_labelmap: numpy.ndarray
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray
+        3D binary array of the segment to compare.
+    
     Returns
     -------
-    patient_folders: list
-        List containing the names of patient folders in the input directory.
-
+    counts : dict
+        Number of voxels of the reference ("reference"), of the compared
+        ("compared") and of both segments ("intersection").
+    
     """
-    patient_folders = []
-    for folder in os.listdir(input_folder_path):
-        # Only patient folders are needed, so, files are skipped.
-        if not os.path.isfile(os.path.join(input_folder_path,folder)):
-            patient_folders.append(folder)
-            
-    return patient_folders
+    counts = {"reference": int(np.count_nonzero(reference_labelmap)),
+              "compared": int(np.count_nonzero(compared_labelmap)),
+              "intersection": int(np.count_nonzero(reference_labelmap
+                                                   & compared_labelmap
+                                                   )),
+              }
+    
+    return counts
 
-def create_folder(parent_folder_path,
-                  folder_name,
-                  ):
+def ratio(numerator,
+          denominator,
+          ):
     """
-    Creating a new folder and returning the path to it.
-
+    Dividing two numbers, NaN if the denominator is 0.
+    
     Parameters
     ----------
-    parent_folder_path : str
-        Path to the folder where the new one must be created.
-    folder_name : str
-        Name of the new folder.
-     
+    numerator : float
+        Numerator of the ratio.
+    denominator : float
+        Denominator of the ratio.
+    
     Returns
     -------
-    new_folder_path: str
-        Path to the new folder.
-
-    """
-    # Defining folder path
-    new_folder_path = os.path.join(parent_folder_path,
-                                   folder_name,
-                                   )
+    ratio : float
+        numerator / denominator, NaN if denominator is 0.
     
-    # Creating folder if does not exist
-    try:
-        os.mkdir(new_folder_path)
-    except FileExistsError:
-        pass
+    """
+    if denominator == 0:
+        return np.nan
     
-    return new_folder_path
+    return numerator / denominator
 
-def move_ct_rtstruct_files(patient_folder_path,
-                           ct_folder_path,
-                           rtstruct_folder_path,
-                           ):
+def additional_metric_values(metrics,
+                             surf_dists,
+                             counts,
+                             voxel_spacing_mm,
+                             tolerance_mm,
+                             ):
     """
-    Moving CT files in the CT folder and RS files in the RTSTRUCT folder.
-    Folders and different kind of files won't be moved.
+    Computing additional metrics from the surface distances and the overlap
+    counts of two segments.
+    
+    Surface distances of both directions are weighted by the areas of their
+    surface elements. Added path length is the area of the reference surface
+    farther than the tolerance from the compared surface, divided by the
+    slice thickness, that is the length of the reference contours that must
+    be drawn again. Volume difference is the compared volume minus the
+    reference volume.
     
     Parameters
     ----------
-    patient_folder_path : str
-        Path to the patient folder.
-    ct_folder_path : str
-        Path to the folder where CT files will be stored.
-    rtstruct_folder_path : str
-        Path to the folder where RTSTRUCT files will be stored.
-
+    metrics : list
+        Names of the metrics to compute (keys of ADDITIONAL_METRICS).
+    surf_dists : dict or None
+        Surface distances created by surface_distance.compute_surface_distances
+        (None if no metric of SURFACE_DISTANCES_METRICS is computed).
+    counts : dict
+        Voxel counts created by overlap_counts.
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    tolerance_mm : float
+        Tolerance of the surface Dice in millimeters.
+    
     Returns
     -------
-    None.
-
+    values : dict
+        Value of every metric by name.
+    
     """
-    for file in os.listdir(patient_folder_path):
-        file_path = os.path.join(patient_folder_path,
-                                 file,
-                                 )
-        if not os.path.isfile(file_path):
-            pass
-        else:
-            if not (file.startswith("CT") or file.startswith("RS")):
-                pass
-            elif file.startswith("CT"):
-                shutil.move(file_path,
-                            ct_folder_path,
-                            )
-            elif file.startswith("RS"):
-                shutil.move(file_path,
-                            rtstruct_folder_path,
-                            )
+    if surf_dists is not None:
+        distances_gt = surf_dists["distances_gt_to_pred"]
+        distances_pred = surf_dists["distances_pred_to_gt"]
+        areas_gt = surf_dists["surfel_areas_gt"]
+        areas_pred = surf_dists["surfel_areas_pred"]
+        distances = np.concatenate((distances_gt, distances_pred))
+        areas = np.concatenate((areas_gt, areas_pred))
+    
+    # Every metric is computed only if requested.
+    union = counts["reference"] + counts["compared"] - counts["intersection"]
+    formulas = {
+        "Jaccard index": lambda: ratio(counts["intersection"],
+                                       union,
+                                       ),
+        "Added path length": lambda: (
+            np.sum(areas_gt[distances_gt > tolerance_mm])
+            / voxel_spacing_mm[2]),
+        "Mean surface distance": lambda: ratio(np.sum(distances * areas),
+                                               np.sum(areas),
+                                               ),
+        "Median surface distance": lambda: (
+            weighted_percentile(distances, areas, 50) if len(distances)
+            else np.inf),
+        "Volume difference": lambda: (
+            (counts["compared"] - counts["reference"])
+            * np.prod(voxel_spacing_mm) / 1000),
+        "Sensitivity": lambda: ratio(counts["intersection"],
+                                     counts["reference"],
+                                     ),
+        "Precision": lambda: ratio(counts["intersection"],
+                                   counts["compared"],
+                                   ),
+        "Hausdorff distance reference to compared": lambda: (
+            weighted_percentile(distances_gt, areas_gt, 95) if len(distances_gt)
+            else np.inf),
+        "Hausdorff distance compared to reference": lambda: (
+            weighted_percentile(distances_pred, areas_pred, 95)
+            if len(distances_pred) else np.inf),
+        }
+    values = {name: float(formulas[name]()) for name in metrics}
+    
+    return values
 
-def fill_ct_rtstruct_folders(patient_folder_path,
-                             ct_folder_path,
-                             rtstruct_folder_path,
-                             ):
+def additional_metrics(config):
     """
-    Filling CT and RTSTRUCT folders if both empty.
-    Exiting if only one of the folder is empty.
-    Going on with execution if both folders already have files inside.
-
+    Reading the additional metrics to compute from the configuration file.
+    Execution is halted if a metric is unknown.
+    
     Parameters
     ----------
-    patient_folder_path : str
-        Path to the patient folder.
-    ct_folder_path : str
-        Path to the folder where CT files will be stored.
-    rtstruct_folder_path : str
-        Path to the folder where RTSTRUCT files will be stored.
-
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
     Returns
     -------
-    None.
+    metrics : list
+        Names of the metrics in "Additional metrics", empty if it is missing
+        (default).
+    
+    """
+    metrics = list(config.get("Additional metrics", []))
+    for name in metrics:
+        if name not in ADDITIONAL_METRICS:
+            sys.exit(f"{name} is not one of the additional metrics "
+                     f"{list(ADDITIONAL_METRICS)}, execution halted"
+                     )
+    
+    return metrics
 
+def results_columns(config):
     """
-    # If both CT and RTSTRUCT folders have files in them no action is needed.
-    if not (is_empty(rtstruct_folder_path) or is_empty(ct_folder_path)):
-        print("Both RTSTRUCT and CT folders have already files in them.",
-              "Thus, no files will be moved",
-              )
-        pass
-    # Filling CT and RTSTRUCT folders if both empty.
-    elif (is_empty(rtstruct_folder_path) and is_empty(ct_folder_path)):
-        print("Moving CT.dcm files into CT folder and RS.dcm files into",
-              "RTSTRUCT folder",
-              )
-        move_ct_rtstruct_files(patient_folder_path,
-                               ct_folder_path,
-                               rtstruct_folder_path,
-                               )
-    # Exit to not mix different data.
-    else:
-        exit_if_empty(rtstruct_folder_path)
-        exit_if_empty(ct_folder_path)
-        
-def check_new_folder_path(new_folder_path):
+    Returning the columns of the results of a configuration.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    columns : list
+        Results.RESULTS_COLUMNS followed by the columns of the additional
+        metrics, by Results.SKIPPED_REASON_COLUMN and by
+        Results.FINGERPRINT_COLUMNS.
+    
     """
-    Checking if the user provided new_folder_path as argument.
-    If yes the path wil be concerted to python style.
+    return (Results.RESULTS_COLUMNS
+            + [ADDITIONAL_METRICS[name] for name in additional_metrics(config)]
+            + [Results.SKIPPED_REASON_COLUMN]
+            + Results.FINGERPRINT_COLUMNS
+            )
 
+def crop_to_union(reference_labelmap,
+                  compared_labelmap,
+                  ):
+    """
+    Cropping two labelmaps to the bounding box of their union.
+    
+    The metrics only depend on the voxels in this box, so they do not change,
+    but every following operation runs on a much smaller volume.
+    
     Parameters
     ----------
-    new_folder_path : str
-        Path to the folder where patient folders will be moved after execution.
-
+    reference_labelmap: numpy.ndarray
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray
+        3D binary array of the segment to compare.
+    
     Returns
     -------
-    new_folder_path : str or bool
-        Path to the folder where patient folders will be moved after execution
-        converted into python path style.
-        False if the argument was not provided by the user.
-
+    reference_labelmap: numpy.ndarray
+        Cropped reference labelmap (a view, not a copy).
+    compared_labelmap: numpy.ndarray
+        Cropped compared labelmap (a view, not a copy).
+    
     """
-    if new_folder_path == ".":
-        print("New folder path has not been provided. Patient folders won't",
-              "be moved after execution.",
-              )
-        new_folder_path = False
-    else:
-        # Convert to python path style.
-        new_folder_path = new_folder_path.replace("\\", "/")
+    # Every axis is searched inside the box already found along the previous
+    # axes, so that only the first search scans the whole volumes.
+    box = [slice(None)] * reference_labelmap.ndim
+    for axis in range(reference_labelmap.ndim):
+        other_axes = tuple(other for other in range(reference_labelmap.ndim)
+                           if other != axis
+                           )
+        indices = np.flatnonzero(
+            reference_labelmap[tuple(box)].any(axis=other_axes)
+            | compared_labelmap[tuple(box)].any(axis=other_axes)
+            )
+        if len(indices) == 0:
+            # Empty labelmaps are left as they are.
+            return reference_labelmap, compared_labelmap
+        box[axis] = slice(indices[0], indices[-1] + 1)
+    box = tuple(box)
     
-    return new_folder_path
+    return reference_labelmap[box], compared_labelmap[box]
 
-def read_config(config_path):
+def weighted_percentile(distances,
+                        surfel_areas,
+                        percent,
+                        ):
     """
-    Opening the configuration.json file
-
+    Computing the percentile of distances weighted by the surface element
+    areas, as surface_distance.compute_robust_hausdorff does.
+    
     Parameters
     ----------
-    config_path : str
+    distances : numpy.ndarray
+        Distances of the surface elements.
+    surfel_areas : numpy.ndarray
+        Areas of the surface elements.
+    percent : float
+        Percentile to compute (Ex. 95).
+    
+    Returns
+    -------
+    distance : float
+        Smallest distance such that the surface elements not farther than it
+        have at least percent % of the total area.
+    
+    """
+    order = np.lexsort((surfel_areas, distances))
+    cumulative_areas = np.cumsum(surfel_areas[order]) / np.sum(surfel_areas)
+    index = np.searchsorted(cumulative_areas, percent / 100.0)
+    
+    return distances[order][min(index, len(distances) - 1)]
+
+def surface_area_table(voxel_spacing_mm):
+    """
+    Returning the areas of the surface elements by neighbour code, computed
+    only the first time a voxel spacing is met.
+    
+    Parameters
+    ----------
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    
+    Returns
+    -------
+    surface_areas : numpy.ndarray
+        Area of the surface element of every neighbour code, as in
+        surface_distance.lookup_tables.
+    
+    """
+    import surface_distance as sd
+    
+    key = tuple(float(size) for size in voxel_spacing_mm)
+    PipelineMetrics.count_cache_lookup("surface_area_tables",
+                                       key in SURFACE_AREA_TABLES,
+                                       )
+    if key not in SURFACE_AREA_TABLES:
+        SURFACE_AREA_TABLES[key] = (
+            sd.lookup_tables.create_table_neighbour_code_to_surface_area(key))
+    
+    return SURFACE_AREA_TABLES[key]
+
+def coarse_to_fine_surface_distances(reference_labelmap,
+                                     compared_labelmap,
+                                     voxel_spacing_mm,
+                                     tolerance_mm,
+                                     percent=95,
+                                     factor=2,
+                                     ):
+    """
+    Computing the distances between the surfaces of two labelmaps, exact
+    only where they can change the percent-th Hausdorff distance and the
+    surface Dice at tolerance_mm.
+    
+    Surface elements are found as surface_distance.compute_surface_distances
+    does. The distance transform of the other surface is computed on a
+    downsampled grid, which bounds the distance of every surface element
+    within two block half-diagonals. Surface elements lying on the other
+    surface are at distance 0. Of the others, only those whose bounds overlap
+    the bounds of the percentile or contain the tolerance are refined, with
+    the exact nearest surface element found by a k-d tree; the rest keep
+    their coarse distance, which is on the same side of the percentile and of
+    the tolerance as the exact one. Exact distances are computed as
+    scipy.ndimage.distance_transform_edt does, so that the Hausdorff distance
+    and the surface Dice are the same of the full resolution computation.
+    
+    Parameters
+    ----------
+    reference_labelmap: numpy.ndarray
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray
+        3D binary array of the segment to compare.
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    tolerance_mm : float
+        Tolerance of the surface Dice in millimeters.
+    percent : float, optional
+        Percentile of the Hausdorff distance. Default is 95.
+    factor : int, optional
+        Downsampling factor of the coarse grid along the axes with the
+        smallest spacing. Axes with a greater spacing are downsampled less,
+        so that blocks are about as long along every axis. Default is 2.
+    
+    Returns
+    -------
+    surface_distances : dict
+        Sorted distances and surface elements areas, with the same keys of
+        surface_distance.compute_surface_distances.
+    
+    """
+    import surface_distance as sd
+    from scipy import ndimage
+    from scipy.spatial import cKDTree
+    
+    spacing = np.asarray(voxel_spacing_mm,
+                         dtype=np.float64,
+                         )
+    reference_labelmap, compared_labelmap = crop_to_union(reference_labelmap,
+                                                          compared_labelmap,
+                                                          )
+    
+    # Surface elements, located at the corners of the voxels. As in
+    # surface_distance, labelmaps are padded with a voxel after their end, so
+    # that the surface at the end of the box is found.
+    surface_areas = surface_area_table(voxel_spacing_mm)
+    surfaces = []
+    for labelmap in (reference_labelmap, compared_labelmap):
+        neighbour_codes = ndimage.correlate(
+            np.pad(labelmap.astype(np.uint8), ((0, 1),) * 3),
+            sd.lookup_tables.ENCODE_NEIGHBOURHOOD_3D_KERNEL,
+            mode="constant",
+            cval=0,
+            )
+        borders = (neighbour_codes != 0) & (neighbour_codes != 0b11111111)
+        surfaces.append({"borders": borders,
+                         "points": np.argwhere(borders),
+                         "areas": surface_areas[neighbour_codes[borders]],
+                         })
+    
+    # Empty surfaces have no distances to bound.
+    if not (len(surfaces[0]["points"]) and len(surfaces[1]["points"])):
+        return sd.compute_surface_distances(reference_labelmap,
+                                            compared_labelmap,
+                                            voxel_spacing_mm,
+                                            )
+    
+    # Downsampling factors along every axis and greatest distance between a
+    # voxel and the center of its block.
+    factors = np.maximum(np.round(factor * spacing.min() / spacing), 1)
+    factors = factors.astype(int)
+    half_diagonal = np.sqrt(np.sum(((factors - 1) / 2 * spacing) ** 2))
+    
+    directed = []
+    for source, target in ((surfaces[0], surfaces[1]),
+                           (surfaces[1], surfaces[0]),
+                           ):
+        # Coarse distance transform of the target surface.
+        shape = -(-np.array(target["borders"].shape) // factors) * factors
+        padded = np.zeros(shape,
+                          dtype=bool,
+                          )
+        padded[tuple(slice(0, size) for size in target["borders"].shape)] = (
+            target["borders"])
+        coarse_borders = padded.reshape(shape[0] // factors[0], factors[0],
+                                        shape[1] // factors[1], factors[1],
+                                        shape[2] // factors[2], factors[2],
+                                        ).any(axis=(1, 3, 5))
+        coarse_distances = ndimage.distance_transform_edt(
+            ~coarse_borders,
+            sampling=spacing * factors,
+            )
+        distances = coarse_distances[tuple((source["points"] // factors).T)]
+        on_target = target["borders"][tuple(source["points"].T)]
+        distances[on_target] = 0
+        
+        # Bounds of the exact distances and of their percentile, with a
+        # margin for rounding errors.
+        margin = 2 * half_diagonal + 1e-6 * (1 + distances)
+        margin[on_target] = 0
+        lower = distances - margin
+        upper = distances + margin
+        lower_percentile = weighted_percentile(lower,
+                                               source["areas"],
+                                               percent,
+                                               )
+        upper_percentile = weighted_percentile(upper,
+                                               source["areas"],
+                                               percent,
+                                               )
+        refine = ((((upper >= lower_percentile) & (lower <= upper_percentile))
+                   | ((lower <= tolerance_mm) & (upper > tolerance_mm)))
+                  & ~on_target
+                  )
+        
+        # Exact distances to the nearest surface element of the target.
+        tree = cKDTree(target["points"] * spacing)
+        _, nearest = tree.query(source["points"][refine] * spacing)
+        delta = (target["points"][nearest] - source["points"][refine]).T
+        delta = delta.astype(np.float64) * spacing[:, np.newaxis]
+        distances[refine] = np.sqrt(np.add.reduce(delta * delta,
+                                                  axis=0,
+                                                  ),
+                                    )
+        
+        # Sorting as surface_distance does, by distance and area.
+        order = np.lexsort((source["areas"], distances))
+        directed.append((distances[order], source["areas"][order]))
+    
+    surface_distances = {"distances_gt_to_pred": directed[0][0],
+                         "distances_pred_to_gt": directed[1][0],
+                         "surfel_areas_gt": directed[0][1],
+                         "surfel_areas_pred": directed[1][1],
+                         }
+    
+    return surface_distances
+
+def neighbour_codes(labelmap):
+    """
+    Computing the neighbour code of every corner of the voxels of a
+    labelmap, as surface_distance.compute_surface_distances does with
+    scipy.ndimage.correlate.
+    
+    Parameters
+    ----------
+    labelmap : numpy.ndarray
+        3D binary array of the segment.
+    
+    Returns
+    -------
+    neighbour_codes : numpy.ndarray
+        Code (see surface_distance.lookup_tables) of the 2x2x2 voxels around
+        every corner, one more along every axis than the labelmap.
+    
+    """
+    # Corners before the first and after the last voxel see the background.
+    padded = np.pad(labelmap.astype(np.uint8),
+                    1,
+                    )
+    shape = tuple(size - 1 for size in padded.shape)
+    codes = np.zeros(shape,
+                     dtype=np.uint8,
+                     )
+    for bit, (i, j, k) in enumerate(np.ndindex(2, 2, 2)):
+        codes |= padded[i:i + shape[0],
+                        j:j + shape[1],
+                        k:k + shape[2],
+                        ] << (7 - bit)
+    
+    return codes
+
+def surface_elements(labelmap,
+                     voxel_spacing_mm,
+                     backend="numpy",
+                     ):
+    """
+    Finding the surface elements of a labelmap and their areas.
+    
+    Parameters
+    ----------
+    labelmap : numpy.ndarray
+        3D binary array of the segment.
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    backend : str, optional
+        "numpy" (default) or "numba", which finds them in a single compiled
+        pass without creating the neighbour codes array.
+    
+    Returns
+    -------
+    points : numpy.ndarray
+        Corner of every surface element, one row per element with its
+        indexes along the three axes.
+    areas : numpy.ndarray
+        Area of every surface element in square millimeters.
+    
+    """
+    surface_areas = surface_area_table(voxel_spacing_mm)
+    if backend == "numba":
+        return numba_kernels()["surface_elements"](
+            np.pad(labelmap.astype(np.uint8), 1),
+            surface_areas,
+            )
+    
+    codes = neighbour_codes(labelmap)
+    borders = (codes != 0) & (codes != 0b11111111)
+    
+    return np.argwhere(borders), surface_areas[codes[borders]]
+
+def nearest_surface_distances(source_points,
+                              target_points,
+                              voxel_spacing_mm,
+                              backend="numpy",
+                              ):
+    """
+    Computing the distance from every surface element of a surface to the
+    nearest surface element of another one.
+    
+    Distances are exact and computed as scipy.ndimage.distance_transform_edt
+    does, from the differences of the indexes times the voxel spacing.
+    
+    Parameters
+    ----------
+    source_points : numpy.ndarray
+        Surface elements whose distances are computed (see
+        surface_elements).
+    target_points : numpy.ndarray
+        Surface elements of the other surface.
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    backend : str, optional
+        "numpy" (default), which finds the nearest elements with a k-d tree,
+        or "numba", which searches them in cubic cells around every source
+        element, starting from the nearest element of the previous source
+        element and stopping at the first ring of cells farther than the
+        nearest element found. Source elements lying on the target surface
+        are at distance 0 without searching.
+    
+    Returns
+    -------
+    distances : numpy.ndarray
+        Distance in millimeters of every source element, infinite if the
+        target surface is empty.
+    
+    """
+    from scipy.spatial import cKDTree
+    
+    spacing = np.asarray(voxel_spacing_mm,
+                         dtype=np.float64,
+                         )
+    if not len(target_points):
+        return np.full(len(source_points),
+                       np.inf,
+                       )
+    if not len(source_points):
+        return np.zeros(0)
+    
+    if backend == "numba":
+        return numba_kernels()["nearest_distances"](
+            np.ascontiguousarray(source_points, dtype=np.int64),
+            np.ascontiguousarray(target_points, dtype=np.int64),
+            spacing,
+            NUMBA_CELL_SIZE * spacing.max(),
+            )
+    
+    # Source elements lying on the target surface are at distance 0.
+    on_target = np.zeros(np.maximum(source_points.max(axis=0),
+                                    target_points.max(axis=0),
+                                    ) + 1,
+                         dtype=bool,
+                         )
+    on_target[tuple(target_points.T)] = True
+    on_target = on_target[tuple(source_points.T)]
+    distances = np.zeros(len(source_points))
+    
+    tree = cKDTree(target_points * spacing)
+    _, nearest = tree.query(source_points[~on_target] * spacing)
+    delta = (target_points[nearest] - source_points[~on_target]).T
+    delta = delta.astype(np.float64) * spacing[:, np.newaxis]
+    distances[~on_target] = np.sqrt(np.add.reduce(delta * delta,
+                                                  axis=0,
+                                                  ))
+    
+    return distances
+
+def surface_distances(reference_labelmap,
+                      compared_labelmap,
+                      voxel_spacing_mm,
+                      backend="numpy",
+                      ):
+    """
+    Computing the distances between the surfaces of two labelmaps with one
+    of the DISTANCE_BACKENDS.
+    
+    "numpy" and "numba" give the same distances of
+    surface_distance.compute_surface_distances, except for floating point
+    rounding, without computing a distance transform of the whole box.
+    
+    Parameters
+    ----------
+    reference_labelmap: numpy.ndarray
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray
+        3D binary array of the segment to compare.
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    backend : str, optional
+        Backend computing the distances. Default is "numpy".
+    
+    Returns
+    -------
+    surface_distances : dict
+        Sorted distances and surface elements areas, with the same keys of
+        surface_distance.compute_surface_distances.
+    
+    """
+    import surface_distance as sd
+    
+    if backend == "surface-distance":
+        return sd.compute_surface_distances(reference_labelmap,
+                                            compared_labelmap,
+                                            voxel_spacing_mm,
+                                            )
+    
+    reference_labelmap, compared_labelmap = crop_to_union(reference_labelmap,
+                                                          compared_labelmap,
+                                                          )
+    surfaces = [surface_elements(labelmap,
+                                 voxel_spacing_mm,
+                                 backend,
+                                 )
+                for labelmap in (reference_labelmap, compared_labelmap)
+                ]
+    
+    directed = []
+    for (points, areas), (target_points, _) in ((surfaces[0], surfaces[1]),
+                                                (surfaces[1], surfaces[0]),
+                                                ):
+        distances = nearest_surface_distances(points,
+                                              target_points,
+                                              voxel_spacing_mm,
+                                              backend,
+                                              )
+        
+        # Sorting as surface_distance does, by distance and area.
+        order = np.lexsort((areas, distances))
+        directed.append((distances[order], areas[order]))
+    
+    surface_distances = {"distances_gt_to_pred": directed[0][0],
+                         "distances_pred_to_gt": directed[1][0],
+                         "surfel_areas_gt": directed[0][1],
+                         "surfel_areas_pred": directed[1][1],
+                         }
+    
+    return surface_distances
+
+def tolerance_offsets(voxel_spacing_mm,
+                      tolerance_mm,
+                      ):
+    """
+    Creating the anisotropic structuring element of the voxels within a
+    tolerance.
+    
+    Lengths are computed as surface distances are, so that an offset is in
+    the element exactly when a surface element at that offset is within the
+    tolerance for surface_distance.compute_surface_dice_at_tolerance.
+    
+    Parameters
+    ----------
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    tolerance_mm : float
+        Tolerance in millimeters.
+    
+    Returns
+    -------
+    offsets : numpy.ndarray
+        Index offsets not longer than the tolerance, one row per offset,
+        sorted from the shortest (the null offset) to the longest.
+    
+    """
+    spacing = np.asarray(voxel_spacing_mm,
+                         dtype=np.float64,
+                         )
+    radii = np.floor(tolerance_mm / spacing).astype(int)
+    offsets = np.indices(2 * radii + 1).reshape(3, -1).T - radii
+    delta = offsets.T.astype(np.float64) * spacing[:, np.newaxis]
+    lengths = np.sqrt(np.add.reduce(delta * delta,
+                                    axis=0,
+                                    ))
+    order = np.argsort(lengths,
+                       kind="stable",
+                       )
+    
+    return offsets[order][lengths[order] <= tolerance_mm]
+
+def banded_surface_dice(reference_labelmap,
+                        compared_labelmap,
+                        voxel_spacing_mm,
+                        tolerance_mm,
+                        ):
+    """
+    Computing the surface Dice similarity coefficient without computing the
+    surface distances.
+    
+    The surface of every segment is dilated by the tolerance with the
+    structuring element of tolerance_offsets, evaluating the dilation only
+    at the surface elements of the other segment: the area of the surface
+    elements inside the band is the same that
+    surface_distance.compute_surface_dice_at_tolerance counts, so the
+    coefficient only differs by floating point rounding.
+    
+    Parameters
+    ----------
+    reference_labelmap: numpy.ndarray
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray
+        3D binary array of the segment to compare.
+    voxel_spacing_mm : list
+        Voxel dimensions in millimeters.
+    tolerance_mm : float
+        Tolerance of the surface Dice in millimeters.
+    
+    Returns
+    -------
+    surface_dice : float
+        Value of the surface Dice similarity coefficient, NaN if both
+        segments are empty.
+    
+    """
+    offsets = tolerance_offsets(voxel_spacing_mm,
+                                tolerance_mm,
+                                )
+    radii = np.abs(offsets).max(axis=0)
+    reference_labelmap, compared_labelmap = crop_to_union(reference_labelmap,
+                                                          compared_labelmap,
+                                                          )
+    surface_areas = surface_area_table(voxel_spacing_mm)
+    surfaces = []
+    for labelmap in (reference_labelmap, compared_labelmap):
+        codes = neighbour_codes(labelmap)
+        borders = (codes != 0) & (codes != 0b11111111)
+        surfaces.append({"borders": borders,
+                         "points": np.argwhere(borders),
+                         "areas": surface_areas[codes[borders]],
+                         })
+    
+    overlap = 0.0
+    for source, target in ((surfaces[0], surfaces[1]),
+                           (surfaces[1], surfaces[0]),
+                           ):
+        # The target surface is padded by the tolerance, so that every
+        # offset of a surface element is inside it.
+        padded = np.pad(target["borders"],
+                        [(radius, radius) for radius in radii],
+                        )
+        strides = np.array(padded.strides) // padded.itemsize
+        positions = (source["points"] + radii) @ strides
+        padded = padded.ravel()
+        
+        # Shorter offsets come first, surface elements already inside the
+        # band are not looked up again.
+        outside = np.arange(len(positions))
+        for offset in offsets @ strides:
+            outside = outside[~padded[positions[outside] + offset]]
+            if not len(outside):
+                break
+        inside = np.ones(len(positions),
+                         dtype=bool,
+                         )
+        inside[outside] = False
+        overlap += np.sum(source["areas"][inside])
+    
+    return ratio(overlap,
+                 np.sum(surfaces[0]["areas"]) + np.sum(surfaces[1]["areas"]),
+                 )
+
+def numba_kernels():
+    """
+    Returning the Numba kernels of the "numba" distance backend, compiled
+    the first time they are needed and cached on disk.
+    
+    Returns
+    -------
+    kernels : dict
+        Compiled functions by name ("surface_elements",
+        "nearest_distances").
+    
+    """
+    if NUMBA_KERNELS:
+        return NUMBA_KERNELS
+    
+    import numba
+    
+    @numba.njit(cache=True)
+    def surface_elements_kernel(padded,
+                                surface_areas,
+                                ):
+        # Neighbour code of a corner, as neighbour_codes computes it.
+        def code(i, j, k):
+            return (128 * padded[i, j, k] + 64 * padded[i, j, k + 1]
+                    + 32 * padded[i, j + 1, k] + 16 * padded[i, j + 1, k + 1]
+                    + 8 * padded[i + 1, j, k] + 4 * padded[i + 1, j, k + 1]
+                    + 2 * padded[i + 1, j + 1, k]
+                    + padded[i + 1, j + 1, k + 1]
+                    )
+        
+        # Surface elements are counted first, then saved.
+        n0, n1, n2 = (padded.shape[0] - 1,
+                      padded.shape[1] - 1,
+                      padded.shape[2] - 1,
+                      )
+        count = 0
+        for i in range(n0):
+            for j in range(n1):
+                for k in range(n2):
+                    value = code(i, j, k)
+                    if value != 0 and value != 255:
+                        count += 1
+        points = np.empty((count, 3),
+                          dtype=np.int64,
+                          )
+        areas = np.empty(count)
+        count = 0
+        for i in range(n0):
+            for j in range(n1):
+                for k in range(n2):
+                    value = code(i, j, k)
+                    if value != 0 and value != 255:
+                        points[count, 0] = i
+                        points[count, 1] = j
+                        points[count, 2] = k
+                        areas[count] = surface_areas[value]
+                        count += 1
+        
+        return points, areas
+    
+    @numba.njit(cache=True)
+    def nearest_distances_kernel(source_points,
+                                 target_points,
+                                 spacing,
+                                 cell_size,
+                                 ):
+        # Target elements are grouped by cubic cell, cells are indexed from
+        # the smallest target coordinates.
+        lows = np.empty(3,
+                        dtype=np.int64,
+                        )
+        shape = np.empty(3,
+                         dtype=np.int64,
+                         )
+        for axis in range(3):
+            lows[axis] = target_points[:, axis].min()
+            shape[axis] = int((target_points[:, axis].max() - lows[axis])
+                              * spacing[axis] / cell_size) + 1
+        cells = np.empty(len(target_points),
+                         dtype=np.int64,
+                         )
+        for point in range(len(target_points)):
+            cell = 0
+            for axis in range(3):
+                cell = cell * shape[axis] + int(
+                    (target_points[point, axis] - lows[axis])
+                    * spacing[axis] / cell_size)
+            cells[point] = cell
+        order = np.argsort(cells)
+        sorted_points = target_points[order]
+        starts = np.zeros(shape[0] * shape[1] * shape[2] + 1,
+                          dtype=np.int64,
+                          )
+        for point in range(len(cells)):
+            starts[cells[point] + 1] += 1
+        starts = np.cumsum(starts)
+        
+        # Corners of the target surface.
+        occupied = np.zeros((max(source_points[:, 0].max(),
+                                 target_points[:, 0].max(),
+                                 ) + 1,
+                             max(source_points[:, 1].max(),
+                                 target_points[:, 1].max(),
+                                 ) + 1,
+                             max(source_points[:, 2].max(),
+                                 target_points[:, 2].max(),
+                                 ) + 1,
+                             ),
+                            dtype=np.bool_,
+                            )
+        for point in range(len(target_points)):
+            occupied[target_points[point, 0],
+                     target_points[point, 1],
+                     target_points[point, 2],
+                     ] = True
+        
+        # Distance along an axis between a position and a cell.
+        def gap(position, cell):
+            return max(0.0,
+                       cell * cell_size - position,
+                       position - (cell + 1) * cell_size,
+                       )
+        
+        distances = np.zeros(len(source_points))
+        center = np.empty(3,
+                          dtype=np.int64,
+                          )
+        position = np.empty(3)
+        previous = -1
+        for source in range(len(source_points)):
+            if occupied[source_points[source, 0],
+                        source_points[source, 1],
+                        source_points[source, 2],
+                        ]:
+                continue
+            
+            # Greatest ring of cells around the source element that can
+            # contain target elements.
+            max_ring = 0
+            for axis in range(3):
+                center[axis] = int(np.floor(
+                    (source_points[source, axis] - lows[axis])
+                    * spacing[axis] / cell_size))
+                max_ring = max(max_ring,
+                               center[axis],
+                               shape[axis] - 1 - center[axis],
+                               )
+            
+            # Consecutive source elements are close, so the nearest element
+            # of the previous one bounds the distance from the start.
+            nearest = np.inf
+            if previous >= 0:
+                nearest = 0.0
+                for axis in range(3):
+                    delta = float(sorted_points[previous, axis]
+                                  - source_points[source, axis]
+                                  ) * spacing[axis]
+                    nearest += delta * delta
+            for axis in range(3):
+                position[axis] = ((source_points[source, axis] - lows[axis])
+                                  * spacing[axis]
+                                  )
+            
+            # Elements of a ring are farther than ring - 1 cells, so the
+            # search ends when the nearest element found is closer. Cells
+            # farther than the nearest element found are not visited.
+            ring = 0
+            while ring <= max_ring:
+                for i in range(max(center[0] - ring, 0),
+                               min(center[0] + ring, shape[0] - 1) + 1,
+                               ):
+                    gap_i = gap(position[0], i) ** 2
+                    if gap_i * (1 - 1e-9) >= nearest:
+                        continue
+                    for j in range(max(center[1] - ring, 0),
+                                   min(center[1] + ring, shape[1] - 1) + 1,
+                                   ):
+                        gap_ij = gap_i + gap(position[1], j) ** 2
+                        if gap_ij * (1 - 1e-9) >= nearest:
+                            continue
+                        
+                        # Inside the ring only its two faces along the last
+                        # axis are visited.
+                        if (abs(i - center[0]) == ring
+                                or abs(j - center[1]) == ring):
+                            step = 1
+                        else:
+                            step = 2 * ring
+                        for k in range(center[2] - ring,
+                                       center[2] + ring + 1,
+                                       step,
+                                       ):
+                            if (k < 0 or k >= shape[2]
+                                    or (gap_ij + gap(position[2], k) ** 2)
+                                    * (1 - 1e-9) >= nearest):
+                                continue
+                            cell = (i * shape[1] + j) * shape[2] + k
+                            for point in range(starts[cell],
+                                               starts[cell + 1],
+                                               ):
+                                squared = 0.0
+                                for axis in range(3):
+                                    delta = float(sorted_points[point, axis]
+                                                  - source_points[source,
+                                                                  axis]
+                                                  ) * spacing[axis]
+                                    squared += delta * delta
+                                if squared < nearest:
+                                    nearest = squared
+                                    previous = point
+                if nearest < (ring * cell_size) ** 2 * (1 - 1e-9):
+                    break
+                ring += 1
+            distances[source] = np.sqrt(nearest)
+        
+        return distances
+    
+    NUMBA_KERNELS["surface_elements"] = surface_elements_kernel
+    NUMBA_KERNELS["nearest_distances"] = nearest_distances_kernel
+    
+    return NUMBA_KERNELS
+
+def resampling_spacing(config):
+    """
+    Returning the voxel spacing of the common grid where labelmaps are
+    resampled.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    spacing : list or None
+        Spacing in millimeters along rows, columns and slices (Ex. [1.0, 1.0,
+        1.0]), None if the configuration file does not have a "Resampling
+        spacing (mm)" (default) and labelmaps are created on the CT grid.
+    
+    """
+    spacing = config.get("Resampling spacing (mm)")
+    if spacing is None:
+        return None
+    
+    return [float(value) for value in spacing]
+
+def use_coarse_to_fine(config):
+    """
+    Returning whether surface distances are computed coarse to fine.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    coarse_to_fine : bool
+        Value of "Coarse to fine distances" in the configuration file, False
+        if it is missing (default).
+    
+    """
+    return bool(config.get("Coarse to fine distances", False))
+
+def use_hausdorff_distance(config):
+    """
+    Returning whether the Hausdorff distance is computed.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    hausdorff : bool
+        Value of "Compute Hausdorff distance" in the configuration file, True
+        if it is missing (default).
+    
+    """
+    return bool(config.get("Compute Hausdorff distance", True))
+
+def distance_backend(config):
+    """
+    Returning the backend computing the surface distances at full
+    resolution.
+    
+    If "numba" is chosen but Numba is not installed, the "numpy" backend is
+    used instead.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    backend : str
+        Value of "Distance backend" in the configuration file, one of
+        DISTANCE_BACKENDS, "surface-distance" if it is missing (default).
+    
+    """
+    backend = config.get("Distance backend", DISTANCE_BACKENDS[0])
+    if backend not in DISTANCE_BACKENDS:
+        sys.exit(f"Unknown Distance backend {backend!r}, valid backends "
+                 f"are: {', '.join(DISTANCE_BACKENDS)}"
+                 )
+    if backend == "numba":
+        try:
+            import numba
+        except ImportError:
+            print("Numba is not installed, the numpy distance backend is",
+                  "used",
+                  )
+            backend = "numpy"
+    
+    return backend
+
+def metric_workers(config):
+    """
+    Returning the number of processes computing the metrics of a patient.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    n_workers : int
+        Value of "Metric workers" in the configuration file, 1 if it is
+        missing (default) and the metrics are computed in the main process.
+    
+    """
+    n_workers = config.get("Metric workers", 1)
+    if not isinstance(n_workers, int) or n_workers < 1:
+        sys.exit(f"Invalid Metric workers {n_workers!r}, a positive integer "
+                 "is expected"
+                 )
+    
+    return n_workers
+
+def create_mask_store():
+    """
+    Creating an empty store of labelmaps in shared memory.
+    
+    Returns
+    -------
+    store : dict
+        Shared memory blocks ("blocks") and handles ("handles") by segment
+        name.
+    
+    """
+    store = {"blocks": {},
+             "handles": {},
+             }
+    
+    return store
+
+def store_mask(store,
+               segment_name,
+               labelmap,
+               ):
+    """
+    Copying a labelmap in shared memory, only the first time the segment is
+    stored.
+    
+    Parameters
+    ----------
+    store : dict
+        Store created by create_mask_store.
+    segment_name : str
+        Name of the segment.
+    labelmap : numpy.ndarray
+        3D binary array of the segment.
+    
+    Returns
+    -------
+    handle : dict
+        Name of the shared memory block ("name"), shape ("shape") and data
+        type ("dtype") of the labelmap, which is all a process needs to
+        attach it (see attach_mask).
+    
+    """
+    from multiprocessing import shared_memory
+    
+    if segment_name not in store["handles"]:
+        labelmap = np.ascontiguousarray(labelmap)
+        
+        # Blocks of zero bytes can not be created.
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(labelmap.nbytes, 1),
+                                           )
+        store["blocks"][segment_name] = block
+        np.ndarray(labelmap.shape,
+                   dtype=labelmap.dtype,
+                   buffer=block.buf,
+                   )[...] = labelmap
+        store["handles"][segment_name] = {"name": block.name,
+                                          "shape": labelmap.shape,
+                                          "dtype": labelmap.dtype.str,
+                                          }
+    
+    return store["handles"][segment_name]
+
+def attach_mask(handle):
+    """
+    Attaching a labelmap stored in shared memory, without copying it.
+    
+    Parameters
+    ----------
+    handle : dict
+        Handle returned by store_mask.
+    
+    Returns
+    -------
+    block : multiprocessing.shared_memory.SharedMemory
+        Shared memory block, to close once the labelmap is no longer used.
+    labelmap : numpy.ndarray
+        3D binary array of the segment, a view of the block.
+    
+    """
+    from multiprocessing import shared_memory
+    
+    block = shared_memory.SharedMemory(name=handle["name"])
+    labelmap = np.ndarray(handle["shape"],
+                          dtype=np.dtype(handle["dtype"]),
+                          buffer=block.buf,
+                          )
+    
+    return block, labelmap
+
+def release_masks(store,
+                  segment_names,
+                  ):
+    """
+    Removing labelmaps from the store and freeing their shared memory.
+    
+    Parameters
+    ----------
+    store : dict
+        Store created by create_mask_store.
+    segment_names : list
+        Names of the segments to remove, those not stored are ignored.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    for segment_name in segment_names:
+        store["handles"].pop(segment_name, None)
+        block = store["blocks"].pop(segment_name, None)
+        if block is not None:
+            block.close()
+            block.unlink()
+
+def close_mask_store(store):
+    """
+    Freeing the shared memory of all the labelmaps of the store.
+    
+    Parameters
+    ----------
+    store : dict
+        Store created by create_mask_store.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    release_masks(store,
+                  list(store["blocks"]),
+                  )
+
+@contextmanager
+def mask_store():
+    """
+    Creating a store of labelmaps in shared memory, whose memory is freed
+    when the block ends, also on errors.
+    
+    Yields
+    ------
+    store : dict
+        Store created by create_mask_store.
+    
+    """
+    store = create_mask_store()
+    try:
+        yield store
+    finally:
+        close_mask_store(store)
+
+def import_metrics_library():
+    """
+    Importing surface_distance when a worker process starts, while the
+    labelmaps of the first structure are created.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    import surface_distance
+
+def create_metric_executor(config):
+    """
+    Creating the pool of processes computing the metrics, shared by all the
+    patients of a run so that its processes are started only once.
+    
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    executor : concurrent.futures.ProcessPoolExecutor or None
+        Pool of metric_workers(config) processes, to be shut down at the end
+        of the run. None if the metrics are computed in the main process.
+    
+    """
+    n_workers = metric_workers(config)
+    if n_workers == 1:
+        return None
+    
+    return ProcessPoolExecutor(max_workers=n_workers,
+                               initializer=import_metrics_library,
+                               )
+
+def compute_stored_metrics(reference_handle,
+                           compared_handle,
+                           voxel_spacing_mm,
+                           coarse_to_fine=False,
+                           metrics=(),
+                           backend="surface-distance",
+                           hausdorff=True,
+                           ):
+    """
+    Computing the metrics of two labelmaps stored in shared memory, in a
+    worker process.
+    
+    Parameters
+    ----------
+    reference_handle : dict
+        Handle of the reference labelmap (see store_mask).
+    compared_handle : dict
+        Handle of the labelmap to compare.
+    voxel_spacing_mm : list
+        Voxel spacing of the labelmaps in millimeters.
+    coarse_to_fine : bool, optional
+        Passed to compute_metrics. Default is False.
+    metrics : list, optional
+        Names of the additional metrics to compute. Default is none.
+    backend : str, optional
+        Passed to compute_metrics. Default is "surface-distance".
+    hausdorff : bool, optional
+        Passed to compute_metrics. Default is True.
+    
+    Returns
+    -------
+    surface_dice : float
+        Value of the surface Dice similarity coefficient.
+    volume_dice : float
+        Value of the Dice similarity coefficient.
+    hausdorff_distance : float
+        Value of the Hausdorff distance.
+    values : dict
+        Values of the additional metrics by name.
+    
+    """
+    values = dict.fromkeys(metrics,
+                           np.nan,
+                           )
+    blocks = []
+    try:
+        labelmaps = []
+        for handle in (reference_handle, compared_handle):
+            block, labelmap = attach_mask(handle)
+            blocks.append(block)
+            labelmaps.append(labelmap)
+        sdsc, dsc, hd = compute_metrics(labelmaps[0],
+                                        labelmaps[1],
+                                        None,
+                                        voxel_spacing_mm=voxel_spacing_mm,
+                                        coarse_to_fine=coarse_to_fine,
+                                        additional_metrics=values,
+                                        backend=backend,
+                                        hausdorff=hausdorff,
+                                        )
+    finally:
+        # Views must be released before closing their blocks. Views still
+        # referenced by an error traceback keep the block mapped until they
+        # are garbage collected, the parent process frees it anyway.
+        labelmaps = None
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                pass
+    
+    return sdsc, dsc, hd, values
+
+def collect_stored_metrics(rows,
+                           submitted,
+                           metrics,
+                           ):
+    """
+    Waiting for the metrics computed by compute_stored_metrics and setting
+    them in their rows.
+    
+    Parameters
+    ----------
+    rows : list
+        Rows of the patient, with NaN metrics where they are computed by the
+        workers.
+    submitted : list
+        Index of the row and concurrent.futures.Future of every comparison
+        computed by the workers.
+    metrics : list
+        Names of the additional metrics.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    for index, future in submitted:
+        sdsc, dsc, hd, values = future.result()
+        rows[index][6:9 + len(metrics)] = [hd,
+                                           dsc,
+                                           sdsc,
+                                           ] + [values[name] for name in metrics]
+
+def cancel_stored_metrics(submitted):
+    """
+    Cancelling the comparisons of a patient not yet started by the workers
+    and waiting for the running ones, so that the shared memory of their
+    labelmaps can be freed while the pool keeps serving the next patients.
+    
+    Parameters
+    ----------
+    submitted : list
+        Index of the row and concurrent.futures.Future of every comparison
+        computed by the workers.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    futures = [future for index, future in submitted]
+    for future in futures:
+        future.cancel()
+    wait(futures)
+
+def series_geometry(slices):
+    """
+    Computing the axes of the CT series in patient coordinates.
+    
+    Parameters
+    ----------
+    slices : list
+        Ordered list of the slices that compose the CT volume.
+    
+    Returns
+    -------
+    geometry : dict
+        Position of the first voxel ("origin"), unit vectors of the rows,
+        columns and slices axes of the labelmaps ("axes", one per row) and
+        positions in millimeters of the slices along the slices axis
+        ("slice_positions").
+    
+    """
+    orientation = np.array(slices[0].ImageOrientationPatient,
+                           dtype=float,
+                           )
+    # Rows are along the column direction and columns along the row
+    # direction, as in the labelmaps of rt_utils.
+    column_direction = orientation[3:]
+    row_direction = orientation[:3]
+    axes = np.array([column_direction,
+                     row_direction,
+                     np.cross(row_direction, column_direction),
+                     ])
+    origin = np.array(slices[0].ImagePositionPatient,
+                      dtype=float,
+                      )
+    slice_positions = np.array([
+        np.dot(np.array(ct_slice.ImagePositionPatient, dtype=float) - origin,
+               axes[2],
+               )
+        for ct_slice in slices
+        ])
+    geometry = {"origin": origin,
+                "axes": axes,
+                "slice_positions": slice_positions,
+                }
+    
+    return geometry
+
+def roi_contours(rtstruct_dataset,
+                 segment_name,
+                 geometry,
+                 ):
+    """
+    Reading the contours of a segment in the coordinates of the labelmaps.
+    
+    Parameters
+    ----------
+    rtstruct_dataset : pydicom.dataset.FileDataset
+        RTSTRUCT dataset (Ex. patient_data.ds).
+    segment_name : str
+        Name of the segment (Ex. "Prostate").
+    geometry : dict
+        Geometry of the CT series (see series_geometry).
+    
+    Returns
+    -------
+    contours : list
+        Arrays of the contour points, one row per point with its positions in
+        millimeters along rows, columns and slices from the first voxel.
+    
+    """
+    roi_numbers = [roi.ROINumber
+                   for roi in rtstruct_dataset.StructureSetROISequence
+                   if roi.ROIName == segment_name
+                   ]
+    if not roi_numbers:
+        sys.exit(f"There is no {segment_name} in the RTSTRUCT file provided.")
+    
+    contours = []
+    for roi_contour in rtstruct_dataset.ROIContourSequence:
+        if roi_contour.ReferencedROINumber != roi_numbers[0]:
+            continue
+        for contour in roi_contour.get("ContourSequence", []):
+            points = contour_points(contour)
+            contours.append((points - geometry["origin"]) @ geometry["axes"].T)
+    
+    return contours
+
+def resampling_box(contours,
+                   spacing,
+                   margin=2,
+                   ):
+    """
+    Computing the box of the common grid containing some contours.
+    
+    Parameters
+    ----------
+    contours : list
+        Contours in the coordinates of the labelmaps (see roi_contours).
+    spacing : list
+        Spacing in millimeters of the common grid.
+    margin : int, optional
+        Number of voxels added on every side, so that surfaces are not cut.
+        Default is 2.
+    
+    Returns
+    -------
+    box : dict
+        Index of the first voxel of the box in the common grid ("start") and
+        shape of the box ("shape").
+    
+    """
+    if not contours:
+        return {"start": np.zeros(3, dtype=int),
+                "shape": np.ones(3, dtype=int),
+                }
+    
+    points = np.concatenate(contours) / np.array(spacing)
+    start = np.floor(points.min(axis=0)).astype(int) - margin
+    stop = np.ceil(points.max(axis=0)).astype(int) + margin + 1
+    box = {"start": start,
+           "shape": stop - start,
+           }
+    
+    return box
+
+def resampled_labelmap(contours,
+                       slice_positions,
+                       spacing,
+                       box,
+                       ):
+    """
+    Creating the binary labelmap of a segment on a box of the common grid.
+    
+    Contours are rasterized directly at the in-plane resolution of the
+    common grid. Slices of the common grid between two contoured CT slices
+    are obtained by shape-based interpolation, that is by interpolating the
+    signed distance maps of the two slices; near the first and last
+    contoured slices the nearest CT slice is used.
+    
+    Parameters
+    ----------
+    contours : list
+        Contours of the segment in the coordinates of the labelmaps (see
+        roi_contours).
+    slice_positions : numpy.ndarray
+        Positions in millimeters of the CT slices along the slices axis.
+    spacing : list
+        Spacing in millimeters of the common grid.
+    box : dict
+        Box of the common grid (see resampling_box).
+    
+    Returns
+    -------
+    labelmap : numpy.ndarray
+        3D binary array of the segment in the box (0 out of the segment,
+        1 inside).
+    
+    """
+    import cv2
+    from scipy.ndimage import distance_transform_edt
+    
+    # Contours are grouped by their CT slice, sorted along the slices axis.
+    order = np.argsort(slice_positions)
+    positions = slice_positions[order]
+    polygons = {}
+    for points in contours:
+        position = np.abs(positions - points[:, 2].mean()).argmin()
+        pixels = points[:, :2] / np.array(spacing[:2]) - box["start"][:2]
+        # Points are given to OpenCV as (column, row).
+        polygons.setdefault(position, []).append(
+            np.around(pixels[:, ::-1]).astype(np.int32),
+            )
+    
+    # Slices are rasterized and their distance maps computed only when
+    # needed.
+    plane_masks = {}
+    distance_maps = {}
+    
+    def plane_mask(position):
+        if position not in plane_masks:
+            mask = np.zeros(box["shape"][:2],
+                            dtype=np.uint8,
+                            )
+            if position in polygons:
+                cv2.fillPoly(mask,
+                             polygons[position],
+                             1,
+                             )
+            plane_masks[position] = mask.astype(bool)
+        return plane_masks[position]
+    
+    def distance_map(position):
+        if position not in distance_maps:
+            mask = plane_mask(position)
+            distance_maps[position] = (
+                distance_transform_edt(mask, sampling=spacing[:2])
+                - distance_transform_edt(~mask, sampling=spacing[:2])
+                )
+        return distance_maps[position]
+    
+    labelmap = np.zeros(box["shape"],
+                        dtype=bool,
+                        )
+    for plane in range(box["shape"][2]):
+        if len(positions) == 1:
+            labelmap[:, :, plane] = plane_mask(0)
+            continue
+        z = (box["start"][2] + plane) * spacing[2]
+        upper = int(np.clip(np.searchsorted(positions, z),
+                            1,
+                            len(positions) - 1,
+                            ),
+                    )
+        lower = upper - 1
+        weight = np.clip((z - positions[lower])
+                         / (positions[upper] - positions[lower]),
+                         0,
+                         1,
+                         )
+        if lower in polygons and upper in polygons:
+            distance = ((1 - weight) * distance_map(lower)
+                        + weight * distance_map(upper)
+                        )
+            labelmap[:, :, plane] = distance > 0
+        elif weight <= 0.5:
+            labelmap[:, :, plane] = plane_mask(lower)
+        else:
+            labelmap[:, :, plane] = plane_mask(upper)
+    
+    return labelmap
+
+def store_patients(input_folder_path):
+    """
+    Searching input directory for patient folders and storing their names in
+    a list.
+
+    Parameters
+    ----------
+    input_folder_path : str
+        Path to the folder where patients are stored.
+
+    Returns
+    -------
+    patient_folders: list
+        List containing the names of patient folders in the input directory.
+
+    """
+    patient_folders = []
+    for folder in os.listdir(input_folder_path):
+        # Only patient folders are needed, so, files are skipped.
+        if not os.path.isfile(os.path.join(input_folder_path,folder)):
+            patient_folders.append(folder)
+            
+    return patient_folders
+
+def is_patient_folder(folder_path):
+    """
+    Checking if a folder looks like a patient folder, that is if it contains
+    DICOM files or the CT and RTSTRUCT folders.
+    DICOM files are those moved by move_ct_rtstruct_files (names starting
+    with CT or RS) and .dcm files. Hidden files and other files (Ex.
+    Thumbs.db or a README in a year folder) are ignored.
+    
+    Parameters
+    ----------
+    folder_path : str
+        Path to the folder.
+    
+    Returns
+    -------
+    True :
+        If the folder contains DICOM files, a CT folder or a RTSTRUCT folder.
+    False :
+        Otherwise.
+    
+    """
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                if entry.name in ("CT", "RTSTRUCT"):
+                    return True
+            elif (entry.name.startswith(("CT", "RS"))
+                  or entry.name.lower().endswith(".dcm")):
+                return True
+    
+    return False
+
+def discover_patients(input_folder_path,
+                      max_depth=1,
+                      include=None,
+                      exclude=None,
+                      resume_after=None,
+                      ):
+    """
+    Searching input directory for patient folders, yielding them as soon as
+    they are found.
+    
+    Folders are visited in alphabetical order, recursing into the folders
+    that do not look like patient folders (see is_patient_folder) down to
+    max_depth levels; every folder at the deepest level is a patient folder.
+    With max_depth 1 the patient folders are the subfolders of the input
+    directory, as with store_patients.
+    Patient folders are given as paths relative to the input directory with
+    "/" separators (Ex. "2023/01/Pelvic-Ref002"), so that they can be passed
+    to load_patient.
+    
+    Parameters
+    ----------
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    max_depth : int, optional
+        Number of folder levels searched. Default is 1.
+    include : list, optional
+        Glob patterns of the relative paths of the patient folders to yield
+        (Ex. ["2023/*"]). If None (default) all patient folders are yielded.
+    exclude : list, optional
+        Glob patterns of the relative paths of the folders to skip, their
+        subfolders are not searched.
+    resume_after : str, optional
+        Relative path of the last patient folder already processed. Only the
+        following folders are yielded and the previous ones are not searched.
+    
+    Yields
+    ------
+    patient_folder : str
+        Relative path of a patient folder.
+    
+    """
+    include = include or []
+    exclude = exclude or []
+    resume_key = None if resume_after is None else tuple(
+        resume_after.split("/"),
+        )
+    
+    def search(folder_path, parent_key):
+        with os.scandir(folder_path) as entries:
+            folders = sorted(entry.name for entry in entries
+                             if entry.is_dir()
+                             )
+        for name in folders:
+            key = parent_key + (name,)
+            patient_folder = "/".join(key)
+            if any(fnmatch.fnmatch(patient_folder, pattern)
+                   for pattern in exclude
+                   ):
+                continue
+            
+            # Folders up to the last processed one were already searched,
+            # except for the ones containing it.
+            ancestor = False
+            if resume_key is not None:
+                ancestor = (len(key) < len(resume_key)
+                            and key == resume_key[:len(key)]
+                            )
+                if not ancestor and key <= resume_key:
+                    continue
+            
+            sub_folder_path = os.path.join(folder_path,
+                                           name,
+                                           )
+            if (len(key) < max_depth
+                and (ancestor or not is_patient_folder(sub_folder_path))):
+                yield from search(sub_folder_path, key)
+            elif not include or any(fnmatch.fnmatch(patient_folder, pattern)
+                                    for pattern in include
+                                    ):
+                yield patient_folder
+    
+    yield from search(input_folder_path, ())
+
+def read_discovery_progress(progress_path):
+    """
+    Reading the last patient folder processed by a previous execution.
+    
+    Parameters
+    ----------
+    progress_path : str
+        Path to the json file where the progress is recorded.
+    
+    Returns
+    -------
+    patient_folder : str or None
+        Relative path of the last processed patient folder, None if there is
+        no progress file.
+    
+    """
+    try:
+        with open(progress_path) as fd:
+            progress = json.load(fd)
+    except FileNotFoundError:
+        return None
+    
+    return progress["Last patient folder"]
+
+def save_discovery_progress(progress_path,
+                            patient_folder,
+                            ):
+    """
+    Recording the last processed patient folder, so that a following
+    execution can continue the discovery after it.
+    The file is replaced at once, so that it is never left half written.
+    
+    Parameters
+    ----------
+    progress_path : str
+        Path to the json file where the progress is recorded.
+    patient_folder : str
+        Relative path of the last processed patient folder.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    temporary_path = progress_path + ".tmp"
+    with open(temporary_path, "w") as fd:
+        json.dump({"Last patient folder": patient_folder},
+                  fd,
+                  indent=4,
+                  )
+    os.replace(temporary_path,
+               progress_path,
+               )
+
+def discovery_resume_point(processed_folders,
+                           failed_folders,
+                           ):
+    """
+    Finding the last patient folder up to which all the patients were
+    processed, so that failed patients are found again by the following
+    execution.
+    
+    Parameters
+    ----------
+    processed_folders : list
+        Patient folders processed by the execution, in the order they were
+        found.
+    failed_folders : iterable
+        Patient folders that could not be analysed, also after retrying.
+    
+    Returns
+    -------
+    patient_folder : str or None
+        Last patient folder before the first failed one, None if the first
+        patient failed or no patient was processed.
+    
+    """
+    failed_folders = set(failed_folders)
+    last_patient_folder = None
+    for patient_folder in processed_folders:
+        if patient_folder in failed_folders:
+            break
+        last_patient_folder = patient_folder
+    
+    return last_patient_folder
+
+def create_folder(parent_folder_path,
+                  folder_name,
+                  ):
+    """
+    Creating a new folder and returning the path to it.
+
+    Parameters
+    ----------
+    parent_folder_path : str
+        Path to the folder where the new one must be created.
+    folder_name : str
+        Name of the new folder.
+     
+    Returns
+    -------
+    new_folder_path: str
+        Path to the new folder.
+
+    """
+    # Defining folder path
+    new_folder_path = os.path.join(parent_folder_path,
+                                   folder_name,
+                                   )
+    
+    # Creating folder if does not exist
+    try:
+        os.mkdir(new_folder_path)
+    except FileExistsError:
+        pass
+    
+    return new_folder_path
+
+def move_ct_rtstruct_files(patient_folder_path,
+                           ct_folder_path,
+                           rtstruct_folder_path,
+                           ):
+    """
+    Moving CT files in the CT folder and RS files in the RTSTRUCT folder.
+    Folders and different kind of files won't be moved.
+    
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the patient folder.
+    ct_folder_path : str
+        Path to the folder where CT files will be stored.
+    rtstruct_folder_path : str
+        Path to the folder where RTSTRUCT files will be stored.
+
+    Returns
+    -------
+    None.
+
+    """
+    for file in os.listdir(patient_folder_path):
+        file_path = os.path.join(patient_folder_path,
+                                 file,
+                                 )
+        if not os.path.isfile(file_path):
+            pass
+        else:
+            if not (file.startswith("CT") or file.startswith("RS")):
+                pass
+            elif file.startswith("CT"):
+                shutil.move(file_path,
+                            ct_folder_path,
+                            )
+            elif file.startswith("RS"):
+                shutil.move(file_path,
+                            rtstruct_folder_path,
+                            )
+
+def fill_ct_rtstruct_folders(patient_folder_path,
+                             ct_folder_path,
+                             rtstruct_folder_path,
+                             ):
+    """
+    Filling CT and RTSTRUCT folders if both empty.
+    Exiting if only one of the folder is empty.
+    Going on with execution if both folders already have files inside.
+
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the patient folder.
+    ct_folder_path : str
+        Path to the folder where CT files will be stored.
+    rtstruct_folder_path : str
+        Path to the folder where RTSTRUCT files will be stored.
+
+    Returns
+    -------
+    None.
+
+    """
+    # If both CT and RTSTRUCT folders have files in them no action is needed.
+    if not (is_empty(rtstruct_folder_path) or is_empty(ct_folder_path)):
+        print("Both RTSTRUCT and CT folders have already files in them.",
+              "Thus, no files will be moved",
+              )
+        pass
+    # Filling CT and RTSTRUCT folders if both empty.
+    elif (is_empty(rtstruct_folder_path) and is_empty(ct_folder_path)):
+        print("Moving CT.dcm files into CT folder and RS.dcm files into",
+              "RTSTRUCT folder",
+              )
+        move_ct_rtstruct_files(patient_folder_path,
+                               ct_folder_path,
+                               rtstruct_folder_path,
+                               )
+    # Exit to not mix different data.
+    else:
+        exit_if_empty(rtstruct_folder_path)
+        exit_if_empty(ct_folder_path)
+        
+def check_new_folder_path(new_folder_path):
+    """
+    Checking if the user provided new_folder_path as argument.
+    If yes the path wil be concerted to python style.
+
+    Parameters
+    ----------
+    new_folder_path : str
+        Path to the folder where patient folders will be moved after execution.
+
+    Returns
+    -------
+    new_folder_path : str or bool
+        Path to the folder where patient folders will be moved after execution
+        converted into python path style.
+        False if the argument was not provided by the user.
+
+    """
+    if new_folder_path == ".":
+        print("New folder path has not been provided. Patient folders won't",
+              "be moved after execution.",
+              )
+        new_folder_path = False
+    else:
+        # Convert to python path style.
+        new_folder_path = new_folder_path.replace("\\", "/")
+    
+    return new_folder_path
+
+def read_config(config_path):
+    """
+    Opening the configuration.json file
+
+    Parameters
+    ----------
+    config_path : str
         Path to the configuration file.
 
     Returns
@@ -599,348 +3498,1891 @@ def read_config(config_path):
         Content of the configuration file.
 
     """
-    fd = open(config_path)
-    config = json.load(fd)
+    fd = open(config_path)
+    config = json.load(fd)
+    
+    return config
+
+def exit_if_empty(folder_path):
+    """
+    Exiting from execution if the selected folder is empty.
+
+    Parameters
+    ----------
+    folder_path : str
+        Path to a folder.
+
+    Returns
+    -------
+    None.
+
+    """
+    
+    if not is_empty(folder_path):
+        pass
+    else:
+        sys.exit(f"{folder_path} is empty, execution halted")
+        
+def exit_if_no_patients(input_folder_path,
+                        patient_folders,
+                        ):
+    """
+    Exiting from execution if there are no patient folders.
+
+    Parameters
+    ----------
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    patient_folders : list
+        List of the folders in the input directory.
+
+    Returns
+    -------
+    None.
+
+    """
+    if not len(patient_folders) == 0:
+        pass
+    else:
+        sys.exit(print(f"{input_folder_path} does not contain folders.",
+                  "Be sure to provide as input the folder that contains the",
+                  "patients and not directly .dcm files.",
+                  "Execution halted",
+                  )
+                 )
+        
+def extract_rtstruct_file_path(rtstruct_folder_path):
+    """
+    Extracting rtstruct file path.
+
+    Parameters
+    ----------
+    rtstruct_folder_path : str
+        Path to the RTSTRUCT folder.
+
+    Returns
+    -------
+    rtstruct_file_path : str
+        Path to the RS.dcm file.
+
+    """
+    for file in os.listdir(rtstruct_folder_path):
+        rtstruct_file_path = os.path.join(rtstruct_folder_path,
+                                          file,
+                                          )
+    
+    return rtstruct_file_path
+
+def parse_compared_methods(config):
+    """
+    Reading the comparisons to perform from the configuration file.
+    
+    Every compared methods name is made of the reference method and the
+    compared method separated by "-" (Ex. "Manual-MBS"). Methods are
+    "Manual" or one of the automatic methods.
+    Execution is halted if a comparison contains unknown methods.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    comparisons : list
+        List of (compared methods, reference method, compared method) tuples
+        (Ex. [("Manual-MBS", "Manual", "MBS")]).
+
+    """
+    methods = [MANUAL_METHOD] + automatic_methods(config)
+    comparisons = []
+    for compared_methods in config["Compared methods"]:
+        # Method names can contain "-" too, so every split is tried.
+        parts = compared_methods.split("-")
+        for split in range(1, len(parts)):
+            reference_method = "-".join(parts[:split])
+            compared_method = "-".join(parts[split:])
+            if reference_method in methods and compared_method in methods:
+                comparisons.append((compared_methods,
+                                    reference_method,
+                                    compared_method,
+                                    ),
+                                   )
+                break
+        else:
+            sys.exit(f"{compared_methods} is not a comparison between two "
+                     f"of {methods}, execution halted"
+                     )
+    
+    return comparisons
+
+def method_segments(method,
+                    manual_segments,
+                    config,
+                    ):
+    """
+    Returning the segments of a segmentation method.
+
+    Parameters
+    ----------
+    method : str
+        Name of the method (Ex. "Manual", "MBS").
+    manual_segments : list
+        List of the manual segments.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    segments : list
+        Segments of the method in the same order of the alias names.
+
+    """
+    if method == MANUAL_METHOD:
+        return manual_segments
+    
+    return config[f"{method} segments"]
+
+def create_segments_matrices(manual_segments,
+                             config,
+                             ):
+    """
+    Creating the reference segments and compared segments matrices to perform
+    the comparisons listed in "Compared methods" (Ex. manual-MBS, manual-DL
+    and MBS-DL).
+
+    Parameters
+    ----------
+    manual_segments : list
+        List of the manual segments.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    ref_segs : list
+        List of reference segments lists.
+    comp_segs : list
+        List of segments to compare lists.
+
+    """
+    ref_segs = []
+    comp_segs = []
+    for _, reference_method, compared_method in parse_compared_methods(config):
+        ref_segs.append(method_segments(reference_method,
+                                        manual_segments,
+                                        config,
+                                        ),
+                        )
+        comp_segs.append(method_segments(compared_method,
+                                         manual_segments,
+                                         config,
+                                         ),
+                         )
+    
+    return ref_segs, comp_segs
+
+def extract_hausdorff_dice(manual_segments,
+                           config,
+                           ct_folder_path,
+                           rtstruct_file_path,
+                           final_data,
+                           patient_data=None,
+                           labelmaps=None,
+                           previous_rows=None,
+                           progress=None,
+                           executor=None,
+                           ):
+    """
+    Extracting Hausdorff distance, Dice similarity coefficient and
+    surface dice similarity coefficient for each segment.
+    The comparisons listed in "Compared methods" are performed (Ex.
+    manual-MBS, manual-DL and MBS-DL).
+    Extracted data are saved in the final_data list.
+    
+    Comparisons are scheduled one alias name at a time: the labelmaps of a
+    structure are created once for all the comparisons and released before
+    moving to the next structure, so that memory does not grow with the
+    number of methods and structures. Rows are saved grouped by compared
+    methods.
+    If the configuration file has a "Resampling spacing (mm)", labelmaps are
+    created on that common grid, cropped around the segments of the current
+    structure (see resampled_labelmap), and surface Dice tolerance is the
+    greatest spacing of the common grid.
+    The metrics listed in "Additional metrics" are added at the end of every
+    row, in the same order of results_columns, followed by the reason why
+    the comparison was skipped.
+    Comparisons with an absent or empty segment (see skipped_reason) are not
+    performed and their metrics are NaN.
+    Every row ends with the fingerprints of the contours of its segments:
+    comparisons in previous_rows whose segments and fingerprints did not
+    change keep their previous metrics, without creating their labelmaps.
+    Surface distances are computed by the "Distance backend" of the
+    configuration file (see distance_backend). If "Compute Hausdorff
+    distance" is false, Hausdorff distances are NaN and surface Dice is
+    computed without the surface distances when possible.
+    If "Metric workers" is greater than 1, comparisons are computed by that
+    many processes: the labelmaps of a structure are copied once in shared
+    memory (see mask_store) and workers receive only their handles. The
+    results of a structure are collected while the labelmaps of the next one
+    are created, then its shared memory is freed. The pool of processes is
+    the executor of the run (see create_metric_executor), or one created
+    for the patient if it is not given.
+
+    Parameters
+    ----------
+    manual_segments : list
+        List of the manual segments.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    ct_folder_path : str
+        Path to the folder where CT files will be stored.
+    rtstruct_file_path : str
+        Path to the RS.dcm file.
+    final_data: list
+        List containing the final data.
+    patient_data : rt_utils.RTStruct, optional
+        Already loaded patient files. If None (default) they are read from
+        ct_folder_path and rtstruct_file_path once for the whole patient.
+    labelmaps : dict, optional
+        Already decoded labelmaps indexed by segment name. Labelmaps are
+        removed from it once all the comparisons of their structure are done.
+    previous_rows : dict, optional
+        Rows of the study in the previous results by compared methods and
+        alias name (see previous_results). Default is None.
+    progress : dict, optional
+        Progress created by Progress.create_progress, updated with the stage
+        of every structure and the computed comparisons. Default is None.
+    executor : concurrent.futures.ProcessPoolExecutor, optional
+        Pool of the run created by create_metric_executor, used if "Metric
+        workers" is greater than 1. If None (default) a pool is created for
+        the patient.
+
+    Returns
+    -------
+    final_data: list
+        List containing the final data (updated)
+
+    """
+    from rt_utils import RTStructBuilder
+    
+    # Comparisons to perform and their reference and compared segments lists.
+    compared_methods = [comparison[0]
+                        for comparison in parse_compared_methods(config)
+                        ]
+    ref_segs, comp_segs = create_segments_matrices(manual_segments,
+                                                   config,
+                                                   )
+    
+    # Reading patient files only once, every segment is then rasterized from
+    # the same data.
+    if patient_data is None:
+        patient_data = RTStructBuilder.create_from(ct_folder_path,
+                                                   rtstruct_file_path,
+                                                   )
+    if labelmaps is None:
+        labelmaps = {}
+    
+    # Extraction of patient ID and frame of reference UID from the already
+    # read RTSTRUCT file.
+    patient_id = patient_info(rtstruct_file_path,
+                              "PatientID",
+                              patient_data.ds,
+                              )
+    frame_of_reference_uid = patient_info(rtstruct_file_path,
+                                          "FrameOfReferenceUID",
+                                          patient_data.ds,
+                                          )
+    
+    # Geometry of the CT series, needed to resample the labelmaps.
+    spacing = resampling_spacing(config)
+    if spacing is not None:
+        geometry = series_geometry(patient_data.series_data)
+    coarse_to_fine = use_coarse_to_fine(config)
+    metrics = additional_metrics(config)
+    n_workers = metric_workers(config)
+    backend = distance_backend(config)
+    hausdorff = use_hausdorff_distance(config)
+    
+    # Absent and empty segments are found from the ROIs of the RTSTRUCT file,
+    # before rasterizing anything.
+    all_segments = patient_data.get_roi_names()
+    contoured = contoured_segments(patient_data.ds)
+    fingerprints = contour_fingerprints(patient_data.ds)
+    if previous_rows is None:
+        previous_rows = {}
+    metric_columns = Results.RESULTS_COLUMNS[-3:] + [ADDITIONAL_METRICS[name]
+                                                     for name in metrics
+                                                     ]
+    
+    print("Computing 95 percentile Hausdorff distance, Dice",
+          "similarity coefficient and surface Dice similarity",
+          f"coefficient between {', '.join(compared_methods)}",
+          "segments",
+          )
+    
+    # Rows are stored in their final place, grouped by compared methods.
+    n_segments = len(config["Alias names"])
+    rows = [None for i in range(len(compared_methods) * n_segments)]
+    
+    # Comparisons are computed by worker processes, whose shared memory is
+    # released also on errors, once the comparisons of the patient are
+    # cancelled or done.
+    store = None
+    pending, pending_names = [], []
+    all_submitted = []
+    with ExitStack() as stack:
+        if n_workers > 1:
+            if spacing is None:
+                voxel_spacing_mm = spacing_and_tolerance(
+                    ct_folder_path,
+                    patient_data.series_data,
+                    )[0]
+            else:
+                voxel_spacing_mm = spacing
+            store = stack.enter_context(mask_store())
+            if executor is None:
+                executor = create_metric_executor(config)
+                stack.callback(executor.shutdown,
+                               cancel_futures=True,
+                               )
+            stack.callback(cancel_stored_metrics,
+                           all_submitted,
+                           )
+        
+        for segment in range(n_segments):
+            print(f"Comparing {config['Alias names'][segment]} segments")
+            Progress.set_progress_stage(
+                progress,
+                f"masks {config['Alias names'][segment]}",
+                )
+            
+            # Comparisons that can not be performed are skipped.
+            reasons = [skipped_reason(ref_segs[methods][segment],
+                                      comp_segs[methods][segment],
+                                      all_segments,
+                                      contoured,
+                                      )
+                       for methods in range(len(compared_methods))
+                       ]
+            
+            # Comparisons whose contours did not change are not computed again.
+            reused = [reused_metrics(previous_rows.get(
+                                         (compared_methods[methods],
+                                          config["Alias names"][segment],
+                                          ),
+                                         ),
+                                     ref_segs[methods][segment],
+                                     comp_segs[methods][segment],
+                                     fingerprints,
+                                     metric_columns,
+                                     )
+                      for methods in range(len(compared_methods))
+                      ]
+            
+            # Segments of the current structure used by at least one
+            # comparison. Reused metrics and labelmaps decoded while loading
+            # are cache hits.
+            segment_names = []
+            for methods in range(len(compared_methods)):
+                if previous_rows and not reasons[methods]:
+                    PipelineMetrics.count_cache_lookup(
+                        "previous_metrics",
+                        reused[methods] is not None,
+                        )
+                if reasons[methods] or reused[methods] is not None:
+                    continue
+                for segment_name in (ref_segs[methods][segment],
+                                     comp_segs[methods][segment],
+                                     ):
+                    if segment_name not in segment_names:
+                        segment_names.append(segment_name)
+            
+            #Create binary labelmaps for reference and to compare segments.
+            if spacing is not None and segment_names:
+                # All the labelmaps of the structure share the same box of the
+                # common grid.
+                contours = {segment_name: roi_contours(patient_data.ds,
+                                                       segment_name,
+                                                       geometry,
+                                                       )
+                            for segment_name in segment_names
+                            }
+                box = resampling_box([points
+                                      for segment_contours in contours.values()
+                                      for points in segment_contours
+                                      ],
+                                     spacing,
+                                     )
+                for segment_name in segment_names:
+                    labelmaps[segment_name] = resampled_labelmap(
+                        contours.pop(segment_name),
+                        geometry["slice_positions"],
+                        spacing,
+                        box,
+                        )
+            for segment_name in segment_names:
+                if spacing is None:
+                    PipelineMetrics.count_cache_lookup(
+                        "labelmaps",
+                        segment_name in labelmaps,
+                        )
+                if segment_name not in labelmaps:
+                    labelmaps[segment_name] = create_labelmap(
+                        ct_folder_path,
+                        rtstruct_file_path,
+                        segment_name,
+                        patient_data,
+                        )
+            
+            Progress.set_progress_stage(
+                progress,
+                f"metrics {config['Alias names'][segment]}",
+                )
+            submitted = []
+            for methods in range(len(compared_methods)):
+                values = dict.fromkeys(metrics,
+                                       np.nan,
+                                       )
+                if reasons[methods]:
+                    print(f"{compared_methods[methods]} comparison skipped:",
+                          reasons[methods],
+                          )
+                    sdsc, dsc, hd = np.nan, np.nan, np.nan
+                elif reused[methods] is not None:
+                    print(f"{compared_methods[methods]} contours did not",
+                          "change, previous metrics are kept",
+                          )
+                    hd, dsc, sdsc = reused[methods][:3]
+                    values.update(zip(metrics,
+                                      reused[methods][3:],
+                                      ))
+                elif store is not None:
+                    # Metrics are set when the results of the structure are
+                    # collected.
+                    sdsc, dsc, hd = np.nan, np.nan, np.nan
+                    submitted.append((
+                        methods * n_segments + segment,
+                        executor.submit(compute_stored_metrics,
+                                        store_mask(store,
+                                                   ref_segs[methods][segment],
+                                                   labelmaps[ref_segs[methods]
+                                                             [segment]],
+                                                   ),
+                                        store_mask(store,
+                                                   comp_segs[methods][segment],
+                                                   labelmaps[comp_segs[methods]
+                                                             [segment]],
+                                                   ),
+                                        voxel_spacing_mm,
+                                        coarse_to_fine,
+                                        metrics,
+                                        backend,
+                                        hausdorff,
+                                        ),
+                        ))
+                    all_submitted.append(submitted[-1])
+                else:
+                    ref_labelmap = labelmaps[ref_segs[methods][segment]]
+                    comp_labelmap = labelmaps[comp_segs[methods][segment]]
+                    
+                    # Computing surface Dice similarity coefficient (sdsc),
+                    # Dice similarity coefficient (dsc), Hausdorff distance
+                    # (hd) and the additional metrics.
+                    sdsc, dsc, hd = compute_metrics(ref_labelmap,
+                                                    comp_labelmap,
+                                                    ct_folder_path,
+                                                    patient_data.series_data,
+                                                    spacing,
+                                                    coarse_to_fine,
+                                                    values,
+                                                    backend,
+                                                    hausdorff,
+                                                    )
+                    Progress.add_progress(progress,
+                                          comparisons=1,
+                                          )
+                    PipelineMetrics.increment_metric(
+                        "hd_dsc_comparisons_total",
+                        )
+                
+                # Temporary list to store the current row of the final
+                # dataframe.
+                row = [patient_id,
+                       frame_of_reference_uid,
+                       compared_methods[methods],
+                       ref_segs[methods][segment],
+                       comp_segs[methods][segment],
+                       config["Alias names"][segment],
+                       hd,
+                       dsc,
+                       sdsc,
+                       ] + [values[name] for name in metrics] + [
+                           reasons[methods],
+                           fingerprints.get(ref_segs[methods][segment], ""),
+                           fingerprints.get(comp_segs[methods][segment], ""),
+                           ]
+                rows[methods * n_segments + segment] = row
+            
+            # Labelmaps of this structure are no longer needed, also those
+            # decoded while loading for skipped comparisons.
+            for methods in range(len(compared_methods)):
+                labelmaps.pop(ref_segs[methods][segment], None)
+                labelmaps.pop(comp_segs[methods][segment], None)
+            
+            # Results of the previous structure are collected while this one
+            # is computed, then its shared memory is freed.
+            if store is not None:
+                collect_stored_metrics(rows,
+                                       pending,
+                                       metrics,
+                                       )
+                Progress.add_progress(progress,
+                                      comparisons=len(pending),
+                                      )
+                PipelineMetrics.increment_metric("hd_dsc_comparisons_total",
+                                                 len(pending),
+                                                 )
+                release_masks(store,
+                              [segment_name
+                               for segment_name in pending_names
+                               if segment_name not in segment_names
+                               ],
+                              )
+                pending, pending_names = submitted, segment_names
+        
+        if store is not None:
+            collect_stored_metrics(rows,
+                                   pending,
+                                   metrics,
+                                   )
+            Progress.add_progress(progress,
+                                  comparisons=len(pending),
+                                  )
+            PipelineMetrics.increment_metric("hd_dsc_comparisons_total",
+                                             len(pending),
+                                             )
+    
+    # Adding the constructed rows to final_data.
+    final_data.extend(rows)
+    
+    return final_data
+
+def move_patient_folder(new_folder_path,
+                        patient_folder_path,
+                        patient_folder,
+                        ):
+    """
+    If the user provided new_folder_path as argument, move already used patient
+    folders in the new folder.
+
+    Parameters
+    ----------
+    new_folder_path : str
+        Path where patient folders will be moved after execution.
+    patient_folder_path : str
+        Path to the patient folder.
+    patient_folder : str
+        Name of the patient folder.
+
+    Returns
+    -------
+    None.
+
+    """
+    if not new_folder_path:
+        pass
+    else:
+        # Nested patient folders keep their relative path.
+        destination_path = os.path.join(new_folder_path,
+                                        patient_folder,
+                                        )
+        os.makedirs(os.path.dirname(destination_path),
+                    exist_ok=True,
+                    )
+        shutil.move(patient_folder_path,
+                    destination_path,
+                    )
+        print(f"{patient_folder} successfully moved to {new_folder_path}")
+        
+def save_config_data(config,
+                     new_config_path,
+                     ):
+    """
+    Saving the updated configuration data into the new configuration file.
+
+    Parameters
+    ----------
+    config : dict
+        Content of the configuration file.
+    new_config_path : str
+        Path to the new configuration file.
+
+    Returns
+    -------
+    None.
+
+    """
+    json_object = json.dumps(config,
+                             indent=4,
+                             )
+    with open(new_config_path, "w") as outfile:
+        outfile.write(json_object)
+        
+def load_existing_dataframe(excel_path,
+                            columns=None,
+                            ):
+    """
+    Loading existing dataframe or creating an empty new one.
     
-    return config
+    Excel, CSV, Parquet and Arrow (Feather) files are supported. Only the
+    requested columns are read, which is much faster for columnar formats.
+
+    Parameters
+    ----------
+    excel_path : str
+        Path to the file where the old data are stored.
+    columns : list, optional
+        Names of the columns to load. If None (default) all the columns are
+        loaded.
+
+    Returns
+    -------
+    old_data : DataFrame
+        Dataframe of the data contained in the file (if the file does not
+        exist it is an empty dataframe).
 
-def exit_if_empty(folder_path):
     """
-    Exiting from execution if the selected folder is empty.
+    import pandas as pd
+    
+    file_format = Results.results_format(excel_path)
+    try:
+        # loading existing data.
+        if file_format == "excel":
+            old_data = pd.read_excel(excel_path,
+                                     usecols=columns,
+                                     )
+        elif file_format == "csv":
+            # Text is kept as it is (Ex. patient IDs with leading zeros).
+            old_data = pd.read_csv(excel_path,
+                                   usecols=columns,
+                                   dtype={column: str
+                                          for column in Results.TEXT_COLUMNS
+                                          },
+                                   )
+        elif file_format == "parquet":
+            old_data = pd.read_parquet(excel_path,
+                                       columns=columns,
+                                       )
+        else:
+            old_data = pd.read_feather(excel_path,
+                                       columns=columns,
+                                       )
+        print(f"Successfully loaded {excel_path}")
+    except FileNotFoundError:
+        # There is not an existing file in excel path.
+        print(f"Failed to load {excel_path}, a new file will be created")
+        old_data = pd.DataFrame()
+    
+    return old_data
+
+def concatenate_data(old_data,
+                     new_data,
+                     ):
+    """
+    Concatenating old and new data in a single dataframe.
 
     Parameters
     ----------
-    folder_path : str
-        Path to a folder.
+    old_data : DataFrame
+        Dataframe contained in the excel file (if there is not an excel file
+        it is an empty dataframe).
+    new_data : DataFrame
+        Dataframe of the new acquired data.
 
     Returns
     -------
-    None.
+    new_data : DataFrame
+        Dataframe of the merged data.
 
     """
+    import pandas as pd
     
-    if not is_empty(folder_path):
-        pass
-    else:
-        sys.exit(f"{folder_path} is empty, execution halted")
-        
-def exit_if_no_patients(input_folder_path,
-                        patient_folders,
-                        ):
+    frames = [old_data,
+              new_data,
+              ]
+    new_data = pd.concat(frames,
+                         ignore_index=True,
+                         )
+    print("Old and new dataframe concatenated")
+    
+    return new_data
+
+def check_study(old_data,
+                frame_of_reference_uid,
+                patient_id,
+                ):
     """
-    Exiting from execution if there are no patient folders.
+    Checking if the current patient has been already analysed.
 
     Parameters
     ----------
-    input_folder_path : str
-        Path to the folder where patients are stored.
-    patient_folders : list
-        List of the folders in the input directory.
+    old_data : DataFrame
+        Dataframe contained in the excel file (if there is not an excel file
+        it is an empty dataframe).
+    frame_of_reference_uid : pydicom.uid.UID
+        Code of the current patient.
+    patient_id : str
+        Name of the anlysed patient.
 
     Returns
     -------
-    None.
+    frame_uid_in_old_data : bool
+        Flag to know if the current patient study is already in the dataframe.
 
     """
-    if not len(patient_folders) == 0:
-        pass
-    else:
-        sys.exit(print(f"{input_folder_path} does not contain folders.",
-                  "Be sure to provide as input the folder that contains the",
-                  "patients and not directly .dcm files.",
-                  "Execution halted",
+    for frame_of_reference in old_data.loc[:,"Frame of reference"]:
+        if frame_of_reference == frame_of_reference_uid:
+            print(f"Study {frame_of_reference} of patient",
+                  f"{patient_id} is alreday in the dataframe,",
+                  "going to the next one",
                   )
-                 )
-        
-def extract_rtstruct_file_path(rtstruct_folder_path):
+            frame_uid_in_old_data = True
+            break
+        else:
+            frame_uid_in_old_data = False
+    
+    return frame_uid_in_old_data
+
+def previous_results(old_data,
+                     frame_of_reference_uid,
+                     ):
     """
-    Extracting rtstruct file path.
+    Returning the rows of a study in the previous results.
+    
+    Parameters
+    ----------
+    old_data : DataFrame
+        Dataframe contained in the results file (if there is not a results
+        file it is an empty dataframe).
+    frame_of_reference_uid : str
+        Frame of reference UID of the study.
+    
+    Returns
+    -------
+    previous_rows : dict
+        Rows of the study as dictionaries by (compared methods, alias name),
+        with missing text values as empty strings. Empty if the previous
+        results do not have the fingerprints of the contours.
+    
+    """
+    if (old_data.empty or "Frame of reference" not in old_data
+            or any(column not in old_data
+                   for column in Results.FINGERPRINT_COLUMNS)):
+        return {}
+    
+    study_data = old_data[old_data["Frame of reference"].astype(str)
+                          == str(frame_of_reference_uid)
+                          ]
+    previous_rows = {}
+    for row in study_data.to_dict("records"):
+        for column in Results.TEXT_COLUMNS:
+            if column in row and not isinstance(row[column], str):
+                row[column] = ""
+        previous_rows[(str(row["Compared methods"]),
+                       str(row["Alias name"]),
+                       )] = row
+    
+    return previous_rows
 
+def study_unchanged(previous_rows,
+                    fingerprints,
+                    ):
+    """
+    Checking if the contours of all the segments of a study in the previous
+    results are the same.
+    
     Parameters
     ----------
-    rtstruct_folder_path : str
-        Path to the RTSTRUCT folder.
+    previous_rows : dict
+        Rows of the study in the previous results (see previous_results).
+    fingerprints : dict
+        Current fingerprints by segment name (see contour_fingerprints).
+    
+    Returns
+    -------
+    unchanged : bool
+        True if every compared segment has the same fingerprint.
+    
+    """
+    for row in previous_rows.values():
+        for name_column, fingerprint_column in zip(("Reference segment name",
+                                                    "Compared segment name",
+                                                    ),
+                                                   Results.FINGERPRINT_COLUMNS,
+                                                   ):
+            if (fingerprints.get(row[name_column], "")
+                    != row[fingerprint_column]):
+                return False
+    
+    return True
 
+def skip_analysed_study(old_data,
+                        patient_id,
+                        frame_of_reference_uid,
+                        rtstruct_dataset=None,
+                        ):
+    """
+    Checking if a study must not be analysed, since it is already in the
+    previous results and the contours of its segments were not edited.
+    
+    Bound to the previous results with functools.partial, it is the
+    skip_study function of load_patient, prefetch_patients, plan_patient
+    and WorkQueue.run_worker.
+    
+    Parameters
+    ----------
+    old_data : DataFrame
+        Dataframe contained in the results file (if there is not a results
+        file it is an empty dataframe).
+    patient_id : str
+        Patient ID of the study.
+    frame_of_reference_uid : str
+        Frame of reference UID of the study.
+    rtstruct_dataset : pydicom.dataset.FileDataset, optional
+        RTSTRUCT dataset of the study, whose contours are compared with the
+        fingerprints of the previous results. If None (default) they are
+        not compared.
+    
     Returns
     -------
-    rtstruct_file_path : str
-        Path to the RS.dcm file.
+    skip : bool
+        True if the study must not be analysed.
+    
+    """
+    # Studies already in the results file are analysed again only if the
+    # contours of some of their segments were edited.
+    previous_rows = previous_results(old_data,
+                                     frame_of_reference_uid,
+                                     )
+    if previous_rows and rtstruct_dataset is not None:
+        fingerprints = contour_fingerprints(rtstruct_dataset)
+        if not study_unchanged(previous_rows,
+                               fingerprints,
+                               ):
+            print(f"Contours of study {frame_of_reference_uid} of",
+                  f"patient {patient_id} were edited, changed segments",
+                  "will be analysed again",
+                  )
+            return False
+    
+    # If the current frame of reference is already in the results we can
+    # move to the next one.
+    try:
+        return check_study(old_data,
+                           frame_of_reference_uid,
+                           patient_id,
+                           )
+    except KeyError:
+        return False
 
+def update_results(old_data,
+                   updated_rows,
+                   columns,
+                   ):
     """
-    for file in os.listdir(rtstruct_folder_path):
-        rtstruct_file_path = os.path.join(rtstruct_folder_path,
-                                          file,
-                                          )
+    Replacing the rows of the previous results that were computed again.
     
-    return rtstruct_file_path
+    Parameters
+    ----------
+    old_data : DataFrame
+        Dataframe contained in the results file.
+    updated_rows : dict
+        New rows by (frame of reference UID, compared methods, alias name).
+    columns : list
+        Columns of the results.
+    
+    Returns
+    -------
+    rows : list
+        Previous rows with the updated ones in their place, followed by the
+        new rows of comparisons that were not in the previous results.
+    
+    """
+    if old_data.empty:
+        return list(updated_rows.values())
+    
+    rows = old_data.reindex(columns=columns).values.tolist()
+    positions = {key: position
+                 for position, key in enumerate(zip(
+                     old_data["Frame of reference"].astype(str),
+                     old_data["Compared methods"].astype(str),
+                     old_data["Alias name"].astype(str),
+                     ))
+                 }
+    for key, row in updated_rows.items():
+        key = tuple(str(value) for value in key)
+        if key in positions:
+            rows[positions[key]] = row
+        else:
+            rows.append(row)
+    
+    return rows
 
-def create_segments_matrices(manual_segments,
-                             config,
-                             ):
+def load_patient(input_folder_path,
+                 patient_folder,
+                 config=None,
+                 decode_masks=False,
+                 skip_study=None,
+                 read_workers=None,
+                 capture_errors=False,
+                 segment_index=None,
+                 ):
     """
-    Creating the reference segments and compared segments matrices to compare
-    manual-MBS, manual-DL and MBS-DL methods.
+    Preparing the patient folder and loading its CT series and RTSTRUCT file.
+    
+    CT and RS files are moved in their folders (if needed), patient ID and
+    frame of reference UID are extracted and the CT series and the RTSTRUCT
+    file are read. Optionally, the labelmaps of all the known segments are
+    decoded too.
 
     Parameters
     ----------
-    manual_segments : list
-        List of the manual segments.
-    config : dict
-        Dictionary containing lists of possible manual segments names.
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    patient_folder : str
+        Name of the patient folder.
+    config : dict, optional
+        Dictionary containing lists of possible segments names. Needed only
+        if decode_masks is True.
+    decode_masks : bool, optional
+        If True the labelmaps of the segments that are in the configuration
+        file are created while loading. Default is False.
+    skip_study : callable, optional
+        Function taking patient ID, frame of reference UID and RTSTRUCT
+        dataset and returning True if the study must not be loaded (Ex.
+        already analysed).
+    read_workers : int, optional
+        Number of CT files read at the same time (see read_ct_slices).
+    capture_errors : bool, optional
+        If True errors (execution halts included) are stored in the patient
+        instead of being raised (see patient_error). Default is False.
+    segment_index : dict, optional
+        Segments index created by compile_segment_index, used if
+        decode_masks is True. If None (default) it is created from config.
 
     Returns
     -------
-    ref_segs : list
-        List of reference segments lists.
-    comp_segs : list
-        List of segments to compare lists.
+    patient : dict
+        Dictionary with the paths of the patient folders and files, patient
+        ID, frame of reference UID, loaded patient data ("patient_data",
+        None if the study is skipped or can not be loaded), decoded
+        labelmaps ("labelmaps"), an estimate of the memory used in bytes
+        ("nbytes", the bytes read from the RTSTRUCT file and the CT headers
+        plus the decoded labelmaps) and the error met while loading
+        ("error", None if there was not one).
 
     """
-    ref_segs = [manual_segments,
-                manual_segments,
-                config["MBS segments"],
-                ]
-    comp_segs = [config["MBS segments"],
-                 config["DL segments"],
-                 config["DL segments"],
-                 ]
+    patient_folder_path = os.path.join(input_folder_path,
+                                       patient_folder,
+                                       )
+    patient = {"patient_folder": patient_folder,
+               "patient_folder_path": patient_folder_path,
+               "ct_folder_path": None,
+               "rtstruct_file_path": None,
+               "patient_id": None,
+               "frame_of_reference_uid": None,
+               "patient_data": None,
+               "labelmaps": {},
+               "nbytes": 0,
+               "error": None,
+               }
+    
+    stage = "prepare"
+    start = time.perf_counter()
+    try:
+        # Patient folder can not be empty.
+        exit_if_empty(patient_folder_path)
+        
+        # RTSTRUCT and CT series should be in different folders.
+        rtstruct_folder_path = create_folder(patient_folder_path,
+                                             "RTSTRUCT",
+                                             )
+        ct_folder_path = create_folder(patient_folder_path,
+                                       "CT",
+                                       )
+        
+        # Filling CT and RTSTRUCT folders if both empty
+        fill_ct_rtstruct_folders(patient_folder_path,
+                                 ct_folder_path,
+                                 rtstruct_folder_path,
+                                 )
+        
+        # If RTSTRUCT or CT folders are still empty there are no data.
+        exit_if_empty(rtstruct_folder_path)
+        exit_if_empty(ct_folder_path)
+        
+        rtstruct_file_path = extract_rtstruct_file_path(rtstruct_folder_path)
+        patient["ct_folder_path"] = ct_folder_path
+        patient["rtstruct_file_path"] = rtstruct_file_path
+        
+        # The RTSTRUCT file is parsed once, its contours are decoded only
+        # when needed.
+        stage = "header"
+        rtstruct_dataset = read_rtstruct(rtstruct_file_path)
+        patient["patient_id"] = patient_info(rtstruct_file_path,
+                                             "PatientID",
+                                             rtstruct_dataset,
+                                             )
+        patient["frame_of_reference_uid"] = patient_info(
+            rtstruct_file_path,
+            "FrameOfReferenceUID",
+            rtstruct_dataset,
+            )
+        
+        # Studies that must not be analysed are not loaded at all.
+        if skip_study is not None and skip_study(
+                patient["patient_id"],
+                patient["frame_of_reference_uid"],
+                rtstruct_dataset,
+                ):
+            return patient
+        
+        # Reading CT series and RTSTRUCT file.
+        stage = "read"
+        read_stats = {}
+        patient_data = load_patient_data(ct_folder_path,
+                                         rtstruct_file_path,
+                                         read_workers,
+                                         rtstruct_dataset,
+                                         read_stats,
+                                         )
+        patient["patient_data"] = patient_data
+        
+        # Datasets in memory are estimated by the bytes read from their
+        # files, contours are kept as they are stored.
+        patient["nbytes"] = (os.path.getsize(rtstruct_file_path)
+                             + read_stats["n_bytes"]
+                             )
+        
+        # Rasterizing the known segments, resampled labelmaps are created
+        # while analysing since they depend on all the segments of their
+        # structure.
+        stage = "masks"
+        if decode_masks and resampling_spacing(config) is None:
+            if segment_index is None:
+                segment_index = compile_segment_index(config)
+            contoured = contoured_segments(patient_data.ds)
+            for name in patient_data.get_roi_names():
+                match = lookup_segment(name,
+                                       segment_index,
+                                       )
+                if (match is None or match[0] == "External names"
+                        or name not in contoured):
+                    continue
+                labelmap = create_labelmap(ct_folder_path,
+                                           rtstruct_file_path,
+                                           name,
+                                           patient_data,
+                                           )
+                patient["labelmaps"][name] = labelmap
+                patient["nbytes"] += labelmap.nbytes
+    except (Exception, SystemExit):
+        if not capture_errors:
+            raise
+        # Partially loaded data are released.
+        patient["error"] = patient_error(stage)
+        patient["patient_data"] = None
+        patient["labelmaps"] = {}
+        patient["nbytes"] = 0
+    finally:
+        PipelineMetrics.record_stage(None,
+                                     "load",
+                                     time.perf_counter() - start,
+                                     )
+    
+    return patient
+
+def prefetch_patients(input_folder_path,
+                      patient_folders,
+                      prefetch_depth=1,
+                      max_prefetch_mb=None,
+                      config=None,
+                      decode_masks=False,
+                      skip_study=None,
+                      read_workers=None,
+                      capture_errors=False,
+                      progress=None,
+                      ):
+    """
+    Loading patients in a background thread while the previous ones are
+    analysed.
+    
+    Patients are yielded in the same order of patient_folders. At most
+    prefetch_depth patients are loaded ahead of the one being analysed, and
+    no new patient is loaded while the patients in memory (the one being
+    analysed included) exceed max_prefetch_mb megabytes.
+    Errors raised while loading are raised again when the corresponding
+    patient would have been yielded.
+
+    Parameters
+    ----------
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    patient_folders : list
+        List containing the names of patient folders in the input directory.
+    prefetch_depth : int, optional
+        Number of patients loaded ahead. If 0 patients are loaded one at a
+        time when needed. Default is 1.
+    max_prefetch_mb : float, optional
+        Memory limit in megabytes for the loaded patients. If None (default)
+        only prefetch_depth limits the look-ahead.
+    config : dict, optional
+        Dictionary containing lists of possible segments names. The loading
+        thread uses a copy taken before it starts, since the user may change
+        the configuration while a patient is analysed.
+    decode_masks : bool, optional
+        If True the labelmaps of the known segments are created while
+        loading. Default is False.
+    skip_study : callable, optional
+        Function taking patient ID, frame of reference UID and RTSTRUCT
+        dataset and returning True if the study must not be loaded.
+    read_workers : int, optional
+        Number of CT files read at the same time (see read_ct_slices).
+    capture_errors : bool, optional
+        If True errors met while loading a patient are stored in it and the
+        following patients are loaded anyway (see load_patient). Default is
+        False.
+    progress : dict, optional
+        Progress created by Progress.create_progress, where the loading
+        thread sets its "load" stage.
+
+    Yields
+    ------
+    patient : dict
+        Loaded patient (see load_patient).
+
+    """
+    if prefetch_depth <= 0:
+        for patient_folder in patient_folders:
+            Progress.set_progress_stage(progress,
+                                        "load",
+                                        patient_folder,
+                                        )
+            yield load_patient(input_folder_path,
+                               patient_folder,
+                               config,
+                               decode_masks,
+                               skip_study,
+                               read_workers,
+                               capture_errors,
+                               )
+        return
+    
+    if max_prefetch_mb is None:
+        max_prefetch_bytes = float("inf")
+    else:
+        max_prefetch_bytes = max_prefetch_mb * 1024**2
+    
+    # The loading thread and the analysis do not share the configuration,
+    # which user_selection changes while a patient is analysed.
+    if config is not None:
+        config = copy.deepcopy(config)
+        segment_index = compile_segment_index(config)
+    else:
+        segment_index = None
+    
+    loaded_patients = queue.Queue()
+    condition = threading.Condition()
+    in_memory = {"count": 0,
+                 "nbytes": 0,
+                 }
+    stop = threading.Event()
+    
+    def can_load():
+        # A patient is always loaded if nothing is in memory, otherwise both
+        # the look-ahead and the memory limits must be respected.
+        return (stop.is_set()
+                or in_memory["count"] == 0
+                or (in_memory["count"] <= prefetch_depth
+                    and in_memory["nbytes"] < max_prefetch_bytes)
+                )
+    
+    def producer():
+        try:
+            for patient_folder in patient_folders:
+                with condition:
+                    condition.wait_for(can_load)
+                if stop.is_set():
+                    return
+                Progress.set_progress_stage(progress,
+                                            "load",
+                                            patient_folder,
+                                            )
+                patient = load_patient(input_folder_path,
+                                       patient_folder,
+                                       config,
+                                       decode_masks,
+                                       skip_study,
+                                       read_workers,
+                                       capture_errors,
+                                       segment_index,
+                                       )
+                Progress.set_progress_stage(progress,
+                                            None,
+                                            )
+                with condition:
+                    in_memory["count"] += 1
+                    in_memory["nbytes"] += patient["nbytes"]
+                loaded_patients.put(("patient", patient))
+        except BaseException as error:
+            loaded_patients.put(("error", error))
+        else:
+            loaded_patients.put(("done", None))
     
-    return ref_segs, comp_segs
+    thread = threading.Thread(target=producer,
+                              name="patient-prefetch",
+                              daemon=True,
+                              )
+    thread.start()
+    
+    try:
+        while True:
+            kind, item = loaded_patients.get()
+            if kind == "done":
+                break
+            elif kind == "error":
+                raise item
+            yield item
+            # The patient has been analysed, its memory can be reused.
+            with condition:
+                in_memory["count"] -= 1
+                in_memory["nbytes"] -= item["nbytes"]
+                condition.notify_all()
+    finally:
+        stop.set()
+        with condition:
+            condition.notify_all()
 
-def extract_hausdorff_dice(manual_segments,
-                           config,
-                           ct_folder_path,
-                           rtstruct_file_path,
-                           final_data
-                           ):
+def analyse_patient(patient,
+                    config,
+                    segment_index=None,
+                    interactive=True,
+                    previous_rows=None,
+                    progress=None,
+                    executor=None,
+                    ):
     """
-    Extracting Hausdorff distance, Dice similarity coefficient and
-    surface dice similarity coefficient for each segment.
-    The comparisons manual-MBS, manual-DL and MBS-DL are performed.
-    Extracted data are saved in the final_data list.
+    Computing the metrics of a loaded patient.
+    
+    The manual segments are found in the configuration file and all the
+    comparisons are performed.
 
     Parameters
     ----------
-    manual_segments : list
-        List of the manual segments.
+    patient : dict
+        Loaded patient (see load_patient).
     config : dict
         Dictionary containing lists of possible manual segments names.
-    ct_folder_path : str
-        Path to the folder where CT files will be stored.
-    rtstruct_file_path : str
-        Path to the RS.dcm file.
-    final_data: list
-        List containing the final data.
+    segment_index : dict, optional
+        Segments index created by compile_segment_index. If None (default)
+        it is created from config.
+    interactive : bool, optional
+        If True (default) the user is asked what to do with the unknown
+        segments, otherwise they are ignored.
+    previous_rows : dict, optional
+        Rows of the study in the previous results, whose metrics are kept if
+        the contours did not change (see previous_results).
+    progress : dict, optional
+        Progress created by Progress.create_progress, updated with the stages
+        and the comparisons of the patient.
+    executor : concurrent.futures.ProcessPoolExecutor, optional
+        Pool of processes computing the metrics, created by
+        create_metric_executor (see extract_hausdorff_dice).
 
     Returns
     -------
-    final_data: list
-        List containing the final data (updated)
+    rows : list
+        Results rows of the patient.
 
     """
-    # Extraction of patient ID and frame of reference UID.
-    patient_id = patient_info(rtstruct_file_path,
-                              "PatientID",
-                              )
-    frame_of_reference_uid = patient_info(rtstruct_file_path,
-                                          "FrameOfReferenceUID",
-                                          )
+    if segment_index is None:
+        segment_index = compile_segment_index(config)
     
-    # Reference and compared segments lists.
-    ref_segs, comp_segs = create_segments_matrices(manual_segments,
-                                                   config,
-                                                   )
+    # Creating the list of all segments of current patient.
+    all_segments = patient["patient_data"].get_roi_names()
     
+    # Creating manual segments list.
+    print("Creating the list of manual segments")
+    if interactive:
+        unknown_segments = find_unknown_segments(all_segments,
+                                                 config,
+                                                 segment_index,
+                                                 )
+        user_selection(unknown_segments,
+                       config,
+                       segment_index,
+                       )
+    manual_segments = extract_manual_segments(all_segments,
+                                              config,
+                                              segment_index,
+                                              )
     
     # Computing HD, DSC and SDSC for every segment in manual and MBS lists.
-    for methods in range(len(config["Compared methods"])):
-        print("Computing 95 percentile Hausdorff distance, Dice",
-              "similarity coefficient and surface Dice similarity",
-              f"coefficient between {config['Compared methods'][methods]}",
-              "segments",
-              )
-        
-        for segment in range(len(config["Alias names"])):
-            #Create binary labelmaps for reference and to compare segments.
-            ref_labelmap = create_labelmap(ct_folder_path,
-                                           rtstruct_file_path,
-                                           ref_segs[methods][segment],
-                                           )
-            comp_labelmap = create_labelmap(ct_folder_path,
-                                            rtstruct_file_path,
-                                            comp_segs[methods][segment],
-                                            )
-            
-            # Computing surface Dice similarity coefficient (sdsc), Dice
-            # similarity coefficient (dsc) and Hausdorff distance (hd).
-            sdsc, dsc, hd = compute_metrics(ref_labelmap,
-                                            comp_labelmap,
-                                            ct_folder_path,
-                                            )
-            
-            # Temporary list to store the current row of the final
-            # dataframe.
-            row = [patient_id,
-                   frame_of_reference_uid,
-                   config["Compared methods"][methods],
-                   ref_segs[methods][segment],
-                   comp_segs[methods][segment],
-                   config["Alias names"][segment],
-                   hd,
-                   dsc,
-                   sdsc,
-                   ]
-            
-            # Adding the constructed row to final_data.
-            final_data.append(row)
+    rows = extract_hausdorff_dice(manual_segments,
+                                  config,
+                                  patient["ct_folder_path"],
+                                  patient["rtstruct_file_path"],
+                                  [],
+                                  patient["patient_data"],
+                                  patient["labelmaps"],
+                                  previous_rows,
+                                  progress,
+                                  executor,
+                                  )
     
-    return final_data
+    return rows
 
-def move_patient_folder(new_folder_path,
-                        patient_folder_path,
-                        patient_folder,
-                        ):
+def patient_error(stage):
     """
-    If the user provided new_folder_path as argument, move already used patient
-    folders in the new folder.
+    Describing the error being handled while analysing a patient.
+    Must be called inside an except block.
+    
+    Parameters
+    ----------
+    stage : str
+        Stage of the analysis where the error was met (Ex. "prepare",
+        "header", "read", "masks", "metrics", "save" or "move").
+    
+    Returns
+    -------
+    error : dict
+        Stage ("stage"), last line of the error message ("message") and
+        whole traceback ("traceback").
+    
+    """
+    error_type, error_value, _ = sys.exc_info()
+    message = traceback.format_exception_only(error_type,
+                                              error_value,
+                                              )[-1].strip()
+    error = {"stage": stage,
+             "message": message,
+             "traceback": traceback.format_exc(),
+             }
+    PipelineMetrics.increment_metric("hd_dsc_failures_total",
+                                     labels={"stage": stage},
+                                     )
+    
+    return error
 
+def print_patient_error(patient_folder,
+                        error,
+                        attempt=1,
+                        ):
+    """
+    Logging the error met while analysing a patient.
+    
     Parameters
     ----------
-    new_folder_path : str
-        Path where patient folders will be moved after execution.
-    patient_folder_path : str
-        Path to the patient folder.
     patient_folder : str
         Name of the patient folder.
-
+    error : dict
+        Error created by patient_error.
+    attempt : int, optional
+        Number of the attempt that failed. Default is 1.
+    
     Returns
     -------
     None.
+    
+    """
+    print(f"Patient folder {patient_folder} failed at stage",
+          f"{error['stage']} (attempt {attempt}): {error['message']}",
+          )
+    print(error["traceback"])
 
+def error_row(patient_folder,
+              error,
+              attempts,
+              ):
     """
-    if not new_folder_path:
-        pass
-    else:
-        shutil.move(patient_folder_path,
-                    os.path.join(new_folder_path,
-                                 patient_folder,
-                                 ),
-                    )
-        print(f"{patient_folder} successfully moved to {new_folder_path}")
-        
-def save_config_data(config,
-                     new_config_path,
-                     ):
+    Creating the row of the errors table of a patient.
+    
+    Parameters
+    ----------
+    patient_folder : str
+        Name of the patient folder.
+    error : dict
+        Last error created by patient_error.
+    attempts : int
+        Number of attempts made to analyse the patient.
+    
+    Returns
+    -------
+    row : list
+        Row with the values of Results.ERRORS_COLUMNS.
+    
     """
-    Saving the updated configuration data into the new configuration file.
+    row = [patient_folder,
+           error["stage"],
+           error["message"],
+           attempts,
+           error["traceback"],
+           ]
+    
+    return row
 
+def errors_results_path(results_path):
+    """
+    Returning the path of the errors table written next to the results file.
+    
     Parameters
     ----------
-    config : dict
-        Content of the configuration file.
-    new_config_path : str
-        Path to the new configuration file.
-
+    results_path : str
+        Path to the results file (Ex. "path/to/results.xlsx").
+    
     Returns
     -------
-    None.
+    errors_path : str
+        Path to the errors table, in the same format of the results (Ex.
+        "path/to/results_errors.xlsx").
+    
+    """
+    root, extension = os.path.splitext(results_path)
+    
+    return f"{root}_errors{extension}"
 
+def save_patient_rows(rows,
+                      writer,
+                      previous_rows=None,
+                      updated_rows=None,
+                      aggregate=None,
+                      ):
     """
-    json_object = json.dumps(config,
-                             indent=4,
-                             )
-    with open(new_config_path, "w") as outfile:
-        outfile.write(json_object)
-        
-def load_existing_dataframe(excel_path):
+    Writing the results rows of a patient, or keeping them to replace its
+    previous rows, and updating the cohort statistics.
+    
+    Parameters
+    ----------
+    rows : list
+        Results rows of the patient.
+    writer : dict
+        Writer created by Results.open_results_writer.
+    previous_rows : dict, optional
+        Rows of the study in the previous results (see previous_results).
+    updated_rows : dict, optional
+        If given, rows are stored in it by (frame of reference UID, compared
+        methods, alias name) instead of being written, so that they can
+        replace the previous ones (see update_results).
+    aggregate : dict, optional
+        Cohort statistics (see Aggregate.create_aggregate) updated with the
+        rows, the previous rows they replace are removed from them.
+    
+    Returns
+    -------
+    None.
+    
     """
-    Loading existing dataframe or creating an empty new one.
+    if updated_rows is None:
+        Results.write_results(writer,
+                              rows,
+                              )
+    else:
+        # Frame of reference, compared methods and alias name.
+        for row in rows:
+            updated_rows[(row[1], row[2], row[5])] = row
+    if aggregate is not None:
+        replaced_rows = [previous_rows[(row[2], row[5])]
+                         for row in rows
+                         if (row[2], row[5]) in (previous_rows or {})
+                         ]
+        Aggregate.update_aggregate(aggregate,
+                                   [[row.get(column, np.nan)
+                                     for column in writer["columns"]]
+                                    for row in replaced_rows
+                                    ],
+                                   writer["columns"],
+                                   -1,
+                                   )
+        Aggregate.update_aggregate(aggregate,
+                                   rows,
+                                   writer["columns"],
+                                   )
 
+def process_patient(patient,
+                    config,
+                    writer,
+                    segment_index=None,
+                    new_folder_path=False,
+                    interactive=True,
+                    previous_rows=None,
+                    updated_rows=None,
+                    aggregate=None,
+                    progress=None,
+                    executor=None,
+                    ):
+    """
+    Analysing a loaded patient, writing its results and moving its folder.
+    
+    Errors (execution halts included) are returned instead of being raised,
+    so that the other patients can be analysed anyway. Folders of failed
+    patients are not moved. Stage durations, processed studies and
+    failures are added to the pipeline metrics.
+    
     Parameters
     ----------
-    excel_path : str
-        Path to the excel file where the old data are stored.
-
+    patient : dict
+        Loaded patient (see load_patient), its metrics are not computed if
+        its data were not loaded (Ex. already analysed study).
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    writer : dict
+        Writer created by Results.open_results_writer.
+    segment_index : dict, optional
+        Segments index created by compile_segment_index.
+    new_folder_path : str or bool, optional
+        Path where patient folders are moved after the analysis, False
+        (default) to leave them in the input folder.
+    interactive : bool, optional
+        If True (default) the user is asked what to do with the unknown
+        segments.
+    previous_rows : dict, optional
+        Rows of the study in the previous results (see previous_results).
+    updated_rows : dict, optional
+        If given, rows are stored in it by (frame of reference UID, compared
+        methods, alias name) instead of being written, so that they can
+        replace the previous ones (see update_results).
+    aggregate : dict, optional
+        Cohort statistics (see Aggregate.create_aggregate) updated with the
+        rows of the patient, the previous rows they replace are removed from
+        them.
+    progress : dict, optional
+        Progress created by Progress.create_progress, updated with the stages
+        of the patient.
+    executor : concurrent.futures.ProcessPoolExecutor, optional
+        Pool of processes computing the metrics, created by
+        create_metric_executor (see extract_hausdorff_dice).
+    
     Returns
     -------
-    old_data : DataFrame
-        Dataframe of the data contained in the excel file (if the excel file
-        does not exist it is an empty dataframe).
-
+    error : dict or None
+        Error met while loading or analysing the patient (see
+        patient_error), None if there was not one.
+    
     """
+    if patient["error"] is not None:
+        return patient["error"]
+    
+    # Every stage is timed until the next one starts.
+    stage = "metrics"
+    stage_start = time.perf_counter()
+    Progress.set_progress_stage(progress,
+                                stage,
+                                patient["patient_folder"],
+                                )
     try:
-        # loading existing data.
-        old_data = pd.read_excel(excel_path)
-        print(f"Successfully loaded {excel_path}")
-    except FileNotFoundError:
-        # There is not an existing excel file in excel path.
-        print(f"Failed to load {excel_path}, a new file will be created")
-        old_data = pd.DataFrame()
+        # Computing HD, DSC and SDSC for every segment in manual and
+        # automatic lists.
+        if patient["patient_data"] is not None:
+            rows = analyse_patient(patient,
+                                   config,
+                                   segment_index,
+                                   interactive,
+                                   previous_rows,
+                                   progress,
+                                   executor,
+                                   )
+            PipelineMetrics.record_stage(None,
+                                         stage,
+                                         time.perf_counter() - stage_start,
+                                         )
+            stage = "save"
+            stage_start = time.perf_counter()
+            Progress.set_progress_stage(progress,
+                                        stage,
+                                        patient["patient_folder"],
+                                        )
+            save_patient_rows(rows,
+                              writer,
+                              previous_rows,
+                              updated_rows,
+                              aggregate,
+                              )
+            PipelineMetrics.record_stage(None,
+                                         stage,
+                                         time.perf_counter() - stage_start,
+                                         )
+        
+        # Moving patient folder to a different location, if the destination
+        # folder does not exist it will be automatically created.
+        stage = "move"
+        stage_start = time.perf_counter()
+        Progress.set_progress_stage(progress,
+                                    stage,
+                                    patient["patient_folder"],
+                                    )
+        move_patient_folder(new_folder_path,
+                            patient["patient_folder_path"],
+                            patient["patient_folder"],
+                            )
+        PipelineMetrics.record_stage(None,
+                                     stage,
+                                     time.perf_counter() - stage_start,
+                                     )
+    except (Exception, SystemExit):
+        return patient_error(stage)
     
-    return old_data
+    # Studies already in the results are not analysed again.
+    if patient["patient_data"] is not None:
+        PipelineMetrics.increment_metric("hd_dsc_studies_processed_total")
+    else:
+        PipelineMetrics.increment_metric("hd_dsc_studies_skipped_total")
+    
+    return None
 
-def concatenate_data(old_data,
-                     new_data,
-                     ):
+def locate_patient_files(patient_folder_path):
     """
-    Concatenating old and new data in a single dataframe.
-
+    Finding the CT files and the RTSTRUCT file of a patient without moving
+    them.
+    
+    Files are taken from the CT and RTSTRUCT folders if both have files in
+    them, otherwise from the CT and RS files of the patient folder, as
+    fill_ct_rtstruct_folders would do.
+    
     Parameters
     ----------
-    old_data : DataFrame
-        Dataframe contained in the excel file (if there is not an excel file
-        it is an empty dataframe).
-    new_data : DataFrame
-        Dataframe of the new acquired data.
-
+    patient_folder_path : str
+        Path to the patient folder.
+    
     Returns
     -------
-    new_data : DataFrame
-        Dataframe of the merged data.
-
+    ct_file_paths : list
+        Paths to the CT files.
+    rtstruct_file_path : str or None
+        Path to the RS.dcm file, None if there is not one.
+    
     """
-    frames = [old_data,
-              new_data,
-              ]
-    new_data = pd.concat(frames,
-                         ignore_index=True,
-                         )
-    print("Old and new dataframe concatenated")
+    ct_folder_path = os.path.join(patient_folder_path,
+                                  "CT",
+                                  )
+    rtstruct_folder_path = os.path.join(patient_folder_path,
+                                        "RTSTRUCT",
+                                        )
+    if (os.path.isdir(ct_folder_path) and os.path.isdir(rtstruct_folder_path)
+        and not (is_empty(ct_folder_path) or is_empty(rtstruct_folder_path))):
+        ct_file_paths = [os.path.join(ct_folder_path,
+                                      file,
+                                      )
+                         for file in os.listdir(ct_folder_path)
+                         ]
+        rtstruct_file_path = extract_rtstruct_file_path(rtstruct_folder_path)
+        return ct_file_paths, rtstruct_file_path
     
-    return new_data
+    # Files that would be moved in the CT and RTSTRUCT folders.
+    ct_file_paths = []
+    rtstruct_file_path = None
+    for file in os.listdir(patient_folder_path):
+        file_path = os.path.join(patient_folder_path,
+                                 file,
+                                 )
+        if not os.path.isfile(file_path):
+            continue
+        if file.startswith("CT"):
+            ct_file_paths.append(file_path)
+        elif file.startswith("RS"):
+            rtstruct_file_path = file_path
+    
+    return ct_file_paths, rtstruct_file_path
 
-def check_study(old_data,
-                frame_of_reference_uid,
-                patient_id,
-                ):
+def plan_patient(input_folder_path,
+                 patient_folder,
+                 config,
+                 segment_index=None,
+                 skip_study=None,
+                 ):
     """
-    Checking if the current patient has been already analysed.
-
+    Finding the work needed to analyse a patient, without moving files and
+    without computing metrics.
+    
+    Only the RTSTRUCT file and the header of one CT file are read. The
+    cost is estimated as the number of voxels rasterized (every segment used
+    by a comparison is rasterized once on the CT grid) and the number of
+    comparisons.
+    
     Parameters
     ----------
-    old_data : DataFrame
-        Dataframe contained in the excel file (if there is not an excel file
-        it is an empty dataframe).
-    frame_of_reference_uid : pydicom.uid.UID
-        Code of the current patient.
-    patient_id : str
-        Name of the anlysed patient.
-
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    patient_folder : str
+        Name of the patient folder.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    segment_index : dict, optional
+        Segments index created by compile_segment_index. If None (default)
+        it is created from config.
+    skip_study : callable, optional
+        Function taking patient ID, frame of reference UID and RTSTRUCT
+        dataset and returning True if the study is already in the results.
+    
     Returns
     -------
-    frame_uid_in_old_data : bool
-        Flag to know if the current patient study is already in the dataframe.
+    plan : dict
+        Patient folder, patient ID, frame of reference UID, CT grid
+        ("grid", columns x rows x slices), matched segments by alias name
+        ("matched"), unknown segments ("unknown"), segments used by the
+        comparisons but missing in the RTSTRUCT file ("missing", "<alias
+        name> (manual)" if there is no manual segment), whether the study is
+        already in the results ("in_results"), number of rasterized segments
+        ("n_masks") and voxels ("n_voxels"), number of comparisons that are
+        not skipped ("n_comparisons") and the reason why the patient can not
+        be analysed ("error", None if it can).
+    
+    """
+    import pydicom
+    
+    if segment_index is None:
+        segment_index = compile_segment_index(config)
+    
+    plan = {"patient_folder": patient_folder,
+            "patient_id": None,
+            "frame_of_reference_uid": None,
+            "grid": None,
+            "matched": {},
+            "unknown": [],
+            "missing": [],
+            "in_results": False,
+            "n_masks": 0,
+            "n_voxels": 0,
+            "n_comparisons": 0,
+            "error": None,
+            }
+    
+    patient_folder_path = os.path.join(input_folder_path,
+                                       patient_folder,
+                                       )
+    ct_file_paths, rtstruct_file_path = locate_patient_files(
+        patient_folder_path,
+        )
+    if rtstruct_file_path is None or not ct_file_paths:
+        plan["error"] = "CT or RTSTRUCT files not found"
+        return plan
+    
+    # The RTSTRUCT file is read once, its contours are decoded only if
+    # the study is in the results and their fingerprints are needed.
+    rtstruct_dataset = read_rtstruct(rtstruct_file_path)
+    header = rtstruct_metadata(rtstruct_dataset)
+    plan["patient_id"] = header["patient_id"]
+    plan["frame_of_reference_uid"] = header["frame_of_reference_uid"]
+    if skip_study is not None and skip_study(plan["patient_id"],
+                                             plan["frame_of_reference_uid"],
+                                             rtstruct_dataset,
+                                             ):
+        plan["in_results"] = True
+        return plan
+    
+    # Labelmaps have the grid of the CT series.
+    ct_header = pydicom.dcmread(ct_file_paths[0],
+                                force=True,
+                                stop_before_pixels=True,
+                                )
+    plan["grid"] = (int(ct_header.Columns),
+                    int(ct_header.Rows),
+                    len(ct_file_paths),
+                    )
+    
+    # Segments are matched as analyse_patient would do.
+    all_segments = header["roi_names"]
+    plan["unknown"] = find_unknown_segments(all_segments,
+                                            config,
+                                            segment_index,
+                                            )
+    manual_segments = extract_manual_segments(all_segments,
+                                              config,
+                                              segment_index,
+                                              )
+    ref_segs, comp_segs = create_segments_matrices(manual_segments,
+                                                   config,
+                                                   )
+    masks = []
+    for segment, alias_name in enumerate(config["Alias names"]):
+        plan["matched"][alias_name] = []
+        for methods in range(len(ref_segs)):
+            pair = (ref_segs[methods][segment],
+                    comp_segs[methods][segment],
+                    )
+            for segment_name in pair:
+                if segment_name is None:
+                    segment_name = f"{alias_name} (manual)"
+                if segment_name not in all_segments:
+                    if segment_name not in plan["missing"]:
+                        plan["missing"].append(segment_name)
+                elif segment_name not in masks:
+                    masks.append(segment_name)
+                    plan["matched"][alias_name].append(segment_name)
+            # Comparisons with absent segments are skipped.
+            if all(segment_name in all_segments for segment_name in pair):
+                plan["n_comparisons"] += 1
+    plan["n_masks"] = len(masks)
+    plan["n_voxels"] = plan["n_masks"] * int(np.prod(plan["grid"]))
+    
+    return plan
 
+def print_plan(plans):
     """
-    for frame_of_reference in old_data.loc[:,"Frame of reference"]:
-        if frame_of_reference == frame_of_reference_uid:
-            print(f"Study {frame_of_reference} of patient",
-                  f"{patient_id} is alreday in the dataframe,",
-                  "going to the next one",
-                  )
-            frame_uid_in_old_data = True
-            break
-        else:
-            frame_uid_in_old_data = False
+    Printing the work to do for every patient and the total estimated cost.
+    
+    Parameters
+    ----------
+    plans : list
+        Plans of the patients (see plan_patient).
+    
+    Returns
+    -------
+    totals : dict
+        Number of patients to analyse ("to_analyse"), already in the results
+        ("in_results") and that can not be analysed ("errors"), total number
+        of rasterized voxels ("n_voxels") and of comparisons
+        ("n_comparisons").
+    
+    """
+    totals = {"to_analyse": 0,
+              "in_results": 0,
+              "errors": 0,
+              "n_voxels": 0,
+              "n_comparisons": 0,
+              }
+    for plan in plans:
+        print(f"Patient folder {plan['patient_folder']}:")
+        if plan["error"] is not None:
+            print(f"    {plan['error']}")
+            totals["errors"] += 1
+            continue
+        print(f"    Patient ID {plan['patient_id']}, study",
+              f"{plan['frame_of_reference_uid']}",
+              )
+        if plan["in_results"]:
+            print("    Already in the results, it will be skipped")
+            totals["in_results"] += 1
+            continue
+        print(f"    CT grid {' x '.join(map(str, plan['grid']))}")
+        for alias_name, names in plan["matched"].items():
+            print(f"    {alias_name}: {', '.join(names) or 'none'}")
+        print(f"    Unknown ROIs: {', '.join(plan['unknown']) or 'none'}")
+        if plan["missing"]:
+            print(f"    Missing ROIs: {', '.join(map(str, plan['missing']))}")
+        print(f"    {plan['n_masks']} masks ({plan['n_voxels']:,} voxels) to",
+              f"rasterize, {plan['n_comparisons']} comparisons",
+              )
+        totals["to_analyse"] += 1
+        totals["n_voxels"] += plan["n_voxels"]
+        totals["n_comparisons"] += plan["n_comparisons"]
+    
+    print(f"{totals['to_analyse']} studies to analyse,",
+          f"{totals['in_results']} already in the results,",
+          f"{totals['errors']} that can not be analysed",
+          )
+    print(f"Estimated cost: {totals['n_voxels']:,} voxels to rasterize,",
+          f"{totals['n_comparisons']} comparisons",
+          )
     
-    return frame_uid_in_old_data
\ No newline at end of file
+    return totals
@@ -1,10 +1,15 @@
 import argparse
 import sys
 import os
-
-import pandas as pd
+import itertools
+import functools
 
 import HD_DSC
+import Aggregate
+import PipelineMetrics
+import Progress
+import Results
+import WorkQueue
 
 
 def main(argv):
@@ -45,11 +50,12 @@ def main(argv):
                               )
                         )
     parser.add_argument(dest="excel_path",
-                        metavar="excel_path",
+                        metavar="results_path",
                         default=None,
-                        help=("""Path to the .xlsx file where data will be 
-                              stored (if it is not already there it will be
-                              automatically created)"""
+                        help=("""Path to the .xlsx, .csv, .parquet or
+                              .feather file where data will be stored (if it
+                              is not already there it will be automatically
+                              created)"""
                               )
                         ) 
     parser.add_argument("-n", "--new-folder",
@@ -71,6 +77,206 @@ def main(argv):
                               )
                         )
     
+    parser.add_argument("-p", "--prefetch",
+                        dest="prefetch_depth",
+                        metavar="N",
+                        type=int,
+                        default=1,
+                        required=False,
+                        help=("""Number of patients loaded in background
+                              while the current one is analysed (0 to
+                              disable prefetching)"""
+                              )
+                        )
+    parser.add_argument("--prefetch-memory",
+                        dest="max_prefetch_mb",
+                        metavar="MB",
+                        type=float,
+                        default=None,
+                        required=False,
+                        help=("""Maximum memory in megabytes used by loaded
+                              patients, no patient is prefetched above it"""
+                              )
+                        )
+    parser.add_argument("--prefetch-masks",
+                        dest="prefetch_masks",
+                        action="store_true",
+                        required=False,
+                        help=("""Create the labelmaps of the known segments
+                              while prefetching patients"""
+                              )
+                        )
+    parser.add_argument("-w", "--read-workers",
+                        dest="read_workers",
+                        metavar="N",
+                        type=int,
+                        default=None,
+                        required=False,
+                        help=("""Number of DICOM files read at the same time
+                              (default chosen by the thread pool)"""
+                              )
+                        )
+    parser.add_argument("--chunk-size",
+                        dest="chunk_size",
+                        metavar="N",
+                        type=int,
+                        default=1000,
+                        required=False,
+                        help=("""Number of result rows written to the results
+                              file at once"""
+                              )
+                        )
+    parser.add_argument("--queue",
+                        dest="queue_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the SQLite work queue shared by the
+                              nodes, enables coordinator/worker execution"""
+                              )
+                        )
+    parser.add_argument("--role",
+                        dest="role",
+                        choices=["coordinator", "worker"],
+                        default="coordinator",
+                        required=False,
+                        help=("""With --queue, coordinator enqueues patients,
+                              waits for the workers and saves their results,
+                              worker analyses patients claimed from the
+                              queue"""
+                              )
+                        )
+    parser.add_argument("--workers",
+                        dest="n_workers",
+                        metavar="N",
+                        type=int,
+                        default=0,
+                        required=False,
+                        help=("""Number of worker processes started on this
+                              machine by the coordinator"""
+                              )
+                        )
+    parser.add_argument("--lease",
+                        dest="lease_seconds",
+                        metavar="SECONDS",
+                        type=float,
+                        default=600,
+                        required=False,
+                        help=("""Duration of the claims of the workers, claims
+                              of crashed workers expire after it"""
+                              )
+                        )
+    parser.add_argument("--retries",
+                        dest="retries",
+                        metavar="N",
+                        type=int,
+                        default=0,
+                        required=False,
+                        help=("""Number of times patients that fail are
+                              analysed again, after the other patients"""
+                              )
+                        )
+    parser.add_argument("--depth",
+                        dest="max_depth",
+                        metavar="N",
+                        type=int,
+                        default=1,
+                        required=False,
+                        help=("""Number of folder levels searched for patient
+                              folders (Ex. 3 for year/month/patient)"""
+                              )
+                        )
+    parser.add_argument("--include",
+                        dest="include",
+                        metavar="GLOB",
+                        action="append",
+                        default=None,
+                        required=False,
+                        help=("""Glob pattern of the relative paths of the
+                              patient folders to analyse (can be repeated)"""
+                              )
+                        )
+    parser.add_argument("--exclude",
+                        dest="exclude",
+                        metavar="GLOB",
+                        action="append",
+                        default=None,
+                        required=False,
+                        help=("""Glob pattern of the relative paths of the
+                              folders to skip (can be repeated)"""
+                              )
+                        )
+    parser.add_argument("--discovery-state",
+                        dest="discovery_state_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the json file where the last
+                              processed patient folder is recorded, a new
+                              execution continues the search of patient
+                              folders after it"""
+                              )
+                        )
+    parser.add_argument("--progress-bar",
+                        dest="progress_bar",
+                        action="store_true",
+                        required=False,
+                        help=("""Show a live progress bar with patients per
+                              minute, comparisons per second, remaining time
+                              and current stage of every worker"""
+                              )
+                        )
+    parser.add_argument("--progress-json",
+                        dest="progress_json_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the file where the progress is
+                              appended as JSON lines"""
+                              )
+                        )
+    parser.add_argument("--progress-interval",
+                        dest="progress_interval",
+                        metavar="SECONDS",
+                        type=float,
+                        default=1.0,
+                        required=False,
+                        help=("""Minimum time in seconds between two progress
+                              reports, completed patients are always
+                              reported"""
+                              )
+                        )
+    parser.add_argument("--metrics-textfile",
+                        dest="metrics_textfile_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the .prom file where pipeline
+                              metrics are written in the Prometheus text
+                              format after every patient (for the textfile
+                              collector of node_exporter)"""
+                              )
+                        )
+    parser.add_argument("--metrics-port",
+                        dest="metrics_port",
+                        metavar="PORT",
+                        type=int,
+                        default=None,
+                        required=False,
+                        help=("""Local port where pipeline metrics are served
+                              at /metrics in the Prometheus text format"""
+                              )
+                        )
+    parser.add_argument("--plan",
+                        dest="plan",
+                        action="store_true",
+                        required=False,
+                        help=("""Only report the studies, their matched and
+                              unknown ROIs and the estimated cost, without
+                              moving files or computing metrics"""
+                              )
+                        )
+    
     args = parser.parse_args(argv)
     
     # To better separate input from output messages
@@ -91,259 +297,351 @@ def main(argv):
     # Opening the json file where the lists of names are stored.
     config = HD_DSC.read_config(config_path)
     
-    # List where final data will be stored.
-    final_data = []
+    # Index of the segment names, created once for all patients.
+    segment_index = HD_DSC.compile_segment_index(config)
+    
+    # Pipeline metrics are served while patients are analysed and written
+    # after every patient.
+    if args.metrics_port is not None:
+        metrics_server = PipelineMetrics.start_metrics_server(
+            args.metrics_port,
+            )
+        print("Pipeline metrics served on",
+              f"http://127.0.0.1:{metrics_server.server_port}/metrics",
+              )
+    if args.metrics_textfile_path is not None:
+        metrics_textfile_path = args.metrics_textfile_path.replace("\\", "/")
+    else:
+        metrics_textfile_path = None
+    
+    # Workers write their results next to the work queue.
+    if args.queue_path is not None:
+        queue_path = args.queue_path.replace("\\", "/")
+        results_folder_path = os.path.splitext(queue_path)[0] + "_results"
+    
+    # Workers analyse the patients of the queue and exit. With join_data,
+    # studies already in the results are skipped as the coordinator does.
+    if args.queue_path is not None and args.role == "worker":
+        old_data = (HD_DSC.load_existing_dataframe(excel_path)
+                    if join_data else None)
+        WorkQueue.run_worker(queue_path,
+                             input_folder_path,
+                             config,
+                             results_folder_path,
+                             lease_seconds=args.lease_seconds,
+                             new_folder_path=new_folder_path,
+                             read_workers=args.read_workers,
+                             old_data=old_data,
+                             )
+        if metrics_textfile_path is not None:
+            PipelineMetrics.write_metrics_textfile(metrics_textfile_path)
+        print("Execution successfully ended")
+        return
     
     # Input folder can not be empty.
     HD_DSC.exit_if_empty(input_folder_path)
     
+    # Patient folders are searched while patients are analysed, after the
+    # last one processed by the previous execution.
+    if args.discovery_state_path is not None:
+        discovery_state_path = args.discovery_state_path.replace("\\", "/")
+        resume_after = HD_DSC.read_discovery_progress(discovery_state_path)
+        if resume_after is not None:
+            print(f"Continuing after patient folder {resume_after}")
+    else:
+        resume_after = None
+    patient_folders = HD_DSC.discover_patients(input_folder_path,
+                                               args.max_depth,
+                                               args.include,
+                                               args.exclude,
+                                               resume_after,
+                                               )
+    
     # Input folder must contain patient folders, not directly .dcm files.
-    patient_folders = HD_DSC.store_patients(input_folder_path)   
+    first_patient_folder = next(patient_folders, None)
     HD_DSC.exit_if_no_patients(input_folder_path,
-                               patient_folders,
+                               [first_patient_folder]
+                               if first_patient_folder is not None else [],
                                )
+    patient_folders = itertools.chain([first_patient_folder],
+                                      patient_folders,
+                                      )
     # If join_data is True, old data will be extracted from excel_path,
     # otherwise the old excel file will be overwritten.
+    # pandas is imported only here, so that argument errors and --help are
+    # fast.
+    import pandas as pd
+    
     if join_data:
         old_data = HD_DSC.load_existing_dataframe(excel_path)
-        
-        for patient_folder in patient_folders:
-            patient_folder_path = os.path.join(input_folder_path,
-                                               patient_folder,
-                                               )
-            
-            # Patient folder can not be empty.
-            HD_DSC.exit_if_empty(patient_folder_path)
-            
-            # RTSTRUCT and CT series should be in different folders.
-            # Creating RTSTRUCT folder if it is not already present, otherwise
-            # going on with the execution.
-            rtstruct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                        "RTSTRUCT",
-                                                        )
-            
-            # Creating CT folder if it is not already present, otherwise
-            # going on with the execution.
-            ct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                  "CT",
-                                                  )
-            
-            # Filling CT and RTSTRUCT folders if both empty
-            HD_DSC.fill_ct_rtstruct_folders(patient_folder_path,
-                                            ct_folder_path,
-                                            rtstruct_folder_path,
-                                            )
-            
-            # If RTSTRUCT or CT folders are still empty there are no data.
-            HD_DSC.exit_if_empty(rtstruct_folder_path)
-            HD_DSC.exit_if_empty(ct_folder_path)
-            
-            # Extracting rtstruct file path.
-            rtstruct_file_path = HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
-                
-            # Extraction of patient ID and frame of reference UID.
-            patient_id = HD_DSC.patient_info(rtstruct_file_path,
-                                             "PatientID",
+    else:
+        if not args.plan:
+            print(f"Results file at {excel_path} will be overwritten if",
+                  "already present, otherwise it will be created.",
+                  )
+        old_data = pd.DataFrame()
+    
+    # Studies already in the results are skipped, unless their contours
+    # were edited.
+    skip_study = functools.partial(HD_DSC.skip_analysed_study,
+                                   old_data,
+                                   )
+    
+    # Dry run: nothing is moved, computed or saved.
+    if args.plan:
+        plans = [HD_DSC.plan_patient(input_folder_path,
+                                     patient_folder,
+                                     config,
+                                     segment_index,
+                                     skip_study,
+                                     )
+                 for patient_folder in patient_folders
+                 ]
+        HD_DSC.print_plan(plans)
+        return
+    
+    # Results are written in chunks while patients are analysed, old data are
+    # written last if they must be kept, with the rows of the edited segments
+    # updated in place.
+    categories = {"Compared methods": config["Compared methods"],
+                  "Alias name": config["Alias names"],
+                  }
+    writer = Results.open_results_writer(excel_path,
+                                         HD_DSC.results_columns(config),
+                                         chunk_size=args.chunk_size,
+                                         categories=categories,
+                                         )
+    updated_rows = {}
+    
+    # Cohort statistics are updated only with the new rows, the previous ones
+    # are read from their file (or from the previous results, the first
+    # time).
+    aggregate_path = Aggregate.aggregate_state_path(excel_path)
+    aggregate = None
+    if join_data:
+        aggregate = Aggregate.load_aggregate(aggregate_path,
+                                             config,
                                              )
-            frame_of_reference_uid = HD_DSC.patient_info(rtstruct_file_path,
-                                                         "FrameOfReferenceUID",
+    if aggregate is None:
+        aggregate = Aggregate.create_aggregate(config)
+        if join_data and not old_data.empty:
+            old_rows = old_data.reindex(columns=writer["columns"])
+            Aggregate.update_aggregate(aggregate,
+                                       old_rows.values.tolist(),
+                                       writer["columns"],
+                                       )
+    
+    # Patient folders are counted while they are found, the remaining time
+    # is estimated from the folders found so far.
+    if args.progress_bar or args.progress_json_path is not None:
+        progress = Progress.create_progress(
+            None,
+            (args.progress_json_path.replace("\\", "/")
+             if args.progress_json_path is not None else None),
+            args.progress_bar,
+            args.progress_interval,
+            )
+        patient_folders = Progress.discovered_patients(progress,
+                                                       patient_folders,
+                                                       )
+    else:
+        progress = None
+    
+    processed_folders = []
+    interrupted = False
+    failed_patients = {}
+    if args.queue_path is not None:
+        # Patients are analysed by the workers, on this machine and on other
+        # nodes sharing the queue. Studies already in the results are not
+        # queued, unless their contours were edited.
+        queued_folders = list(WorkQueue.studies_to_analyse(input_folder_path,
+                                                           patient_folders,
+                                                           skip_study,
+                                                           new_folder_path,
+                                                           ))
+        n_added = WorkQueue.enqueue_patients(queue_path,
+                                             queued_folders,
+                                             )
+        print(f"{n_added} patients added to the work queue {queue_path}")
+        processes = WorkQueue.start_local_workers(
+            args.n_workers,
+            queue_path,
+            input_folder_path,
+            config,
+            results_folder_path,
+            lease_seconds=args.lease_seconds,
+            new_folder_path=new_folder_path,
+            read_workers=args.read_workers,
+            old_data=old_data if join_data else None,
+            )
+        WorkQueue.wait_for_queue(queue_path,
+                                 progress=progress,
+                                 )
+        for process in processes:
+            process.join()
+        
+        # Collecting the results written by the workers for the patients of
+        # this execution, rows of studies in the results replace the old
+        # ones. Failed patients are saved in the errors table.
+        failed_patients = WorkQueue.merge_worker_results(queue_path,
+                                                         results_folder_path,
+                                                         writer,
+                                                         aggregate,
+                                                         queued_folders,
+                                                         old_data,
+                                                         updated_rows,
                                                          )
-            
-            print(f"Starting patient {patient_id} analysis")
-            
-            # If the current frame of reference is already in the excel file
-            # we can move to the next one.
+    else:
+        # Next patients are loaded in background while the current one is
+        # analysed. Patients that fail are retried after the others.
+        folders_to_analyse = patient_folders
+        
+        # Metrics of all the patients are computed by the same pool of
+        # processes, started once for the run.
+        executor = HD_DSC.create_metric_executor(config)
+        for attempt in range(1, args.retries + 2):
+            patients = HD_DSC.prefetch_patients(input_folder_path,
+                                                folders_to_analyse,
+                                                args.prefetch_depth,
+                                                args.max_prefetch_mb,
+                                                config,
+                                                args.prefetch_masks,
+                                                skip_study,
+                                                args.read_workers,
+                                                capture_errors=True,
+                                                progress=progress,
+                                                )
+            failed_folders = []
             try:
-                frame_uid_in_old_data = HD_DSC.check_study(old_data,
-                                                           frame_of_reference_uid,
-                                                           patient_id,
-                                                           )
-                if frame_uid_in_old_data:
-                    # Moving patient folder to a different location if the
-                    # destination folder does not exist it will be
-                    # automatically created.
-                    HD_DSC.move_patient_folder(new_folder_path,
-                                               patient_folder_path,
-                                               patient_folder,
-                                               )
-                    continue
-            except KeyError:
-                pass
+                for patient in patients:
+                    patient_folder = patient["patient_folder"]
+                    print(f"Starting patient {patient_folder} analysis")
                     
-            # Creating the list of all segments of current patient.
-            all_segments = HD_DSC.extract_all_segments(ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       )
-            
-            # Creating manual segments list.
-            print("Creating the list of manual segments")
-            unknown_segments = HD_DSC.find_unknown_segments(all_segments,
-                                                            config,
-                                                            )
-            HD_DSC.user_selection(unknown_segments,
-                                  config,
-                                  )
-            manual_segments = HD_DSC.extract_manual_segments(all_segments,
-                                                             config,
-                                                             )
-            
-            # Computing HD, DSC and SDSC for every segment in manual and MBS
-            # lists.
-            final_data = HD_DSC.extract_hausdorff_dice(manual_segments,
-                                                       config,
-                                                       ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       final_data,
-                                                       )
+                    # Rows of studies already in the results replace the
+                    # previous ones.
+                    previous_rows = HD_DSC.previous_results(
+                        old_data,
+                        patient["frame_of_reference_uid"],
+                        )
+                    
+                    # Errors of a patient do not stop the others.
+                    error = HD_DSC.process_patient(patient,
+                                                   config,
+                                                   writer,
+                                                   segment_index,
+                                                   new_folder_path,
+                                                   previous_rows=previous_rows,
+                                                   updated_rows=(
+                                                       updated_rows
+                                                       if previous_rows
+                                                       else None),
+                                                   aggregate=aggregate,
+                                                   progress=progress,
+                                                   executor=executor,
+                                                   )
+                    if error is not None:
+                        HD_DSC.print_patient_error(patient_folder,
+                                                   error,
+                                                   attempt,
+                                                   )
+                        failed_patients[patient_folder] = HD_DSC.error_row(
+                            patient_folder,
+                            error,
+                            attempt,
+                            )
+                        failed_folders.append(patient_folder)
+                    else:
+                        failed_patients.pop(patient_folder, None)
+                    
+                    # Patients retried successfully are no longer failed.
+                    Progress.set_progress_stage(progress,
+                                                None,
+                                                )
+                    Progress.add_progress(progress,
+                                          patients=int(error is None),
+                                          failed=(int(error is not None)
+                                                  if attempt == 1
+                                                  else -int(error is None)),
+                                          )
+                    if metrics_textfile_path is not None:
+                        PipelineMetrics.write_metrics_textfile(
+                            metrics_textfile_path,
+                            )
+                    if attempt == 1:
+                        processed_folders.append(patient_folder)
+            except KeyboardInterrupt:
+                # Results of the analysed patients are saved anyway.
+                patients.close()
+                interrupted = True
+                print("Execution interrupted, saving the analysed patients")
+                break
             
-            # Moving patient folder to a different location, if the destination
-            # folder does not exist it will be automatically created.
-            HD_DSC.move_patient_folder(new_folder_path,
-                                       patient_folder_path,
-                                       patient_folder,
-                                       )
+            if not failed_folders or attempt > args.retries:
+                break
+            print(f"Retrying {len(failed_folders)} failed patients")
+            folders_to_analyse = failed_folders
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    Progress.close_progress(progress)
 
-        # Creating the dataframe
-        new_data = pd.DataFrame(final_data,
-                                columns=["Patient ID",
-                                         "Frame of reference",
-                                         "Compared methods",
-                                         "Reference segment name",
-                                         "Compared segment name",
-                                         "Alias name",
-                                         "95% Hausdorff distance (mm)",
-                                         "Volumetric Dice similarity coefficient",
-                                         "Surface Dice similarity coefficient",
-                                         ],
-                                )
-        
-        # Concatenating old and new dataframes.
-        new_data = HD_DSC.concatenate_data(old_data,
-                                           new_data,
-                                           )
-        
-        # Saving dataframe to excel.
-        print("Saving data")
-        new_data.to_excel(excel_path,
-                          sheet_name="Data",
-                          index=False,
-                          )
-        
-        # Saving configuration data.
-        HD_DSC.save_config_data(config,
-                                new_config_path,
-                                )
-        
-        print("Execution successfully ended")
+    # Saving the remaining data.
+    print("Saving data")
+    if join_data and not old_data.empty:
+        Results.write_results(writer,
+                              HD_DSC.update_results(old_data,
+                                                    updated_rows,
+                                                    writer["columns"],
+                                                    ),
+                              )
+    Results.close_results_writer(writer)
     
-    else:
-        print(f"Excel file at {excel_path} will be overwritten if already",
-              "present, otherwise it will be created.",
+    # Summary of the whole cohort, per compared methods and alias name.
+    summary_path = Aggregate.summary_results_path(excel_path)
+    Aggregate.save_aggregate(aggregate,
+                             aggregate_path,
+                             )
+    Aggregate.write_summary(aggregate,
+                            summary_path,
+                            )
+    print(f"Cohort summary saved in {summary_path}")
+    
+    # Patients that could not be analysed are saved in the errors table.
+    if failed_patients:
+        errors_path = HD_DSC.errors_results_path(excel_path)
+        print(f"{len(failed_patients)} patients could not be analysed, see",
+              f"{errors_path}",
               )
-        
-        for patient_folder in patient_folders:
-            patient_folder_path = os.path.join(input_folder_path,
-                                               patient_folder,
-                                               )
-            
-            # Patient folder can not be empty.
-            HD_DSC.exit_if_empty(patient_folder_path)
-            
-            # RTSTRUCT and CT series should be in different folders.
-            # Creating RTSTRUCT folder if it is not already present, otherwise
-            # going on with the execution.
-            rtstruct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                        "RTSTRUCT",
+        errors_writer = Results.open_results_writer(errors_path,
+                                                    Results.ERRORS_COLUMNS,
+                                                    )
+        Results.write_results(errors_writer,
+                              list(failed_patients.values()),
+                              )
+        Results.close_results_writer(errors_writer)
+    
+    # Saving configuration data.
+    HD_DSC.save_config_data(config,
+                            new_config_path,
+                            )
+    
+    # Next execution continues the discovery after the last patient folder
+    # of the patients all analysed, so that failed patients are found again.
+    last_patient_folder = HD_DSC.discovery_resume_point(processed_folders,
+                                                        failed_patients,
                                                         )
-            
-            # Creating CT folder if it is not already present, otherwise
-            # going on with the execution.
-            ct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                  "CT",
-                                                  )
-            
-            # Filling CT and RTSTRUCT folders if both empty
-            HD_DSC.fill_ct_rtstruct_folders(patient_folder_path,
-                                            ct_folder_path,
-                                            rtstruct_folder_path,
-                                            )
-            
-            # If RTSTRUCT or CT folders are still empty there are no data.
-            HD_DSC.exit_if_empty(rtstruct_folder_path)
-            HD_DSC.exit_if_empty(ct_folder_path)
-            
-            # Extracting rtstruct file path.
-            rtstruct_file_path = HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
-                
-            # Extraction of patient ID and frame of reference UID.
-            patient_id = HD_DSC.patient_info(rtstruct_file_path,
-                                             "PatientID",
-                                             )
-            frame_of_reference_uid = HD_DSC.patient_info(rtstruct_file_path,
-                                                         "FrameOfReferenceUID",
-                                                         )
-            
-            print(f"Starting patient {patient_id} analysis")
-        
-            # Creating the list of all segments of current patient.
-            all_segments = HD_DSC.extract_all_segments(ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       )
-            
-            # Creating manual segments list.
-            print("Creating the list of manual segments")
-            unknown_segments = HD_DSC.find_unknown_segments(all_segments,
-                                                            config,
-                                                            )
-            HD_DSC.user_selection(unknown_segments,
-                                  config,
-                                  )
-            manual_segments = HD_DSC.extract_manual_segments(all_segments,
-                                                             config,
-                                                             )
-            
-            # Computing HD, DSC and SDSC for every segment in manual and MBS
-            # lists.
-            final_data = HD_DSC.extract_hausdorff_dice(manual_segments,
-                                                       config,
-                                                       ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       final_data,
-                                                       )
-            
-            # Moving patient folder to a different location, if the destination
-            # folder does not exist it will be automatically created.
-            HD_DSC.move_patient_folder(new_folder_path,
-                                       patient_folder_path,
-                                       patient_folder,
+    if (args.discovery_state_path is not None
+            and last_patient_folder is not None):
+        HD_DSC.save_discovery_progress(discovery_state_path,
+                                       last_patient_folder,
                                        )
     
-        # Creating the dataframe
-        new_data = pd.DataFrame(final_data,
-                                columns=["Patient ID",
-                                         "Frame of reference",
-                                         "Compared methods",
-                                         "Reference segment name",
-                                         "Compared segment name",
-                                         "Alias name",
-                                         "95% Hausdorff distance (mm)",
-                                         "Volumetric Dice similarity coefficient",
-                                         "Surface Dice similarity coefficient",
-                                         ],
-                                )
-        # Saving dataframe to excel.
-        print("Saving data")
-        new_data.to_excel(excel_path,
-                          sheet_name="Data",
-                          index=False,
-                          )
-     
-        # Saving configuration data.
-        HD_DSC.save_config_data(config,
-                                new_config_path,
-                                )
-        
-        print("Execution successfully ended")
+    # Final metrics, saving included.
+    if metrics_textfile_path is not None:
+        PipelineMetrics.write_metrics_textfile(metrics_textfile_path)
+    
+    if interrupted:
+        sys.exit("Execution halted by the user")
+    print("Execution successfully ended")
     
     
 if __name__ == "__main__":
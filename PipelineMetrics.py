@@ -0,0 +1,433 @@
+import sys
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Counters, gauges and histograms of the pipeline by name and labels,
+# exported in the Prometheus text format by pipeline_metrics_text.
+PIPELINE_METRICS = {"counter": {},
+                    "gauge": {},
+                    "histogram": {},
+                    }
+
+# Lock protecting PIPELINE_METRICS, updated by several threads.
+PIPELINE_METRICS_LOCK = threading.Lock()
+
+# Upper bounds in seconds of the buckets of the stage duration histograms.
+STAGE_DURATION_BUCKETS = [0.1,
+                          0.5,
+                          1,
+                          2.5,
+                          5,
+                          10,
+                          30,
+                          60,
+                          120,
+                          300,
+                          600,
+                          ]
+
+# Description of every exported metric.
+PIPELINE_METRICS_HELP = {
+    "hd_dsc_studies_processed_total": "Studies whose metrics were computed",
+    "hd_dsc_studies_skipped_total": "Studies not analysed again",
+    "hd_dsc_failures_total": "Failures by pipeline stage",
+    "hd_dsc_comparisons_total": "Comparisons whose metrics were computed",
+    "hd_dsc_stage_duration_seconds": "Duration of the pipeline stages",
+    "hd_dsc_cache_requests_total": "Cache lookups by cache and result",
+    "hd_dsc_cache_hit_ratio": "Fraction of the cache lookups that hit",
+    "hd_dsc_dicom_read_bytes_total": "Bytes read from DICOM files",
+    "hd_dsc_dicom_read_files_total": "DICOM files read",
+    "hd_dsc_peak_memory_bytes": ("Peak resident memory of this process "
+                                 "(worker \"main\") and of its largest "
+                                 "finished child process (worker "
+                                 "\"children\")"),
+    }
+
+
+def record_stage(stage_stats,
+                 stage,
+                 seconds,
+                 ):
+    """
+    Adding the duration of a pipeline stage to its statistics and to the
+    stage duration histogram of the pipeline metrics.
+
+    Parameters
+    ----------
+    stage_stats : dict or None
+        Statistics of every stage, updated in place. If None only the
+        pipeline metrics are updated.
+    stage : str
+        Name of the stage (Ex. "load").
+    seconds : float
+        Duration of the stage in seconds.
+
+    Returns
+    -------
+    None.
+
+    """
+    observe_metric("hd_dsc_stage_duration_seconds",
+                   seconds,
+                   {"stage": stage},
+                   )
+    if stage_stats is None:
+        return
+    stats = stage_stats.setdefault(stage,
+                                   {"count": 0,
+                                    "total_s": 0.0,
+                                    "max_s": 0.0,
+                                    "last_s": 0.0,
+                                    },
+                                   )
+    stats["count"] += 1
+    stats["total_s"] += seconds
+    stats["max_s"] = max(stats["max_s"], seconds)
+    stats["last_s"] = seconds
+
+@contextmanager
+def timed_stage(stage_stats,
+                stage,
+                lock=None,
+                ):
+    """
+    Measuring the duration of the code in the with block as a pipeline
+    stage. The duration is recorded even if the block raises an error.
+
+    Parameters
+    ----------
+    stage_stats : dict or None
+        Statistics of every stage, updated in place (see record_stage).
+    stage : str
+        Name of the stage (Ex. "load").
+    lock : threading.Lock, optional
+        Lock protecting stage_stats when it is shared by several threads.
+
+    Yields
+    ------
+    None.
+
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if lock is None:
+            record_stage(stage_stats,
+                         stage,
+                         seconds,
+                         )
+        else:
+            with lock:
+                record_stage(stage_stats,
+                             stage,
+                             seconds,
+                             )
+
+def increment_metric(name,
+                     value=1,
+                     labels=None,
+                     ):
+    """
+    Adding a value to a counter of the pipeline metrics.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the counter (Ex. "hd_dsc_studies_processed_total").
+    value : float, optional
+        Value added to the counter. Default is 1.
+    labels : dict, optional
+        Labels of the counter (Ex. {"stage": "read"}).
+    
+    Returns
+    -------
+    None.
+    
+    """
+    key = tuple(sorted((labels or {}).items()))
+    with PIPELINE_METRICS_LOCK:
+        counters = PIPELINE_METRICS["counter"].setdefault(name, {})
+        counters[key] = counters.get(key, 0) + value
+
+def set_metric(name,
+               value,
+               labels=None,
+               ):
+    """
+    Setting a gauge of the pipeline metrics.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the gauge (Ex. "hd_dsc_peak_memory_bytes").
+    value : float
+        Value of the gauge.
+    labels : dict, optional
+        Labels of the gauge (Ex. {"worker": "main"}).
+    
+    Returns
+    -------
+    None.
+    
+    """
+    key = tuple(sorted((labels or {}).items()))
+    with PIPELINE_METRICS_LOCK:
+        PIPELINE_METRICS["gauge"].setdefault(name, {})[key] = value
+
+def observe_metric(name,
+                   value,
+                   labels=None,
+                   buckets=STAGE_DURATION_BUCKETS,
+                   ):
+    """
+    Adding an observation to a histogram of the pipeline metrics.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the histogram (Ex. "hd_dsc_stage_duration_seconds").
+    value : float
+        Observed value.
+    labels : dict, optional
+        Labels of the histogram (Ex. {"stage": "load"}).
+    buckets : list, optional
+        Increasing upper bounds of the buckets, used when the histogram is
+        created. Default is STAGE_DURATION_BUCKETS.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    key = tuple(sorted((labels or {}).items()))
+    with PIPELINE_METRICS_LOCK:
+        histograms = PIPELINE_METRICS["histogram"].setdefault(name, {})
+        histogram = histograms.setdefault(key,
+                                          {"buckets": list(buckets),
+                                           "counts": [0] * len(buckets),
+                                           "sum": 0.0,
+                                           "count": 0,
+                                           },
+                                          )
+        for index, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+def count_cache_lookup(cache,
+                       hit,
+                       ):
+    """
+    Counting a lookup of one of the caches of the pipeline.
+    
+    Parameters
+    ----------
+    cache : str
+        Name of the cache (Ex. "labelmaps").
+    hit : bool
+        True if the value was found in the cache.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    increment_metric("hd_dsc_cache_requests_total",
+                     labels={"cache": cache,
+                             "result": "hit" if hit else "miss",
+                             },
+                     )
+
+def record_peak_memory():
+    """
+    Setting the peak memory gauges of this process and of its largest
+    finished child process (Ex. metric workers), where the resource module
+    is available (not on Windows).
+    
+    Returns
+    -------
+    None.
+    
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    
+    # Maximum resident set size is in kilobytes on Linux, in bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    for worker, who in (("main", resource.RUSAGE_SELF),
+                        ("children", resource.RUSAGE_CHILDREN),
+                        ):
+        peak = resource.getrusage(who).ru_maxrss * scale
+        if peak:
+            set_metric("hd_dsc_peak_memory_bytes",
+                       peak,
+                       {"worker": worker},
+                       )
+
+def format_metric_labels(labels):
+    """
+    Formatting metric labels as in the Prometheus text format.
+    
+    Parameters
+    ----------
+    labels : tuple
+        Pairs of label name and value.
+    
+    Returns
+    -------
+    text : str
+        Labels between braces (Ex. '{stage="load"}'), empty if there are
+        none.
+    
+    """
+    if not labels:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\")
+                                .replace("\n", "\\n")
+                                .replace('"', '\\"'))
+               for name, value in labels
+               ]
+    
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def pipeline_metrics_text():
+    """
+    Exporting the pipeline metrics in the Prometheus text format.
+    
+    Peak memory is measured and the hit ratio of every cache is computed
+    from its lookups first.
+    
+    Returns
+    -------
+    text : str
+        Metrics in the Prometheus text exposition format (version 0.0.4).
+    
+    """
+    record_peak_memory()
+    lookups = {}
+    with PIPELINE_METRICS_LOCK:
+        for key, value in PIPELINE_METRICS["counter"].get(
+                "hd_dsc_cache_requests_total", {}).items():
+            labels = dict(key)
+            hits, total = lookups.get(labels["cache"], (0, 0))
+            lookups[labels["cache"]] = (hits + value * (labels["result"]
+                                                        == "hit"),
+                                        total + value,
+                                        )
+    for cache, (hits, total) in lookups.items():
+        set_metric("hd_dsc_cache_hit_ratio",
+                   hits / total,
+                   {"cache": cache},
+                   )
+    
+    lines = []
+    with PIPELINE_METRICS_LOCK:
+        for kind in ("counter", "gauge", "histogram"):
+            for name, series in sorted(PIPELINE_METRICS[kind].items()):
+                lines.append(f"# HELP {name} "
+                             f"{PIPELINE_METRICS_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(series.items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{format_metric_labels(key)} "
+                                     f"{value}")
+                        continue
+                    # Buckets are cumulative, the last one is +Inf.
+                    for bound, count in zip(value["buckets"] + ["+Inf"],
+                                            value["counts"]
+                                            + [value["count"]],
+                                            ):
+                        labels = key + (("le", f"{bound:g}"
+                                         if bound != "+Inf" else bound),)
+                        lines.append(f"{name}_bucket"
+                                     f"{format_metric_labels(labels)} "
+                                     f"{count}")
+                    lines.append(f"{name}_sum{format_metric_labels(key)} "
+                                 f"{value['sum']}")
+                    lines.append(f"{name}_count{format_metric_labels(key)} "
+                                 f"{value['count']}")
+    
+    return "\n".join(lines) + "\n"
+
+def write_metrics_textfile(textfile_path):
+    """
+    Writing the pipeline metrics in a file read by the textfile collector of
+    the Prometheus node exporter.
+    
+    The file is written next to its final path and then renamed, so that
+    it is never read half written.
+    
+    Parameters
+    ----------
+    textfile_path : str
+        Path to the metrics file (Ex. "path/to/hd_dsc.prom").
+    
+    Returns
+    -------
+    None.
+    
+    """
+    temporary_path = f"{textfile_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as textfile:
+        textfile.write(pipeline_metrics_text())
+    os.replace(temporary_path,
+               textfile_path,
+               )
+
+def start_metrics_server(port,
+                         host="127.0.0.1",
+                         ):
+    """
+    Serving the pipeline metrics over HTTP in a background thread, for
+    Prometheus to scrape.
+    
+    Parameters
+    ----------
+    port : int
+        Port of the HTTP server, 0 to choose a free one.
+    host : str, optional
+        Address of the HTTP server. Default is "127.0.0.1" (local only).
+    
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        HTTP server answering GET /metrics (see pipeline_metrics_text).
+    
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            data = pipeline_metrics_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def log_message(self, format, *args):
+            # Scrapes are not printed, to keep the output readable.
+            pass
+    
+    server = ThreadingHTTPServer((host, port),
+                                 MetricsHandler,
+                                 )
+    threading.Thread(target=server.serve_forever,
+                     name="metrics-server",
+                     daemon=True,
+                     ).start()
+    
+    return server
@@ -0,0 +1,465 @@
+import sys
+import shutil
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+
+def create_progress(n_patients=None,
+                    json_path=None,
+                    bar=False,
+                    interval_s=1.0,
+                    ):
+    """
+    Creating the progress of a batch of patients, reported as a live
+    terminal bar and as JSON lines (see report_progress).
+    
+    Parameters
+    ----------
+    n_patients : int, optional
+        Number of patients of the batch, needed to estimate the remaining
+        time. If None (default) it is unknown, or counted while the patient
+        folders are found (see discovered_patients).
+    json_path : str, optional
+        Path to the file where a JSON line is appended at every report. If
+        None (default) no line is written.
+    bar : bool, optional
+        If True the progress bar is drawn on the standard error. If it is a
+        terminal, the standard output is replaced until close_progress so
+        that printed lines appear above the bar. Default is False.
+    interval_s : float, optional
+        Minimum time in seconds between two reports, patients completed
+        are always reported. Default is 1.
+    
+    Returns
+    -------
+    progress : dict
+        Counters of the analysed and failed patients ("patients",
+        "failed") and of the computed comparisons ("comparisons"), current
+        stage of every worker ("workers") and the lock protecting them
+        ("lock").
+    
+    """
+    live = bar and sys.stderr.isatty()
+    progress = {"started": time.time(),
+                "n_patients": n_patients,
+                "discovering": False,
+                "patients": 0,
+                "failed": 0,
+                "comparisons": 0,
+                "workers": {},
+                "lock": threading.RLock(),
+                "interval_s": interval_s,
+                "last_report": 0.0,
+                "changed": True,
+                "json_file": (open(json_path, "a", encoding="utf-8")
+                              if json_path is not None else None),
+                "bar": bar,
+                "live": live,
+                "bar_drawn": False,
+                "line_start": True,
+                "stdout": sys.stdout,
+                }
+    
+    # Lines printed while the bar is live are written above it, until the
+    # progress is closed.
+    if live:
+        sys.stdout = progress_stdout(progress)
+    
+    return progress
+
+def set_progress_stage(progress,
+                       stage,
+                       patient_folder=None,
+                       worker=None,
+                       ):
+    """
+    Setting the stage a worker is running.
+    
+    Parameters
+    ----------
+    progress : dict or None
+        Progress created by create_progress. If None nothing is done.
+    stage : str or None
+        Name of the stage (Ex. "load" or "metrics Bladder"), None when the
+        worker is idle.
+    patient_folder : str, optional
+        Name of the patient folder the stage works on. If None (default) the
+        patient folder of the previous stage of the worker is kept.
+    worker : str, optional
+        Name of the worker. If None (default) the name of the current
+        thread is used.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    if progress is None:
+        return
+    if worker is None:
+        worker = threading.current_thread().name
+    
+    # The start of the stage is kept while it does not change, so that
+    # stalls are visible.
+    with progress["lock"]:
+        current = progress["workers"].get(worker)
+        if patient_folder is None and current is not None:
+            patient_folder = current["patient"]
+        if stage is None:
+            progress["workers"].pop(worker, None)
+        elif (current is None
+              or (current["stage"], current["patient"])
+              != (stage, patient_folder)):
+            progress["workers"][worker] = {"stage": stage,
+                                           "patient": patient_folder,
+                                           "since": time.time(),
+                                           }
+        progress["changed"] = True
+        report_progress(progress)
+
+def add_progress(progress,
+                 patients=0,
+                 failed=0,
+                 comparisons=0,
+                 ):
+    """
+    Adding completed patients and comparisons to the progress.
+    
+    Parameters
+    ----------
+    progress : dict or None
+        Progress created by create_progress. If None nothing is done.
+    patients : int, optional
+        Number of patients analysed. Default is 0.
+    failed : int, optional
+        Number of patients that failed, negative when a failed patient is
+        analysed again successfully. Default is 0.
+    comparisons : int, optional
+        Number of comparisons computed. Default is 0.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    if progress is None:
+        return
+    with progress["lock"]:
+        progress["patients"] += patients
+        progress["failed"] += failed
+        progress["comparisons"] += comparisons
+        progress["changed"] = True
+        report_progress(progress,
+                        force=bool(patients or failed),
+                        )
+
+def discovered_patients(progress,
+                        patient_folders,
+                        ):
+    """
+    Counting the patient folders in the progress while they are found, so
+    that the search is not finished before the first patient is analysed.
+    
+    Parameters
+    ----------
+    progress : dict or None
+        Progress created by create_progress. If None the patient folders
+        are returned as they are.
+    patient_folders : iterable
+        Names of the patient folders, found lazily (see discover_patients).
+    
+    Returns
+    -------
+    patient_folders : iterable
+        The same patient folders, counted in the total of the progress when
+        they are yielded.
+    
+    """
+    if progress is None:
+        return patient_folders
+    
+    def counted_folders():
+        with progress["lock"]:
+            progress["n_patients"] = 0
+            progress["discovering"] = True
+        try:
+            for patient_folder in patient_folders:
+                with progress["lock"]:
+                    progress["n_patients"] += 1
+                yield patient_folder
+        finally:
+            with progress["lock"]:
+                progress["discovering"] = False
+                progress["changed"] = True
+    
+    return counted_folders()
+
+def progress_snapshot(progress):
+    """
+    Computing throughput and remaining time of the progress.
+    
+    Parameters
+    ----------
+    progress : dict
+        Progress created by create_progress.
+    
+    Returns
+    -------
+    snapshot : dict
+        Time of the snapshot, elapsed seconds, analysed, failed and total
+        patients, whether patient folders are still being found (then the
+        total and the remaining time only count the folders found so far),
+        computed comparisons, patients per minute, comparisons per second,
+        estimated remaining seconds (None if unknown) and the stage,
+        patient folder and stage duration in seconds of every worker.
+    
+    """
+    now = time.time()
+    with progress["lock"]:
+        elapsed_s = max(now - progress["started"], 1e-9)
+        finished = progress["patients"] + progress["failed"]
+        patients_per_min = finished / elapsed_s * 60
+        if progress["n_patients"] is None or finished == 0:
+            eta_s = None
+        else:
+            remaining = max(progress["n_patients"] - finished, 0)
+            eta_s = remaining / patients_per_min * 60
+        snapshot = {"time": now,
+                    "elapsed_s": elapsed_s,
+                    "patients_done": progress["patients"],
+                    "patients_failed": progress["failed"],
+                    "patients_total": progress["n_patients"],
+                    "discovering": progress["discovering"],
+                    "comparisons": progress["comparisons"],
+                    "patients_per_min": patients_per_min,
+                    "comparisons_per_s": progress["comparisons"] / elapsed_s,
+                    "eta_s": eta_s,
+                    "workers": {worker: {"stage": state["stage"],
+                                         "patient": state["patient"],
+                                         "stage_s": now - state["since"],
+                                         }
+                                for worker, state
+                                in progress["workers"].items()
+                                },
+                    }
+    
+    return snapshot
+
+def format_duration(seconds):
+    """
+    Formatting a duration as hours, minutes and seconds.
+    
+    Parameters
+    ----------
+    seconds : float or None
+        Duration in seconds.
+    
+    Returns
+    -------
+    text : str
+        Duration as "H:MM:SS", "?" if it is None.
+    
+    """
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+def progress_bar(snapshot,
+                 width=10,
+                 ):
+    """
+    Formatting a progress snapshot as a one line progress bar.
+    
+    Parameters
+    ----------
+    snapshot : dict
+        Snapshot created by progress_snapshot.
+    width : int, optional
+        Number of characters of the bar. Default is 10.
+    
+    Returns
+    -------
+    line : str
+        Bar, finished and total patients ("+" while patient folders are
+        still being found), throughput, remaining time and stage of every
+        worker (Ex. "[###-------] 12/40 ETA 1:05:00 ...").
+    
+    """
+    finished = snapshot["patients_done"] + snapshot["patients_failed"]
+    total = snapshot["patients_total"]
+    if total:
+        filled = int(width * min(finished / total, 1))
+        bar = "[" + "#" * filled + "-" * (width - filled) + "] "
+    else:
+        bar = ""
+    if total is None:
+        total = "?"
+    elif snapshot.get("discovering"):
+        total = f"{total}+"
+    line = (f"{bar}{finished}/{total} "
+            f"ETA {format_duration(snapshot['eta_s'])} "
+            f"({snapshot['patients_failed']} failed, "
+            f"{snapshot['patients_per_min']:.2f} patients/min, "
+            f"{snapshot['comparisons_per_s']:.2f} comparisons/s)"
+            )
+    for worker, state in snapshot["workers"].items():
+        line += (f" | {worker}: {state['stage']}"
+                 + (f" {state['patient']}" if state["patient"] else "")
+                 + f" {format_duration(state['stage_s'])}"
+                 )
+    
+    return line
+
+def report_progress(progress,
+                    force=False,
+                    ):
+    """
+    Writing a JSON line with the progress snapshot and drawing the progress
+    bar, at most once every interval.
+    
+    When the standard error is not a terminal the bar is written as a new
+    line only for forced reports.
+    
+    Parameters
+    ----------
+    progress : dict
+        Progress created by create_progress.
+    force : bool, optional
+        If True the progress is reported even if the interval has not
+        elapsed. Default is False.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    with progress["lock"]:
+        now = time.time()
+        if (not force
+            and now - progress["last_report"] < progress["interval_s"]):
+            return
+        progress["last_report"] = now
+        progress["changed"] = False
+        snapshot = progress_snapshot(progress)
+        if progress["json_file"] is not None:
+            progress["json_file"].write(json.dumps(snapshot) + "\n")
+            progress["json_file"].flush()
+        if progress["live"]:
+            # The bar is not drawn in the middle of a printed line.
+            if progress["bar_drawn"] or progress["line_start"]:
+                draw_progress_bar(progress,
+                                  snapshot,
+                                  )
+        elif progress["bar"] and force:
+            print(progress_bar(snapshot),
+                  file=sys.stderr,
+                  flush=True,
+                  )
+
+def draw_progress_bar(progress,
+                      snapshot=None,
+                      ):
+    """
+    Drawing the progress bar on the last line of the terminal, replacing
+    the previous one. The lock of the progress must be held.
+    
+    Parameters
+    ----------
+    progress : dict
+        Progress created by create_progress.
+    snapshot : dict, optional
+        Snapshot created by progress_snapshot. If None (default) a new one
+        is taken.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    if snapshot is None:
+        snapshot = progress_snapshot(progress)
+    columns = shutil.get_terminal_size().columns
+    sys.stderr.write("\r\x1b[K" + progress_bar(snapshot)[:columns - 1])
+    sys.stderr.flush()
+    progress["bar_drawn"] = True
+
+def progress_stdout(progress):
+    """
+    Creating the standard output that prints lines above the live progress
+    bar.
+    
+    Parameters
+    ----------
+    progress : dict
+        Progress created by create_progress.
+    
+    Returns
+    -------
+    stdout : types.SimpleNamespace
+        File-like object writing on the current standard output.
+    
+    """
+    stdout = sys.stdout
+    
+    def write(text):
+        # The bar is cleared before the text and drawn again after every
+        # complete line.
+        with progress["lock"]:
+            if progress["bar_drawn"]:
+                sys.stderr.write("\r\x1b[K")
+                sys.stderr.flush()
+                progress["bar_drawn"] = False
+            stdout.write(text)
+            stdout.flush()
+            if text:
+                progress["line_start"] = text.endswith("\n")
+            if progress["line_start"]:
+                draw_progress_bar(progress)
+        
+        return len(text)
+    
+    return SimpleNamespace(write=write,
+                           flush=stdout.flush,
+                           )
+
+def close_progress(progress):
+    """
+    Reporting the final progress, closing its JSON lines file and
+    restoring the standard output.
+    
+    Parameters
+    ----------
+    progress : dict or None
+        Progress created by create_progress. If None nothing is done.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    if progress is None:
+        return
+    # The last report is written only if something changed after it.
+    with progress["lock"]:
+        if progress["workers"]:
+            progress["workers"].clear()
+            progress["changed"] = True
+        if progress["changed"]:
+            report_progress(progress,
+                            force=True,
+                            )
+        if progress["bar_drawn"]:
+            sys.stderr.write("\n")
+            sys.stderr.flush()
+            progress["bar_drawn"] = False
+        if progress["json_file"] is not None:
+            progress["json_file"].close()
+            progress["json_file"] = None
+        if progress["live"]:
+            sys.stdout = progress["stdout"]
+            progress["live"] = False
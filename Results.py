@@ -0,0 +1,391 @@
+import sys
+import os
+
+import numpy as np
+
+
+# Columns of the results.
+RESULTS_COLUMNS = ["Patient ID",
+                   "Frame of reference",
+                   "Compared methods",
+                   "Reference segment name",
+                   "Compared segment name",
+                   "Alias name",
+                   "95% Hausdorff distance (mm)",
+                   "Volumetric Dice similarity coefficient",
+                   "Surface Dice similarity coefficient",
+                   ]
+
+# Column of the results with the reason why a comparison was skipped (Ex.
+# "reference absent"), empty if the metrics were computed.
+SKIPPED_REASON_COLUMN = "Skipped reason"
+
+# Columns of the results with the fingerprints of the contours of the
+# compared segments, used to recompute only the edited segments.
+FINGERPRINT_COLUMNS = ["Reference contours fingerprint",
+                       "Compared contours fingerprint",
+                       ]
+
+# Columns of the errors table, one row for every patient that could not be
+# analysed.
+ERRORS_COLUMNS = ["Patient folder",
+                  "Stage",
+                  "Error",
+                  "Attempts",
+                  "Traceback",
+                  ]
+
+# Results, summary and errors columns stored as text and as categories, all
+# the others are stored as float32.
+TEXT_COLUMNS = ["Patient ID",
+                "Frame of reference",
+                "Reference segment name",
+                "Compared segment name",
+                SKIPPED_REASON_COLUMN,
+                *FINGERPRINT_COLUMNS,
+                "Metric",
+                "Patient folder",
+                "Stage",
+                "Error",
+                "Traceback",
+                ]
+
+CATEGORY_COLUMNS = ["Compared methods",
+                    "Alias name",
+                    ]
+
+# Results file formats by file extension.
+RESULTS_FORMATS = {".xlsx": "excel",
+                   ".csv": "csv",
+                   ".parquet": "parquet",
+                   ".feather": "arrow",
+                   ".arrow": "arrow",
+                   }
+
+# Maximum number of data rows in an excel sheet.
+EXCEL_MAX_ROWS = 1048575
+
+
+def results_format(results_path):
+    """
+    Finding the format of the results file from its extension.
+    Execution is halted if the extension is not supported.
+
+    Parameters
+    ----------
+    results_path : str
+        Path to the results file (Ex. "path/to/results.parquet").
+
+    Returns
+    -------
+    file_format : str
+        One of "excel", "csv", "parquet" or "arrow".
+
+    """
+    extension = os.path.splitext(results_path)[1].lower()
+    try:
+        return RESULTS_FORMATS[extension]
+    except KeyError:
+        sys.exit(f"{extension} files are not supported, use one of "
+                 f"{list(RESULTS_FORMATS)}, execution halted"
+                 )
+
+def results_dataframe(rows,
+                      columns=RESULTS_COLUMNS,
+                      categories=None,
+                      ):
+    """
+    Creating a typed dataframe from results rows.
+    
+    Text columns are stored as strings (empty if missing), compared methods
+    and alias names as categories and metrics as float32.
+
+    Parameters
+    ----------
+    rows : list
+        List of results rows.
+    columns : list, optional
+        Names of the columns. Default is RESULTS_COLUMNS.
+    categories : dict, optional
+        Categories of every category column. Values not in the categories are
+        appended to them, so that codes of already written rows do not
+        change.
+
+    Returns
+    -------
+    results : DataFrame
+        Typed dataframe of the results.
+
+    """
+    import pandas as pd
+    
+    if categories is None:
+        categories = {}
+    results = pd.DataFrame(rows,
+                           columns=columns,
+                           )
+    for column in columns:
+        if column in CATEGORY_COLUMNS:
+            column_categories = categories.setdefault(column, [])
+            for value in results[column].astype(str).unique():
+                if value not in column_categories:
+                    column_categories.append(value)
+            results[column] = pd.Categorical(results[column].astype(str),
+                                             categories=column_categories,
+                                             )
+        elif column in TEXT_COLUMNS:
+            results[column] = results[column].fillna("").astype(str)
+        else:
+            results[column] = pd.to_numeric(results[column],
+                                            errors="coerce",
+                                            ).astype(np.float32)
+    
+    return results
+
+def open_results_writer(results_path,
+                        columns=RESULTS_COLUMNS,
+                        chunk_size=1000,
+                        categories=None,
+                        temp_path=None,
+                        ):
+    """
+    Opening a writer that saves results in chunks.
+    
+    Rows given to write_results are written every chunk_size rows, so that
+    results are not all kept in memory (excel files are the exception, since
+    they can only be written all at once). Data are written in a temporary
+    file that replaces the results file only when close_results_writer is
+    called.
+
+    Parameters
+    ----------
+    results_path : str
+        Path to the results file, its extension sets the format (.xlsx, .csv,
+        .parquet, .feather or .arrow).
+    columns : list, optional
+        Names of the columns. Default is RESULTS_COLUMNS.
+    chunk_size : int, optional
+        Number of rows written at once. Default is 1000.
+    categories : dict, optional
+        Initial categories of the category columns (Ex. {"Alias name":
+        ["Prostate", "Bladder"]}).
+    temp_path : str, optional
+        Path to the temporary file, with the same extension of the results
+        file. If None (default) it is results_path with ".partial" before
+        the extension.
+
+    Returns
+    -------
+    writer : dict
+        State of the writer.
+
+    """
+    root, extension = os.path.splitext(results_path)
+    if temp_path is None:
+        temp_path = f"{root}.partial{extension}"
+    writer = {"path": results_path,
+              "temp_path": temp_path,
+              "format": results_format(results_path),
+              "columns": list(columns),
+              "chunk_size": max(chunk_size, 1),
+              "categories": {column: list(values)
+                             for column, values in (categories or {}).items()
+                             },
+              "rows": [],
+              "frames": [],
+              "handle": None,
+              "n_rows": 0,
+              }
+    
+    return writer
+
+def write_results(writer,
+                  rows,
+                  ):
+    """
+    Adding results rows to the writer and writing every full chunk.
+
+    Parameters
+    ----------
+    writer : dict
+        Writer created by open_results_writer.
+    rows : list
+        List of results rows.
+
+    Returns
+    -------
+    None.
+
+    """
+    writer["rows"].extend(rows)
+    while len(writer["rows"]) >= writer["chunk_size"]:
+        chunk = writer["rows"][:writer["chunk_size"]]
+        writer["rows"] = writer["rows"][writer["chunk_size"]:]
+        write_results_chunk(writer,
+                            chunk,
+                            )
+
+def arrow_results_schema(columns):
+    """
+    Creating the Arrow schema of the results.
+
+    Parameters
+    ----------
+    columns : list
+        Names of the columns.
+
+    Returns
+    -------
+    schema : pyarrow.Schema
+        Schema with strings for text columns, dictionaries for category
+        columns and float32 for metrics.
+
+    """
+    import pyarrow as pa
+    
+    fields = []
+    for column in columns:
+        if column in CATEGORY_COLUMNS:
+            fields.append(pa.field(column,
+                                   pa.dictionary(pa.int32(), pa.string()),
+                                   ),
+                          )
+        elif column in TEXT_COLUMNS:
+            fields.append(pa.field(column,
+                                   pa.string(),
+                                   ),
+                          )
+        else:
+            fields.append(pa.field(column,
+                                   pa.float32(),
+                                   ),
+                          )
+    
+    return pa.schema(fields)
+
+def write_results_chunk(writer,
+                        rows,
+                        ):
+    """
+    Writing a chunk of results rows in the temporary results file.
+
+    Parameters
+    ----------
+    writer : dict
+        Writer created by open_results_writer.
+    rows : list
+        List of results rows.
+
+    Returns
+    -------
+    None.
+
+    """
+    chunk = results_dataframe(rows,
+                              writer["columns"],
+                              writer["categories"],
+                              )
+    
+    if writer["format"] == "excel":
+        # Excel files can not be appended, they are written when closing.
+        if writer["n_rows"] + len(chunk) > EXCEL_MAX_ROWS:
+            sys.exit(f"Results do not fit in an excel sheet ({EXCEL_MAX_ROWS}"
+                     " rows), use a .csv, .parquet or .feather file"
+                     )
+        writer["frames"].append(chunk)
+    elif writer["format"] == "csv":
+        chunk.to_csv(writer["temp_path"],
+                     mode="a" if writer["n_rows"] else "w",
+                     header=writer["n_rows"] == 0,
+                     index=False,
+                     )
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        schema = arrow_results_schema(writer["columns"])
+        table = pa.Table.from_pandas(chunk,
+                                     preserve_index=False,
+                                     ).cast(schema)
+        if writer["handle"] is None:
+            if writer["format"] == "parquet":
+                writer["handle"] = pq.ParquetWriter(writer["temp_path"],
+                                                    schema,
+                                                    )
+            else:
+                # Categories are only appended, so dictionaries can be
+                # written as deltas.
+                options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+                writer["handle"] = pa.ipc.new_file(writer["temp_path"],
+                                                   schema,
+                                                   options=options,
+                                                   )
+        writer["handle"].write_table(table)
+    
+    writer["n_rows"] += len(chunk)
+
+def close_results_writer(writer):
+    """
+    Writing the remaining rows and replacing the results file with the
+    temporary one.
+
+    Parameters
+    ----------
+    writer : dict
+        Writer created by open_results_writer.
+
+    Returns
+    -------
+    None.
+
+    """
+    import pandas as pd
+    
+    # Remaining rows are written, an empty file with only the columns is
+    # written if there are no results at all.
+    if writer["rows"] or writer["n_rows"] == 0:
+        write_results_chunk(writer,
+                            writer["rows"],
+                            )
+        writer["rows"] = []
+    
+    if writer["format"] == "excel":
+        pd.concat(writer["frames"],
+                  ignore_index=True,
+                  ).to_excel(writer["temp_path"],
+                             sheet_name="Data",
+                             index=False,
+                             )
+        writer["frames"] = []
+    elif writer["handle"] is not None:
+        writer["handle"].close()
+        writer["handle"] = None
+    
+    os.replace(writer["temp_path"],
+               writer["path"],
+               )
+    print(f"{writer['n_rows']} rows saved in {writer['path']}")
+
+def discard_results_writer(writer):
+    """
+    Closing a writer without saving its results, the temporary file is
+    removed and the results file is left as it was.
+
+    Parameters
+    ----------
+    writer : dict
+        Writer created by open_results_writer.
+
+    Returns
+    -------
+    None.
+
+    """
+    if writer["handle"] is not None:
+        writer["handle"].close()
+        writer["handle"] = None
+    writer["rows"] = []
+    writer["frames"] = []
+    
+    if os.path.exists(writer["temp_path"]):
+        os.remove(writer["temp_path"])
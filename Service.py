@@ -0,0 +1,515 @@
+import argparse
+import sys
+import os
+import json
+import threading
+import queue
+import time
+import uuid
+import traceback
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import HD_DSC
+import PipelineMetrics
+import Results
+
+
+def create_service_state(max_jobs=1000):
+    """
+    Creating the state shared by the HTTP server and the job workers.
+    
+    Parameters
+    ----------
+    max_jobs : int, optional
+        Number of finished jobs kept in memory, older ones are forgotten.
+        Default is 1000.
+    
+    Returns
+    -------
+    state : dict
+        Jobs by ID ("jobs"), queue of the jobs to run ("queue"), statistics
+        of the pipeline stages ("stages"), cache of the segments indexes by
+        configuration ("segment_indexes") and the lock protecting them
+        ("lock").
+    
+    """
+    state = {"jobs": OrderedDict(),
+             "queue": queue.Queue(),
+             "stages": {},
+             "segment_indexes": {},
+             "lock": threading.Lock(),
+             "max_jobs": max_jobs,
+             "started": time.time(),
+             }
+    
+    return state
+
+def submit_job(state,
+               request,
+               ):
+    """
+    Adding a job to the service queue.
+    
+    Parameters
+    ----------
+    state : dict
+        State of the service.
+    request : dict
+        Job request with the path to the patient folder
+        ("patient_folder_path"), the configuration ("config") or the path to
+        the configuration file ("config_path") and, optionally, the path to
+        the file where results must be saved ("results_path").
+    
+    Returns
+    -------
+    job : dict
+        Submitted job.
+    
+    """
+    if "patient_folder_path" not in request:
+        raise ValueError("patient_folder_path is required")
+    if "config" in request:
+        config = request["config"]
+    elif "config_path" in request:
+        config = HD_DSC.read_config(request["config_path"])
+    else:
+        raise ValueError("config or config_path is required")
+    
+    job = {"job_id": uuid.uuid4().hex,
+           "status": "queued",
+           "patient_folder_path": request["patient_folder_path"],
+           "results_path": request.get("results_path"),
+           "config": config,
+           "submitted": time.time(),
+           "rows": None,
+           "error": None,
+           }
+    with state["lock"]:
+        state["jobs"][job["job_id"]] = job
+        forget_old_jobs(state)
+    state["queue"].put(job)
+    
+    return job
+
+def forget_old_jobs(state):
+    """
+    Removing the oldest finished jobs when too many are kept in memory.
+    The lock of the state must be held.
+    
+    Parameters
+    ----------
+    state : dict
+        State of the service.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    finished = [job_id for job_id, job in state["jobs"].items()
+                if job["status"] in ("done", "failed")
+                ]
+    for job_id in finished[:max(len(state["jobs"]) - state["max_jobs"], 0)]:
+        del state["jobs"][job_id]
+
+def cached_segment_index(state,
+                         config,
+                         ):
+    """
+    Returning the segments index of a configuration, compiled only the first
+    time the configuration is met.
+    
+    Parameters
+    ----------
+    state : dict
+        State of the service.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    
+    Returns
+    -------
+    segment_index : dict
+        Segments index created by HD_DSC.compile_segment_index.
+    
+    """
+    key = json.dumps(config,
+                     sort_keys=True,
+                     )
+    with state["lock"]:
+        PipelineMetrics.count_cache_lookup("segment_index",
+                                           key in state["segment_indexes"],
+                                           )
+        if key not in state["segment_indexes"]:
+            state["segment_indexes"][key] = HD_DSC.compile_segment_index(config)
+        
+        return state["segment_indexes"][key]
+
+def run_job(state,
+            job,
+            ):
+    """
+    Computing the metrics of the patient of a job.
+    
+    Loading, metrics computation and saving are timed as separate stages.
+    
+    Parameters
+    ----------
+    state : dict
+        State of the service.
+    job : dict
+        Job to run, updated with its status, rows and error.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    job["status"] = "running"
+    job["started"] = time.time()
+    try:
+        input_folder_path, patient_folder = os.path.split(
+            os.path.normpath(job["patient_folder_path"]),
+            )
+        with PipelineMetrics.timed_stage(state["stages"],
+                                         "load",
+                                         state["lock"],
+                                         ):
+            patient = HD_DSC.load_patient(input_folder_path,
+                                          patient_folder,
+                                          )
+        with PipelineMetrics.timed_stage(state["stages"],
+                                         "metrics",
+                                         state["lock"],
+                                         ):
+            rows = HD_DSC.analyse_patient(patient,
+                                          job["config"],
+                                          cached_segment_index(state,
+                                                               job["config"],
+                                                               ),
+                                          interactive=False,
+                                          )
+        columns = HD_DSC.results_columns(job["config"])
+        if job["results_path"] is not None:
+            with PipelineMetrics.timed_stage(state["stages"],
+                                             "save",
+                                             state["lock"],
+                                             ):
+                writer = Results.open_results_writer(job["results_path"],
+                                                     columns,
+                                                     )
+                Results.write_results(writer,
+                                      rows,
+                                      )
+                Results.close_results_writer(writer)
+        
+        # Rows are returned as JSON objects.
+        results = Results.results_dataframe(rows,
+                                            columns,
+                                            )
+        job["rows"] = json.loads(results.to_json(orient="records"))
+        job["status"] = "done"
+        PipelineMetrics.increment_metric("hd_dsc_studies_processed_total")
+    except (Exception, SystemExit):
+        job["error"] = traceback.format_exc()
+        job["status"] = "failed"
+        PipelineMetrics.increment_metric("hd_dsc_failures_total",
+                                         labels={"stage": "job"},
+                                         )
+    finally:
+        job["finished"] = time.time()
+        with state["lock"]:
+            PipelineMetrics.record_stage(state["stages"],
+                                         "job",
+                                         job["finished"] - job["submitted"],
+                                         )
+
+def job_worker(state):
+    """
+    Running the jobs of the service queue one after the other.
+    
+    Parameters
+    ----------
+    state : dict
+        State of the service.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    while True:
+        job = state["queue"].get()
+        run_job(state,
+                job,
+                )
+        state["queue"].task_done()
+
+def service_status(state):
+    """
+    Summarizing the state of the service.
+    
+    Parameters
+    ----------
+    state : dict
+        State of the service.
+    
+    Returns
+    -------
+    status : dict
+        Number of queued, running, done and failed jobs, uptime in seconds and
+        count, mean, maximum and last duration in seconds of every stage
+        ("job" is the time from submission to the end of the job).
+    
+    """
+    with state["lock"]:
+        counts = {"queued": 0,
+                  "running": 0,
+                  "done": 0,
+                  "failed": 0,
+                  }
+        for job in state["jobs"].values():
+            counts[job["status"]] += 1
+        stages = {stage: {"count": stats["count"],
+                          "mean_s": stats["total_s"] / stats["count"],
+                          "max_s": stats["max_s"],
+                          "last_s": stats["last_s"],
+                          }
+                  for stage, stats in state["stages"].items()
+                  }
+    
+    status = {"queue_depth": counts["queued"],
+              "jobs": counts,
+              "uptime_s": time.time() - state["started"],
+              "stages": stages,
+              }
+    
+    return status
+
+def job_summary(job):
+    """
+    Returning the public fields of a job.
+    
+    Parameters
+    ----------
+    job : dict
+        Job of the service.
+    
+    Returns
+    -------
+    summary : dict
+        Job without its configuration.
+    
+    """
+    return {key: value for key, value in job.items() if key != "config"}
+
+def create_request_handler(state):
+    """
+    Creating the HTTP request handler of the service.
+    
+    The API is:
+        POST /jobs        submits a job, the body is the JSON job request
+                          (see submit_job);
+        GET /jobs/<id>    returns the job, with its rows when done;
+        GET /status       returns the service status (see service_status);
+        GET /metrics      returns the pipeline metrics in the Prometheus
+                          text format (see
+                          PipelineMetrics.pipeline_metrics_text).
+    
+    Parameters
+    ----------
+    state : dict
+        State of the service.
+    
+    Returns
+    -------
+    handler : type
+        Subclass of http.server.BaseHTTPRequestHandler.
+    
+    """
+    class RequestHandler(BaseHTTPRequestHandler):
+        
+        def send_json(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def do_GET(self):
+            if self.path == "/status":
+                self.send_json(200, service_status(state))
+            elif self.path == "/metrics":
+                data = PipelineMetrics.pipeline_metrics_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            elif self.path.startswith("/jobs/"):
+                with state["lock"]:
+                    job = state["jobs"].get(self.path[len("/jobs/"):])
+                    summary = None if job is None else job_summary(job)
+                if summary is None:
+                    self.send_json(404, {"error": "unknown job"})
+                else:
+                    self.send_json(200, summary)
+            else:
+                self.send_json(404, {"error": "unknown endpoint"})
+        
+        def do_POST(self):
+            if self.path != "/jobs":
+                self.send_json(404, {"error": "unknown endpoint"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                job = submit_job(state,
+                                 request,
+                                 )
+            except (ValueError, OSError) as error:
+                self.send_json(400, {"error": str(error)})
+                return
+            self.send_json(202, {"job_id": job["job_id"],
+                                 "status": job["status"],
+                                 },
+                           )
+        
+        def log_message(self, format, *args):
+            # Requests are not printed, to keep the output readable.
+            pass
+    
+    return RequestHandler
+
+def import_heavy_libraries():
+    """
+    Importing the libraries that HD_DSC imports only when they are needed,
+    so that the first job does not pay their import time.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    import pandas
+    import pydicom
+    import rt_utils
+    import surface_distance
+
+def start_service(host="127.0.0.1",
+                  port=8765,
+                  n_workers=1,
+                  max_jobs=1000,
+                  ):
+    """
+    Starting the job workers and the HTTP server of the service.
+    
+    Heavy libraries are imported before the workers start (see
+    import_heavy_libraries).
+    
+    Parameters
+    ----------
+    host : str, optional
+        Address of the HTTP server. Default is "127.0.0.1" (local only).
+    port : int, optional
+        Port of the HTTP server, 0 to choose a free one. Default is 8765.
+    n_workers : int, optional
+        Number of jobs run at the same time. Default is 1.
+    max_jobs : int, optional
+        Number of finished jobs kept in memory. Default is 1000.
+    
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        HTTP server, not yet serving requests.
+    state : dict
+        State of the service.
+    
+    """
+    # Libraries are imported once, before any job is submitted.
+    import_heavy_libraries()
+    
+    state = create_service_state(max_jobs)
+    for worker in range(n_workers):
+        threading.Thread(target=job_worker,
+                         args=(state,),
+                         name=f"job-worker-{worker}",
+                         daemon=True,
+                         ).start()
+    server = ThreadingHTTPServer((host, port),
+                                 create_request_handler(state),
+                                 )
+    
+    return server, state
+
+def main(argv):
+    """
+    Running the metrics computation as a long-running local HTTP service.
+    
+    Libraries are imported once, so that jobs do not pay their import time.
+    
+    Parameters
+    ----------
+    argv : char **
+        Pointer to the pointer to the array where command line arguments are
+        stored in the memory.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    parser = argparse.ArgumentParser(description
+                                     = "HD, volDSC and surfDSC service")
+    parser.add_argument("--host",
+                        dest="host",
+                        metavar="HOST",
+                        default="127.0.0.1",
+                        required=False,
+                        help="Address of the HTTP server",
+                        )
+    parser.add_argument("--port",
+                        dest="port",
+                        metavar="PORT",
+                        type=int,
+                        default=8765,
+                        required=False,
+                        help="Port of the HTTP server",
+                        )
+    parser.add_argument("--workers",
+                        dest="n_workers",
+                        metavar="N",
+                        type=int,
+                        default=1,
+                        required=False,
+                        help="Number of jobs run at the same time",
+                        )
+    parser.add_argument("--max-jobs",
+                        dest="max_jobs",
+                        metavar="N",
+                        type=int,
+                        default=1000,
+                        required=False,
+                        help="Number of finished jobs kept in memory",
+                        )
+    
+    args = parser.parse_args(argv)
+    
+    server, state = start_service(args.host,
+                                  args.port,
+                                  args.n_workers,
+                                  args.max_jobs,
+                                  )
+    print(f"Service listening on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Service stopped")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -5,6 +5,12 @@ import shutil
 import json
 import tempfile
 import math
+import threading
+import sqlite3
+import time
+import urllib.request
+import urllib.error
+from contextlib import closing
 
 import numpy as np
 import pandas as pd
@@ -15,6 +21,13 @@ from rt_utils import RTStructBuilder
 import surface_distance as sd
 
 import HD_DSC
+import Aggregate
+import PipelineMetrics
+import Progress
+import Results
+import WorkQueue
+import Service
+import Benchmark
 
 
 def test_is_empty_with_empty_folder():
@@ -560,6 +573,33 @@ def test_load_existing_dataframe_with_no_excel():
     
     assert expected.equals(observed)
         
+def test_load_existing_dataframe_with_csv_text():
+    """
+    GIVEN: a CSV results file with a patient ID with leading zeros
+        
+    WHEN: running the function load_existing_dataframe
+        
+    THEN: text columns are read as text, with their leading zeros
+    
+    """
+    # Create a temporary CSV results file
+    temp_folder = tempfile.TemporaryDirectory()
+    csv_path = os.path.join(temp_folder.name, "results.csv")
+    pd.DataFrame({"Patient ID": ["007"],
+                  "Frame of reference": ["1.2.3"],
+                  "Volumetric Dice similarity coefficient": [0.5],
+                  }).to_csv(csv_path,
+                            index=False,
+                            )
+    
+    observed = HD_DSC.load_existing_dataframe(csv_path)
+    
+    assert ["007"] == list(observed["Patient ID"])
+    assert 0.5 == observed["Volumetric Dice similarity coefficient"][0]
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
 def test_concatenate_data():
     """
     GIVEN: two pandas dataframes
@@ -657,4 +697,1888 @@ def test_exit_if_no_patients():
     with pytest.raises(SystemExit):
         HD_DSC.exit_if_no_patients(temp_empty_folder.name,
                                    patient_folders,
-                                   )
\ No newline at end of file
+                                   )
+    
+def test_prefetch_patients_keeps_order():
+    """
+    GIVEN: an input folder with two patient folders and a skip_study function
+           that skips every study
+        
+    WHEN: running the function prefetch_patients with prefetch_depth 1
+        
+    THEN: patients are yielded in the same order of the patient folders and
+          their data are not loaded
+
+    """
+    # Create a temporary input folder with two patients containing only the
+    # RTSTRUCT file and one CT file.
+    temp_folder = tempfile.TemporaryDirectory()
+    source_folder = os.path.join("patients", "Pelvic-Ref002")
+    source_files = sorted(os.listdir(source_folder))
+    rs_file = [f for f in source_files if f.startswith("RS")][0]
+    ct_file = [f for f in source_files if f.startswith("CT")][0]
+    patient_folders = ["patient_b", "patient_a"]
+    for patient_folder in patient_folders:
+        os.mkdir(os.path.join(temp_folder.name, patient_folder))
+        for file in (rs_file, ct_file):
+            shutil.copy(os.path.join(source_folder, file),
+                        os.path.join(temp_folder.name, patient_folder),
+                        )
+    
+    patients = HD_DSC.prefetch_patients(temp_folder.name,
+                                        patient_folders,
+                                        prefetch_depth=1,
+                                        skip_study=lambda *args: True,
+                                        )
+    observed = [(patient["patient_folder"], patient["patient_data"])
+                for patient in patients
+                ]
+    
+    assert [("patient_b", None), ("patient_a", None)] == observed
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_load_patient_memory_estimate():
+    """
+    GIVEN: the test patient
+        
+    WHEN: running the function load_patient without decoding labelmaps
+        
+    THEN: the memory estimate counts the RTSTRUCT file and the CT headers,
+          but not the CT pixel data
+    
+    """
+    # Create a temporary input folder with the test patient
+    temp_folder = tempfile.TemporaryDirectory()
+    shutil.copytree(os.path.join("tests", "test_patient"),
+                    os.path.join(temp_folder.name, "test_patient"),
+                    )
+    
+    patient = HD_DSC.load_patient(temp_folder.name,
+                                  "test_patient",
+                                  )
+    ct_folder_path = patient["ct_folder_path"]
+    ct_size = sum(os.path.getsize(os.path.join(ct_folder_path, ct_file))
+                  for ct_file in os.listdir(ct_folder_path)
+                  )
+    rtstruct_size = os.path.getsize(patient["rtstruct_file_path"])
+    
+    assert {} == patient["labelmaps"]
+    assert rtstruct_size < patient["nbytes"] < rtstruct_size + ct_size / 10
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_prefetch_patients_with_empty_patient_folder():
+    """
+    GIVEN: an input folder with an empty patient folder
+        
+    WHEN: running the function prefetch_patients
+        
+    THEN: the error raised in the background thread raises SystemExit
+
+    """
+    # Create a temporary input folder with an empty patient folder
+    temp_folder = tempfile.TemporaryDirectory()
+    os.mkdir(os.path.join(temp_folder.name, "empty_patient"))
+    
+    patients = HD_DSC.prefetch_patients(temp_folder.name,
+                                        ["empty_patient"],
+                                        )
+    with pytest.raises(SystemExit):
+        next(patients)
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_read_ct_slices_with_concurrent_reading():
+    """
+    GIVEN: a folder containing some CT files
+        
+    WHEN: running the function read_ct_slices with several threads
+        
+    THEN: slices are ordered by ImagePositionPatient[2] as with one thread
+
+    """
+    # Create a temporary CT folder with some CT files
+    temp_folder = tempfile.TemporaryDirectory()
+    source_folder = os.path.join("patients", "Pelvic-Ref002")
+    ct_files = [f for f in sorted(os.listdir(source_folder))
+                if f.startswith("CT")
+                ]
+    for ct_file in ct_files[:10]:
+        shutil.copy(os.path.join(source_folder, ct_file),
+                    temp_folder.name,
+                    )
+    
+    expected = [ct_slice.SOPInstanceUID
+                for ct_slice in HD_DSC.read_ct_slices(temp_folder.name,
+                                                      max_workers=1,
+                                                      )
+                ]
+    observed_slices = HD_DSC.read_ct_slices(temp_folder.name,
+                                            max_workers=4,
+                                            )
+    observed = [ct_slice.SOPInstanceUID for ct_slice in observed_slices]
+    positions = [float(ct_slice.ImagePositionPatient[2])
+                 for ct_slice in observed_slices
+                 ]
+    
+    assert expected == observed
+    assert positions == sorted(positions)
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_load_ct_volume():
+    """
+    GIVEN: the CT series of the test patient
+        
+    WHEN: running the function load_ct_volume
+        
+    THEN: the volume has the pixels of the ordered slices, every file is
+          read once, the affine maps every voxel to its position in the
+          patient and hounsfield_units applies rescale slope and intercept
+    
+    """
+    ct_folder_path = os.path.join("tests", "test_patient", "CT")
+    slices = HD_DSC.read_ct_slices(ct_folder_path)
+    n_bytes = sum(os.path.getsize(os.path.join(ct_folder_path, ct_file))
+                  for ct_file in os.listdir(ct_folder_path)
+                  )
+    
+    counters = PipelineMetrics.PIPELINE_METRICS["counter"]
+    bytes_before = counters.get("hd_dsc_dicom_read_bytes_total", {}).get((), 0)
+    volume = HD_DSC.load_ct_volume(ct_folder_path,
+                                   max_workers=4,
+                                   )
+    bytes_read = counters["hd_dsc_dicom_read_bytes_total"][()] - bytes_before
+    
+    assert n_bytes == bytes_read
+    assert volume["voxels"].dtype == np.int16
+    assert volume["voxels"].shape == (slices[0].Rows,
+                                      slices[0].Columns,
+                                      len(slices),
+                                      )
+    row_spacing, column_spacing = map(float, slices[0].PixelSpacing)
+    orientation = np.array(slices[0].ImageOrientationPatient, dtype=float)
+    for index, single_slice in enumerate(slices):
+        assert np.array_equal(volume["voxels"][:, :, index],
+                              single_slice.pixel_array,
+                              )
+        position = np.array(single_slice.ImagePositionPatient, dtype=float)
+        assert np.allclose(position,
+                           (volume["affine"] @ [0, 0, index, 1])[:3],
+                           )
+        assert np.allclose(position + 3 * row_spacing * orientation[3:]
+                           + 5 * column_spacing * orientation[:3],
+                           (volume["affine"] @ [3, 5, index, 1])[:3],
+                           )
+    
+    expected_hu = (slices[1].pixel_array * float(slices[1].RescaleSlope)
+                   + float(slices[1].RescaleIntercept)
+                   )
+    assert np.allclose(expected_hu,
+                       HD_DSC.hounsfield_units(volume, 1),
+                       )
+    assert np.allclose(expected_hu,
+                       HD_DSC.hounsfield_units(volume)[:, :, 1],
+                       )
+    
+def test_load_ct_volume_with_unsigned_pixels():
+    """
+    GIVEN: CT files whose unsigned 16 bits pixels are greater than 32767
+        
+    WHEN: running the function load_ct_volume
+        
+    THEN: pixel values are kept without wrapping
+    
+    """
+    # Create a temporary CT folder with unsigned CT files
+    temp_folder = tempfile.TemporaryDirectory()
+    source_folder = os.path.join("tests", "test_patient", "CT")
+    for ct_file in sorted(os.listdir(source_folder))[:3]:
+        single_slice = pydicom.dcmread(os.path.join(source_folder, ct_file))
+        pixels = (np.clip(single_slice.pixel_array, 0, None).astype(np.int32)
+                  + 40000
+                  )
+        single_slice.PixelRepresentation = 0
+        single_slice.PixelData = pixels.astype(np.uint16).tobytes()
+        single_slice.save_as(os.path.join(temp_folder.name, ct_file))
+    
+    slices = HD_DSC.read_ct_slices(temp_folder.name)
+    volume = HD_DSC.load_ct_volume(temp_folder.name)
+    
+    assert volume["voxels"].min() >= 40000
+    for index, single_slice in enumerate(slices):
+        assert np.array_equal(volume["voxels"][:, :, index],
+                              single_slice.pixel_array,
+                              )
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_lookup_segment_with_case_insensitive_and_regex_names():
+    """
+    GIVEN: a configuration with case insensitive names and a regular
+           expression name
+        
+    WHEN: running the function lookup_segment on the compiled index
+        
+    THEN: names are found regardless of case and spaces, regular expressions
+          match the whole name and unknown names return None
+
+    """
+    config = {"MBS segments": ["Bladder_MBS"],
+              "External names": ["External"],
+              "Manual names lists": ["Bladder names"],
+              "Bladder names": ["Vescica", "re:bladder[_ ]?\\d*"],
+              "Case insensitive names": True,
+              }
+    segment_index = HD_DSC.compile_segment_index(config)
+    
+    assert ("Bladder names", 0) == HD_DSC.lookup_segment(" VESCICA",
+                                                         segment_index,
+                                                         )
+    assert ("Bladder names", 0) == HD_DSC.lookup_segment("Bladder_2",
+                                                         segment_index,
+                                                         )
+    assert ("MBS segments", 0) == HD_DSC.lookup_segment("bladder_mbs",
+                                                        segment_index,
+                                                        )
+    assert ("External names", None) == HD_DSC.lookup_segment("External",
+                                                             segment_index,
+                                                             )
+    assert HD_DSC.lookup_segment("Bladder wall",
+                                 segment_index,
+                                 ) is None
+    
+def test_compile_segment_index_with_invalid_regex():
+    """
+    GIVEN: a configuration with a regular expression name that is not valid
+        
+    WHEN: running the function compile_segment_index
+        
+    THEN: raises SystemExit naming the expression and its list
+    
+    """
+    config = {"Alias names": ["Prostate"],
+              "Manual names lists": ["Prostate names"],
+              "Prostate names": ["re:Prostat(a"],
+              }
+    
+    with pytest.raises(SystemExit, match="Prostate names"):
+        HD_DSC.compile_segment_index(config)
+    
+def test_user_selection_with_invalid_answers(monkeypatch):
+    """
+    GIVEN: an unknown segment and answers that are not valid before the
+           valid ones
+        
+    WHEN: running the function user_selection
+        
+    THEN: invalid answers are asked again and the segment is added to the
+          names list of the chosen alias name and to the segments index
+    
+    """
+    config = {"Alias names": ["Prostate", "Bladder"],
+              "Manual names lists": ["Prostate names", "Bladder names"],
+              "Prostate names": ["Prostata"],
+              "Bladder names": ["Vescica"],
+              }
+    segment_index = HD_DSC.compile_segment_index(config)
+    answers = iter(["maybe", "y", "B", "2", "1"])
+    prompts = []
+    def answer(prompt):
+        prompts.append(prompt)
+        return next(answers)
+    monkeypatch.setattr("builtins.input", answer)
+    
+    HD_DSC.user_selection(["Bladder_1"],
+                          config,
+                          segment_index,
+                          )
+    
+    assert 5 == len(prompts)
+    assert "0 (Prostate), 1 (Bladder)" in prompts[-1]
+    assert ["Vescica", "Bladder_1"] == config["Bladder names"]
+    assert ("Bladder names", 1) == HD_DSC.lookup_segment("Bladder_1",
+                                                         segment_index,
+                                                         )
+    
+def test_extract_manual_segments_with_generic_names_lists():
+    """
+    GIVEN: a configuration with a number of alias names different from five
+           and its own manual names lists
+        
+    WHEN: running the function extract_manual_segments
+        
+    THEN: every manual segment is put in the place of its alias name and
+          absent structures are None
+
+    """
+    config = {"Alias names": ["Parotid (left)", "Parotid (right)", "Brainstem",
+                              "Spinal cord", "Mandible", "Larynx"],
+              "Manual names lists": ["Left parotid names",
+                                     "Right parotid names",
+                                     "Brainstem names",
+                                     "Spinal cord names",
+                                     "Mandible names",
+                                     "Larynx names",
+                                     ],
+              "Left parotid names": ["Parotide_Sn"],
+              "Right parotid names": ["Parotide_Dx"],
+              "Brainstem names": ["TroncoEncefalico"],
+              "Spinal cord names": ["re:Midollo.*"],
+              "Mandible names": ["Mandibola"],
+              "Larynx names": ["Laringe"],
+              }
+    all_segments = ["Laringe",
+                    "MidolloSpinale",
+                    "Parotide_Dx",
+                    "Parotide_Sn",
+                    "Occhio",
+                    ]
+    
+    expected = ["Parotide_Sn",
+                "Parotide_Dx",
+                None,
+                "MidolloSpinale",
+                None,
+                "Laringe",
+                ]
+    observed = HD_DSC.extract_manual_segments(all_segments,
+                                              config,
+                                              )
+    
+    assert expected == observed
+    assert ["Occhio"] == HD_DSC.find_unknown_segments(all_segments,
+                                                      config,
+                                                      )
+    
+def test_create_segments_matrices_with_more_methods():
+    """
+    GIVEN: a configuration with four automatic methods, one of them with "-"
+           in its name, and any pairs of compared methods
+        
+    WHEN: running the function create_segments_matrices
+        
+    THEN: return the reference and compared segments of every comparison
+
+    """
+    config = {"Alias names": ["Bladder", "Rectum"],
+              "Automatic methods": ["MBS", "DL", "Vendor-C", "Vendor-D"],
+              "Compared methods": ["Manual-Vendor-C",
+                                   "Vendor-C-Vendor-D",
+                                   "DL-MBS",
+                                   ],
+              "MBS segments": ["Bladder_MBS", "Rectum_MBS"],
+              "DL segments": ["Bladder_DL", "Anorectum_DL"],
+              "Vendor-C segments": ["Bladder_C", "Rectum_C"],
+              "Vendor-D segments": ["Bladder_D", "Rectum_D"],
+              }
+    manual_seg = ["Vescica", "Retto"]
+    
+    expected_ref = [["Vescica", "Retto"],
+                    ["Bladder_C", "Rectum_C"],
+                    ["Bladder_DL", "Anorectum_DL"],
+                    ]
+    expected_comp = [["Bladder_C", "Rectum_C"],
+                     ["Bladder_D", "Rectum_D"],
+                     ["Bladder_MBS", "Rectum_MBS"],
+                     ]
+    obs_ref, obs_comp = HD_DSC.create_segments_matrices(manual_seg,
+                                                        config,
+                                                        )
+    
+    assert expected_ref == obs_ref
+    assert expected_comp == obs_comp
+    
+def test_parse_compared_methods_with_unknown_method():
+    """
+    GIVEN: a configuration comparing a method that is not an automatic method
+        
+    WHEN: running the function parse_compared_methods
+        
+    THEN: raises SystemExit
+
+    """
+    config = {"Automatic methods": ["MBS", "DL"],
+              "Compared methods": ["Manual-Atlas"],
+              }
+    
+    with pytest.raises(SystemExit):
+        HD_DSC.parse_compared_methods(config)
+    
+def test_discard_results_writer():
+    """
+    GIVEN: a results file and a writer that already wrote a chunk of rows
+           in its own temporary file
+        
+    WHEN: running the function discard_results_writer
+        
+    THEN: the temporary file is removed and the results file is unchanged
+    
+    """
+    # Create a temporary folder for the results file
+    temp_folder = tempfile.TemporaryDirectory()
+    results_path = os.path.join(temp_folder.name, "results.csv")
+    with open(results_path, "w") as results_file:
+        results_file.write("previous results\n")
+    
+    writer = Results.open_results_writer(
+        results_path,
+        chunk_size=1,
+        temp_path=os.path.join(temp_folder.name, "results.worker.csv"),
+        )
+    Results.write_results(writer,
+                          [["Pelvic-Ref-002", "1.2.3", "Manual-MBS",
+                            "Prostata", "Prostate_MBS", "Prostate", 1.5, 0.8,
+                            0.9]],
+                          )
+    assert os.path.exists(writer["temp_path"])
+    
+    Results.discard_results_writer(writer)
+    
+    assert not os.path.exists(writer["temp_path"])
+    with open(results_path) as results_file:
+        assert "previous results\n" == results_file.read()
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+@pytest.mark.parametrize("extension", [".csv", ".xlsx", ".parquet", ".feather"])
+def test_results_writer_with_chunks(extension):
+    """
+    GIVEN: results rows with new alias names appearing in later chunks
+        
+    WHEN: writing them with open_results_writer, write_results and
+          close_results_writer with a chunk size smaller than the rows
+        
+    THEN: the results file contains all the rows in order, with categories
+          and float32 metrics for columnar formats
+
+    """
+    if extension in (".parquet", ".feather"):
+        pytest.importorskip("pyarrow")
+    
+    # Create a temporary folder for the results file
+    temp_folder = tempfile.TemporaryDirectory()
+    results_path = os.path.join(temp_folder.name, "results" + extension)
+    
+    rows = [["Pelvic-Ref-002", "1.2.3", "Manual-MBS", "Prostata",
+             "Prostate_MBS", f"Structure {i}", i + 0.5, 0.8, 0.9]
+            for i in range(7)
+            ]
+    writer = Results.open_results_writer(results_path,
+                                         chunk_size=3,
+                                         )
+    Results.write_results(writer,
+                          rows[:4],
+                          )
+    Results.write_results(writer,
+                          rows[4:],
+                          )
+    Results.close_results_writer(writer)
+    
+    observed = HD_DSC.load_existing_dataframe(results_path)
+    
+    assert Results.RESULTS_COLUMNS == list(observed.columns)
+    assert [f"Structure {i}" for i in range(7)] == list(observed["Alias name"].astype(str))
+    assert np.allclose([i + 0.5 for i in range(7)],
+                       observed["95% Hausdorff distance (mm)"],
+                       )
+    assert not os.path.exists(writer["temp_path"])
+    if extension in (".parquet", ".feather"):
+        assert isinstance(observed["Alias name"].dtype, pd.CategoricalDtype)
+        assert observed["Volumetric Dice similarity coefficient"].dtype == np.float32
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_claim_patient_with_expired_lease():
+    """
+    GIVEN: a work queue with one patient claimed by a worker whose lease
+           expired
+        
+    WHEN: running the function claim_patient for another worker
+        
+    THEN: the patient is claimed again, the first worker can not complete
+          it and after max_attempts claims it is marked as failed
+
+    """
+    # Create a temporary folder for the queue
+    temp_folder = tempfile.TemporaryDirectory()
+    queue_path = os.path.join(temp_folder.name, "queue.sqlite")
+    
+    assert 1 == WorkQueue.enqueue_patients(queue_path, ["patient_a"])
+    assert 0 == WorkQueue.enqueue_patients(queue_path, ["patient_a"])
+    
+    assert "patient_a" == WorkQueue.claim_patient(queue_path,
+                                                  "crashed_worker",
+                                                  lease_seconds=-1,
+                                                  )
+    assert "patient_a" == WorkQueue.claim_patient(queue_path,
+                                                  "second_worker",
+                                                  lease_seconds=-1,
+                                                  max_attempts=2,
+                                                  )
+    assert not WorkQueue.complete_patient(queue_path,
+                                          "patient_a",
+                                          "crashed_worker",
+                                          )
+    assert WorkQueue.claim_patient(queue_path,
+                                   "third_worker",
+                                   max_attempts=2,
+                                   ) is None
+    assert ["patient_a"] == WorkQueue.queued_patients(queue_path, "failed")
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_run_worker_with_lost_lease():
+    """
+    GIVEN: a work queue with the test patient, claimed again by another
+           worker while the first worker analyses it
+        
+    WHEN: running the function run_worker
+        
+    THEN: the patient is abandoned, without results files and with its
+          folder left in the input folder
+    
+    """
+    # Create a temporary input folder with the test patient
+    temp_folder = tempfile.TemporaryDirectory()
+    input_folder_path = os.path.join(temp_folder.name, "input")
+    new_folder_path = os.path.join(temp_folder.name, "analysed")
+    results_folder_path = os.path.join(temp_folder.name, "results")
+    queue_path = os.path.join(temp_folder.name, "queue.sqlite")
+    shutil.copytree(os.path.join("tests", "test_patient"),
+                    os.path.join(input_folder_path, "test_patient"),
+                    )
+    os.makedirs(new_folder_path)
+    WorkQueue.enqueue_patients(queue_path, ["test_patient"])
+    
+    # The claim is taken by another worker, with an expired lease so that
+    # the patient fails after max_attempts claims and the worker stops.
+    def claim_again():
+        status = None
+        while status != "running":
+            time.sleep(0.01)
+            with closing(sqlite3.connect(queue_path)) as connection:
+                status = connection.execute(
+                    "SELECT status FROM patients",
+                    ).fetchone()[0]
+        with closing(sqlite3.connect(queue_path)) as connection, connection:
+            connection.execute("""UPDATE patients
+                                  SET worker = 'other_worker',
+                                      lease_expires = 0""")
+    thread = threading.Thread(target=claim_again)
+    thread.start()
+    
+    n_analysed = WorkQueue.run_worker(queue_path,
+                                      input_folder_path,
+                                      HD_DSC.read_config(os.path.join(
+                                          "tests",
+                                          "config.json",
+                                          )),
+                                      results_folder_path,
+                                      poll_seconds=0.1,
+                                      max_attempts=1,
+                                      new_folder_path=new_folder_path,
+                                      )
+    thread.join()
+    
+    assert 0 == n_analysed
+    assert [] == os.listdir(results_folder_path)
+    assert [] == os.listdir(new_folder_path)
+    assert ["test_patient"] == os.listdir(input_folder_path)
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_studies_to_analyse():
+    """
+    GIVEN: a patient folder whose study is in the results and a patient
+           folder without files
+        
+    WHEN: running the function studies_to_analyse
+        
+    THEN: the study in the results is not analysed, the folder without
+          files is kept so that its error is reported by the workers
+    
+    """
+    patient_folders = ["test_patient", "missing_patient"]
+    
+    studies = WorkQueue.studies_to_analyse("tests",
+                                           patient_folders,
+                                           )
+    assert patient_folders == list(studies)
+    
+    skipped = []
+    def skip_study(patient_id, frame_of_reference_uid, rtstruct_dataset):
+        skipped.append(patient_id)
+        return True
+    
+    observed = list(WorkQueue.studies_to_analyse("tests",
+                                                 patient_folders,
+                                                 skip_study,
+                                                 ))
+    
+    assert ["missing_patient"] == observed
+    assert 1 == len(skipped)
+    
+def test_start_local_workers_with_missing_patients():
+    """
+    GIVEN: a work queue with patient folders that do not exist
+        
+    WHEN: running two local worker processes with start_local_workers
+        
+    THEN: every patient is claimed and marked as failed, and the workers stop
+          when the queue is finished
+
+    """
+    # Create a temporary folder for the queue
+    temp_folder = tempfile.TemporaryDirectory()
+    queue_path = os.path.join(temp_folder.name, "queue.sqlite")
+    patient_folders = [f"patient_{i}" for i in range(6)]
+    WorkQueue.enqueue_patients(queue_path,
+                               patient_folders,
+                               )
+    
+    processes = WorkQueue.start_local_workers(2,
+                                              queue_path,
+                                              temp_folder.name,
+                                              {"External names": ["External"]},
+                                              os.path.join(temp_folder.name,
+                                                           "results",
+                                                           ),
+                                              poll_seconds=0.1,
+                                              )
+    for process in processes:
+        process.join(timeout=60)
+        assert 0 == process.exitcode
+    
+    expected = {"pending": 0,
+                "running": 0,
+                "done": 0,
+                "failed": 6,
+                }
+    assert expected == WorkQueue.queue_status(queue_path)
+    assert patient_folders == WorkQueue.queued_patients(queue_path, "failed")
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_merge_worker_results_with_failed_patients():
+    """
+    GIVEN: a work queue whose patients failed, one of them added by a
+           previous execution
+        
+    WHEN: running the function merge_worker_results for the patients of
+          the current execution
+        
+    THEN: the rows of the errors table of the current patients are
+          returned, with the stage where they failed
+    
+    """
+    # Create a temporary folder for the queue
+    temp_folder = tempfile.TemporaryDirectory()
+    queue_path = os.path.join(temp_folder.name, "queue.sqlite")
+    results_folder_path = os.path.join(temp_folder.name, "results")
+    WorkQueue.enqueue_patients(queue_path,
+                               ["previous_patient", "current_patient"],
+                               )
+    WorkQueue.run_worker(queue_path,
+                         temp_folder.name,
+                         {"External names": ["External"]},
+                         results_folder_path,
+                         poll_seconds=0.1,
+                         )
+    
+    writer = Results.open_results_writer(os.path.join(temp_folder.name,
+                                                      "results.csv",
+                                                      ),
+                                         )
+    failed_patients = WorkQueue.merge_worker_results(queue_path,
+                                                     results_folder_path,
+                                                     writer,
+                                                     patient_folders=[
+                                                         "current_patient",
+                                                         ],
+                                                     )
+    
+    assert ["current_patient"] == list(failed_patients)
+    row = dict(zip(Results.ERRORS_COLUMNS,
+                   failed_patients["current_patient"],
+                   ))
+    assert "prepare" == row["Stage"]
+    assert 1 == row["Attempts"]
+    assert "Traceback" in row["Traceback"]
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_service_with_missing_patient_folder():
+    """
+    GIVEN: the metrics service listening on a local port
+        
+    WHEN: submitting a job for a patient folder that does not exist and a
+          job without patient folder
+        
+    THEN: the first job fails, the second request is rejected and the status
+          endpoint counts the failed job and its latency
+
+    """
+    server, state = Service.start_service(port=0)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     daemon=True,
+                                     )
+    server_thread.start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    
+    def request(path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        with urllib.request.urlopen(urllib.request.Request(url + path,
+                                                           data=data,
+                                                           ),
+                                    ) as response:
+            return response.status, json.loads(response.read())
+    
+    code, job = request("/jobs",
+                        {"patient_folder_path": "missing/patient",
+                         "config": {"External names": ["External"]},
+                         },
+                        )
+    assert 202 == code
+    state["queue"].join()
+    code, observed_job = request("/jobs/" + job["job_id"])
+    assert "failed" == observed_job["status"]
+    
+    with pytest.raises(urllib.error.HTTPError) as error:
+        request("/jobs", {"config": {}})
+    assert 400 == error.value.code
+    
+    code, status = request("/status")
+    assert 0 == status["queue_depth"]
+    assert 1 == status["jobs"]["failed"]
+    assert 1 == status["stages"]["job"]["count"]
+    
+    server.shutdown()
+    server.server_close()
+    
+def test_imported_heavy_modules():
+    """
+    GIVEN: the program modules
+        
+    WHEN: importing them in a new process
+        
+    THEN: pandas, pydicom, rt_utils and surface_distance are not imported
+
+    """
+    for module in ("HD_DSC", "Main", "Service"):
+        assert [] == Benchmark.imported_heavy_modules(module)
+    
+def test_plan_patient_does_not_move_files():
+    """
+    GIVEN: a patient folder with the RTSTRUCT file and two CT files not yet
+           moved in the CT and RTSTRUCT folders
+        
+    WHEN: running the function plan_patient
+        
+    THEN: no file is moved and the matched segments and the estimated cost
+          are returned
+
+    """
+    # Create a temporary input folder with one patient.
+    temp_folder = tempfile.TemporaryDirectory()
+    source_folder = os.path.join("patients", "Pelvic-Ref002")
+    source_files = sorted(os.listdir(source_folder))
+    rs_file = [f for f in source_files if f.startswith("RS")][0]
+    ct_files = [f for f in source_files if f.startswith("CT")][:2]
+    patient_folder_path = os.path.join(temp_folder.name, "patient")
+    os.mkdir(patient_folder_path)
+    for file in [rs_file] + ct_files:
+        shutil.copy(os.path.join(source_folder, file),
+                    patient_folder_path,
+                    )
+    config = HD_DSC.read_config("config.json")
+    
+    plan = HD_DSC.plan_patient(temp_folder.name,
+                               "patient",
+                               config,
+                               )
+    
+    assert sorted([rs_file] + ct_files) == sorted(os.listdir(
+        patient_folder_path,
+        ))
+    assert None == plan["error"]
+    assert "Pelvic-Ref-002" == plan["patient_id"]
+    assert (512, 512, 2) == plan["grid"]
+    assert ["Prostata", "Prostate_MBS", "Prostate_DL"] == plan["matched"][
+        "Prostate"]
+    assert [] == plan["unknown"]
+    assert 15 == plan["n_masks"]
+    assert 15 * 512 * 512 * 2 == plan["n_voxels"]
+    assert 15 == plan["n_comparisons"]
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_print_plan_with_skipped_and_failed_patients():
+    """
+    GIVEN: the plans of a patient to analyse, of a patient already in the
+           results and of a patient without files
+        
+    WHEN: running the function print_plan
+        
+    THEN: the totals count each kind of patient and sum the costs of the
+          patients to analyse only
+
+    """
+    plans = [{"patient_folder": "a",
+              "patient_id": "A",
+              "frame_of_reference_uid": "1.2",
+              "grid": (2, 2, 2),
+              "matched": {"Prostate": ["Prostata", "Prostate_MBS"]},
+              "unknown": ["Spinal cord"],
+              "missing": [],
+              "in_results": False,
+              "n_masks": 2,
+              "n_voxels": 16,
+              "n_comparisons": 1,
+              "error": None,
+              },
+             {"patient_folder": "b",
+              "patient_id": "B",
+              "frame_of_reference_uid": "1.3",
+              "in_results": True,
+              "error": None,
+              },
+             {"patient_folder": "c",
+              "error": "CT or RTSTRUCT files not found",
+              },
+             ]
+    
+    expected = {"to_analyse": 1,
+                "in_results": 1,
+                "errors": 1,
+                "n_voxels": 16,
+                "n_comparisons": 1,
+                }
+    assert expected == HD_DSC.print_plan(plans)
+    
+def test_discover_patients_with_nested_folders():
+    """
+    GIVEN: an input folder with patient folders nested in year/month folders,
+           some of them with files that are not DICOM files, and a folder
+           to exclude
+        
+    WHEN: running the function discover_patients with max_depth 3, with
+          include and exclude patterns and after a processed patient
+        
+    THEN: the relative paths of the patient folders are yielded in
+          alphabetical order, filtered and after the processed one
+
+    """
+    # Create a temporary input folder with nested patient folders containing
+    # one file each.
+    temp_folder = tempfile.TemporaryDirectory()
+    patient_folders = ["2023/01/patient_a",
+                       "2023/02/patient_b",
+                       "2024/01/patient_c",
+                       "trash/patient_d",
+                       ]
+    for patient_folder in patient_folders:
+        patient_folder_path = os.path.join(temp_folder.name, patient_folder)
+        os.makedirs(patient_folder_path)
+        open(os.path.join(patient_folder_path, "RS.dcm"), "w").close()
+    
+    # Files that are not DICOM files do not make patient folders.
+    for stray_file in ["2023/.DS_Store", "2023/01/Thumbs.db", "2024/README"]:
+        open(os.path.join(temp_folder.name, stray_file), "w").close()
+    
+    all_patients = HD_DSC.discover_patients(temp_folder.name,
+                                            max_depth=3,
+                                            )
+    filtered_patients = HD_DSC.discover_patients(temp_folder.name,
+                                                 max_depth=3,
+                                                 include=["20*"],
+                                                 exclude=["2023/02"],
+                                                 )
+    resumed_patients = HD_DSC.discover_patients(temp_folder.name,
+                                                max_depth=3,
+                                                resume_after="2023/01/patient_a",
+                                                )
+    
+    assert patient_folders == list(all_patients)
+    assert ["2023/01/patient_a", "2024/01/patient_c"] == list(
+        filtered_patients,
+        )
+    assert patient_folders[1:] == list(resumed_patients)
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_save_discovery_progress():
+    """
+    GIVEN: a path where there is no progress file
+        
+    WHEN: running the function read_discovery_progress before and after
+          save_discovery_progress
+        
+    THEN: None is returned before saving and the saved patient folder after
+
+    """
+    # Create a temporary folder for the progress file
+    temp_folder = tempfile.TemporaryDirectory()
+    progress_path = os.path.join(temp_folder.name, "progress.json")
+    
+    assert None == HD_DSC.read_discovery_progress(progress_path)
+    HD_DSC.save_discovery_progress(progress_path,
+                                   "2023/01/patient_a",
+                                   )
+    assert "2023/01/patient_a" == HD_DSC.read_discovery_progress(
+        progress_path,
+        )
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_discovery_resume_point():
+    """
+    GIVEN: processed patient folders, one of which failed also after
+           retrying
+        
+    WHEN: running the function discovery_resume_point
+        
+    THEN: the discovery continues after the last patient before the failed
+          one
+    
+    """
+    processed_folders = ["patient_a", "patient_b", "patient_c", "patient_d"]
+    
+    assert "patient_d" == HD_DSC.discovery_resume_point(processed_folders,
+                                                        {},
+                                                        )
+    assert "patient_b" == HD_DSC.discovery_resume_point(
+        processed_folders,
+        {"patient_c": ["patient_c"]},
+        )
+    assert HD_DSC.discovery_resume_point(processed_folders,
+                                         ["patient_a"],
+                                         ) is None
+    
+def test_prefetch_patients_with_captured_errors():
+    """
+    GIVEN: an input folder with an empty patient folder followed by a
+           patient folder with the RTSTRUCT file and one CT file
+        
+    WHEN: running the function prefetch_patients with capture_errors True
+          and a skip_study function that skips every study
+        
+    THEN: both patients are yielded, the first one with the error of the
+          prepare stage and the second one without errors
+
+    """
+    # Create a temporary input folder with the two patients
+    temp_folder = tempfile.TemporaryDirectory()
+    source_folder = os.path.join("patients", "Pelvic-Ref002")
+    source_files = sorted(os.listdir(source_folder))
+    rs_file = [f for f in source_files if f.startswith("RS")][0]
+    ct_file = [f for f in source_files if f.startswith("CT")][0]
+    os.mkdir(os.path.join(temp_folder.name, "empty_patient"))
+    os.mkdir(os.path.join(temp_folder.name, "patient"))
+    for file in (rs_file, ct_file):
+        shutil.copy(os.path.join(source_folder, file),
+                    os.path.join(temp_folder.name, "patient"),
+                    )
+    
+    patients = list(HD_DSC.prefetch_patients(temp_folder.name,
+                                             ["empty_patient", "patient"],
+                                             skip_study=lambda *args: True,
+                                             capture_errors=True,
+                                             )
+                    )
+    
+    assert "prepare" == patients[0]["error"]["stage"]
+    assert "SystemExit" in patients[0]["error"]["message"]
+    assert None == patients[1]["error"]
+    assert "Pelvic-Ref-002" == patients[1]["patient_id"]
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_process_patient_with_missing_patient_folder():
+    """
+    GIVEN: an already analysed patient whose folder does not exist
+        
+    WHEN: running the function process_patient moving the patient folder
+        
+    THEN: the error of the move stage is returned instead of being raised
+
+    """
+    # Create a temporary folder where patients are moved
+    temp_folder = tempfile.TemporaryDirectory()
+    patient = {"patient_folder": "missing_patient",
+               "patient_folder_path": os.path.join(temp_folder.name,
+                                                   "missing_patient",
+                                                   ),
+               "patient_data": None,
+               "error": None,
+               }
+    
+    error = HD_DSC.process_patient(patient,
+                                   {},
+                                   None,
+                                   new_folder_path=os.path.join(
+                                       temp_folder.name,
+                                       "moved",
+                                       ),
+                                   )
+    
+    assert "move" == error["stage"]
+    assert "Traceback" in error["traceback"]
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_errors_results_path():
+    """
+    GIVEN: the path to a results file
+        
+    WHEN: running the function errors_results_path
+        
+    THEN: the path to the errors table in the same folder and format is
+          returned
+
+    """
+    assert "path/to/results_errors.parquet" == HD_DSC.errors_results_path(
+        "path/to/results.parquet",
+        )
+    
+def test_resampled_labelmap_with_shape_based_interpolation():
+    """
+    GIVEN: a 21x21 mm square contour on the slice at 0 mm and a 9x9 mm square
+           contour on the slice at 4 mm, with a third empty slice at 8 mm
+        
+    WHEN: running the functions resampling_box and resampled_labelmap with a
+          1 mm common grid
+        
+    THEN: contoured slices are rasterized as they are, slices between them
+          shrink from one square to the other and slices after the last
+          contour copy the nearest contoured slice
+
+    """
+    def square(half_side, z):
+        return np.array([[-half_side, -half_side, z],
+                         [-half_side, half_side, z],
+                         [half_side, half_side, z],
+                         [half_side, -half_side, z],
+                         ],
+                        dtype=float,
+                        )
+    contours = [square(10, 0), square(4, 4)]
+    spacing = [1.0, 1.0, 1.0]
+    
+    box = HD_DSC.resampling_box(contours,
+                                spacing,
+                                )
+    labelmap = HD_DSC.resampled_labelmap(contours,
+                                         np.array([0.0, 4.0, 8.0]),
+                                         spacing,
+                                         box,
+                                         )
+    areas = [labelmap[:, :, plane].sum() for plane in range(box["shape"][2])]
+    
+    assert [-12, -12, -2] == list(box["start"])
+    assert [25, 25, 9] == list(box["shape"])
+    assert [21 * 21] * 3 == areas[:3]
+    assert [9 * 9] * 3 == areas[6:]
+    assert areas[2] > areas[3] > areas[4] > areas[5] > areas[6]
+
+def test_crop_to_union():
+    """
+    GIVEN: two small cubes in opposite corners of a larger volume
+        
+    WHEN: running the function crop_to_union
+        
+    THEN: both labelmaps are cropped to the box containing the two cubes and
+          keep all their voxels
+    
+    """
+    reference_labelmap = np.zeros((20, 30, 10), dtype=bool)
+    compared_labelmap = np.zeros((20, 30, 10), dtype=bool)
+    reference_labelmap[2:4, 3:5, 1:3] = True
+    compared_labelmap[10:12, 20:25, 6:8] = True
+    
+    reference_crop, compared_crop = HD_DSC.crop_to_union(reference_labelmap,
+                                                         compared_labelmap,
+                                                         )
+    
+    assert (10, 22, 7) == reference_crop.shape
+    assert (10, 22, 7) == compared_crop.shape
+    assert reference_labelmap.sum() == reference_crop.sum()
+    assert compared_labelmap.sum() == compared_crop.sum()
+
+def test_coarse_to_fine_surface_distances():
+    """
+    GIVEN: a sphere and a shifted ellipsoid on a grid with thick slices
+        
+    WHEN: running the function coarse_to_fine_surface_distances with
+          tolerance equal to the slice thickness
+        
+    THEN: 95% Hausdorff distance and surface Dice are the same computed from
+          the full resolution surface distances
+    
+    """
+    spacing = [1.0, 1.0, 3.0]
+    grid = np.mgrid[:60, :60, :20].astype(float)
+    reference_labelmap = ((grid[0] - 30) ** 2 + (grid[1] - 30) ** 2
+                          + (3 * (grid[2] - 10)) ** 2 <= 15 ** 2
+                          )
+    compared_labelmap = (((grid[0] - 33) / 18) ** 2
+                         + ((grid[1] - 29) / 14) ** 2
+                         + (3 * (grid[2] - 9) / 15) ** 2 <= 1
+                         )
+    
+    full_distances = sd.compute_surface_distances(reference_labelmap,
+                                                  compared_labelmap,
+                                                  spacing,
+                                                  )
+    distances = HD_DSC.coarse_to_fine_surface_distances(reference_labelmap,
+                                                        compared_labelmap,
+                                                        spacing,
+                                                        3.0,
+                                                        )
+    
+    assert (sd.compute_robust_hausdorff(full_distances, 95)
+            == sd.compute_robust_hausdorff(distances, 95)
+            )
+    assert math.isclose(sd.compute_surface_dice_at_tolerance(full_distances,
+                                                             3.0,
+                                                             ),
+                        sd.compute_surface_dice_at_tolerance(distances,
+                                                             3.0,
+                                                             ),
+                        rel_tol=1e-12,
+                        )
+
+def test_weighted_percentile():
+    """
+    GIVEN: four distances with areas 1, 1, 1 and 7
+        
+    WHEN: running the function weighted_percentile at 25 and 95 percent
+        
+    THEN: the third smallest distance and the distance with the greatest area
+          are returned
+    
+    """
+    distances = np.array([4.0, 1.0, 2.0, 3.0])
+    surfel_areas = np.array([7.0, 1.0, 1.0, 1.0])
+    
+    assert 3.0 == HD_DSC.weighted_percentile(distances,
+                                             surfel_areas,
+                                             25,
+                                             )
+    assert 4.0 == HD_DSC.weighted_percentile(distances,
+                                             surfel_areas,
+                                             95,
+                                             )
+
+def test_additional_metric_values():
+    """
+    GIVEN: two 10x10x10 mm cubes, the second shifted by 2 mm along rows
+        
+    WHEN: running the functions overlap_counts and additional_metric_values
+          with all the additional metrics
+        
+    THEN: overlap metrics are those of the two cubes and the greatest
+          directed Hausdorff distance is the 95% Hausdorff distance
+    
+    """
+    reference_labelmap = np.zeros((16, 16, 16), dtype=bool)
+    compared_labelmap = np.zeros((16, 16, 16), dtype=bool)
+    reference_labelmap[2:12, 2:12, 2:12] = True
+    compared_labelmap[4:14, 2:12, 2:12] = True
+    spacing = [1.0, 1.0, 1.0]
+    surf_dists = sd.compute_surface_distances(reference_labelmap,
+                                              compared_labelmap,
+                                              spacing,
+                                              )
+    
+    values = HD_DSC.additional_metric_values(list(HD_DSC.ADDITIONAL_METRICS),
+                                             surf_dists,
+                                             HD_DSC.overlap_counts(
+                                                 reference_labelmap,
+                                                 compared_labelmap,
+                                                 ),
+                                             spacing,
+                                             1.0,
+                                             )
+    
+    assert math.isclose(800 / 1200, values["Jaccard index"])
+    assert math.isclose(0.8, values["Sensitivity"])
+    assert math.isclose(0.8, values["Precision"])
+    assert 0 == values["Volume difference"]
+    assert values["Added path length"] > 0
+    assert values["Mean surface distance"] > 0
+    assert (sd.compute_robust_hausdorff(surf_dists, 95)
+            == max(values["Hausdorff distance reference to compared"],
+                   values["Hausdorff distance compared to reference"],
+                   )
+            )
+
+def test_results_columns_with_unknown_metric():
+    """
+    GIVEN: configurations with known and unknown additional metrics
+        
+    WHEN: running the function results_columns
+        
+    THEN: known metrics columns are added after the results columns and
+          before the skipped reason and fingerprint columns, while unknown
+          metrics halt the execution
+    
+    """
+    config = {"Additional metrics": ["Sensitivity",
+                                     "Jaccard index",
+                                     ],
+              }
+    
+    assert (Results.RESULTS_COLUMNS
+            + ["Sensitivity", "Jaccard index", Results.SKIPPED_REASON_COLUMN]
+            + Results.FINGERPRINT_COLUMNS
+            == HD_DSC.results_columns(config)
+            )
+    assert (Results.RESULTS_COLUMNS + [Results.SKIPPED_REASON_COLUMN]
+            + Results.FINGERPRINT_COLUMNS
+            == HD_DSC.results_columns({})
+            )
+    with pytest.raises(SystemExit):
+        HD_DSC.results_columns({"Additional metrics": ["Accuracy"]})
+
+def test_skipped_reason_with_absent_and_empty_segments():
+    """
+    GIVEN: an RTSTRUCT dataset with a contoured segment and a segment without
+           contours
+        
+    WHEN: running the functions contoured_segments and skipped_reason
+        
+    THEN: only the contoured segment can be compared, the others are absent
+          or empty
+    
+    """
+    rtstruct_dataset = pydicom.Dataset()
+    rtstruct_dataset.StructureSetROISequence = []
+    rtstruct_dataset.ROIContourSequence = []
+    for roi_number, name in enumerate(["Prostata", "Retto"]):
+        roi = pydicom.Dataset()
+        roi.ROINumber = roi_number
+        roi.ROIName = name
+        rtstruct_dataset.StructureSetROISequence.append(roi)
+        roi_contour = pydicom.Dataset()
+        roi_contour.ReferencedROINumber = roi_number
+        roi_contour.ContourSequence = []
+        if name == "Prostata":
+            contour = pydicom.Dataset()
+            contour.ContourData = [0.0, 0.0, 0.0, 1.0, 0.0, 0.0]
+            roi_contour.ContourSequence.append(contour)
+        rtstruct_dataset.ROIContourSequence.append(roi_contour)
+    all_segments = ["Prostata", "Retto"]
+    
+    contoured = HD_DSC.contoured_segments(rtstruct_dataset)
+    
+    assert {"Prostata"} == contoured
+    assert "" == HD_DSC.skipped_reason("Prostata",
+                                       "Prostata",
+                                       all_segments,
+                                       contoured,
+                                       )
+    assert "reference absent, compared empty" == HD_DSC.skipped_reason(
+        None,
+        "Retto",
+        all_segments,
+        contoured,
+        )
+    assert "compared absent" == HD_DSC.skipped_reason("Prostata",
+                                                      "Vescica_DL",
+                                                      all_segments,
+                                                      contoured,
+                                                      )
+
+def test_contour_fingerprints_with_edited_segment():
+    """
+    GIVEN: the RTSTRUCT file of the test patient and a copy where the
+           contours of one segment are moved by 1 mm
+        
+    WHEN: running the function contour_fingerprints on both and
+          reused_metrics on their comparisons
+        
+    THEN: only the fingerprint of the edited segment changes and only its
+          comparisons must be computed again
+    
+    """
+    rtstruct_dataset = pydicom.dcmread(os.path.join("tests",
+                                                    "test_patient",
+                                                    "RTSTRUCT",
+                                                    "RS_002.dcm",
+                                                    ),
+                                       )
+    fingerprints = HD_DSC.contour_fingerprints(rtstruct_dataset)
+    edited_name = rtstruct_dataset.StructureSetROISequence[0].ROIName
+    other_name = rtstruct_dataset.StructureSetROISequence[1].ROIName
+    roi_number = rtstruct_dataset.StructureSetROISequence[0].ROINumber
+    for roi_contour in rtstruct_dataset.ROIContourSequence:
+        if roi_contour.ReferencedROINumber == roi_number:
+            for contour in roi_contour.ContourSequence:
+                points = [float(value) for value in contour.ContourData]
+                points[0] += 1.0
+                contour.ContourData = points
+    
+    edited_fingerprints = HD_DSC.contour_fingerprints(rtstruct_dataset)
+    previous_row = {"Reference segment name": other_name,
+                    "Compared segment name": edited_name,
+                    "Reference contours fingerprint": fingerprints[other_name],
+                    "Compared contours fingerprint": fingerprints[edited_name],
+                    "95% Hausdorff distance (mm)": 3.0,
+                    }
+    metric_columns = ["95% Hausdorff distance (mm)"]
+    
+    assert fingerprints.keys() == edited_fingerprints.keys()
+    assert [edited_name] == [name for name in fingerprints
+                             if fingerprints[name] != edited_fingerprints[name]
+                             ]
+    assert [3.0] == HD_DSC.reused_metrics(previous_row,
+                                          other_name,
+                                          edited_name,
+                                          fingerprints,
+                                          metric_columns,
+                                          )
+    assert HD_DSC.reused_metrics(previous_row,
+                                 other_name,
+                                 edited_name,
+                                 edited_fingerprints,
+                                 metric_columns,
+                                 ) is None
+
+def test_update_results_in_place():
+    """
+    GIVEN: previous results of two studies and new rows of the first study,
+           one of them for a comparison that was not in the results
+        
+    WHEN: running the functions previous_results and update_results
+        
+    THEN: the updated row replaces the previous one in its place and the new
+          row is added at the end
+    
+    """
+    columns = HD_DSC.results_columns({})
+    old_rows = [["P1", "1.1", "Manual-MBS", "Prostata", "Prostate_MBS",
+                 "Prostate", 5.0, 0.8, 0.9, "", "a", "b"],
+                ["P1", "1.1", "Manual-MBS", "Retto", "Rectum_MBS",
+                 "Rectum", 6.0, 0.7, 0.8, "", "c", "d"],
+                ["P2", "2.2", "Manual-MBS", "Prostata", "Prostate_MBS",
+                 "Prostate", 4.0, 0.9, 0.9, "", "e", "f"],
+                ]
+    old_data = pd.DataFrame(old_rows,
+                            columns=columns,
+                            )
+    updated_row = ["P1", "1.1", "Manual-MBS", "Prostata", "Prostate_MBS",
+                   "Prostate", 2.0, 0.95, 0.97, "", "a2", "b"]
+    new_row = ["P1", "1.1", "Manual-DL", "Prostata", "Prostate_DL",
+               "Prostate", 3.0, 0.9, 0.9, "", "a2", "g"]
+    
+    previous_rows = HD_DSC.previous_results(old_data,
+                                            "1.1",
+                                            )
+    rows = HD_DSC.update_results(old_data,
+                                 {("1.1", "Manual-MBS", "Prostate"):
+                                  updated_row,
+                                  ("1.1", "Manual-DL", "Prostate"): new_row,
+                                  },
+                                 columns,
+                                 )
+    
+    assert {("Manual-MBS", "Prostate"),
+            ("Manual-MBS", "Rectum"),
+            } == set(previous_rows)
+    assert [updated_row, old_rows[1], old_rows[2], new_row] == rows
+
+def test_sketch_quantile_accuracy():
+    """
+    GIVEN: a sketch of 1000 values between -5 and 95 and zero
+        
+    WHEN: running the function sketch_quantile after removing some values
+        
+    THEN: quantiles are within the relative accuracy of the exact ones
+    
+    """
+    values = np.linspace(-5, 95, 1000)
+    sketch = Aggregate.create_sketch()
+    for value in list(values) + [0.0, 200.0]:
+        Aggregate.add_to_sketch(sketch,
+                                value,
+                                )
+    for value in (0.0, 200.0):
+        Aggregate.add_to_sketch(sketch,
+                                value,
+                                -1,
+                                )
+    
+    for quantile in (0, 0.1, 0.25, 0.5, 0.75, 1):
+        expected = np.quantile(values, quantile, method="lower")
+        observed = Aggregate.sketch_quantile(sketch,
+                                             quantile,
+                                             )
+        assert math.isclose(expected,
+                            observed,
+                            rel_tol=Aggregate.SKETCH_RELATIVE_ACCURACY,
+                            )
+
+def test_update_aggregate_with_replaced_rows():
+    """
+    GIVEN: results rows of three patients, a pass criterion on the Dice
+           coefficient and a skipped comparison
+        
+    WHEN: running the function update_aggregate, removing one row and adding
+          its updated version, and aggregate_summary_rows
+        
+    THEN: count, mean, standard deviation and pass rate are those of the
+          current rows and the skipped comparison is not counted
+    
+    """
+    columns = HD_DSC.results_columns({})
+    config = {"Pass criteria": {"Volumetric Dice similarity coefficient":
+                                ">= 0.8",
+                                },
+              }
+    def row(frame, hd, dsc):
+        return ["P", frame, "Manual-MBS", "Prostata", "Prostate_MBS",
+                "Prostate", hd, dsc, 0.9, "", "a", "b"]
+    rows = [row("1", 4.0, 0.9),
+            row("2", 6.0, 0.7),
+            row("3", np.nan, np.nan),
+            ]
+    
+    aggregate = Aggregate.create_aggregate(config)
+    Aggregate.update_aggregate(aggregate,
+                               rows,
+                               columns,
+                               )
+    Aggregate.update_aggregate(aggregate,
+                               [rows[1]],
+                               columns,
+                               -1,
+                               )
+    Aggregate.update_aggregate(aggregate,
+                               [row("2", 8.0, 0.85)],
+                               columns,
+                               )
+    summary = {summary_row[2]: summary_row
+               for summary_row in Aggregate.aggregate_summary_rows(aggregate)
+               }
+    
+    hd_row = summary["95% Hausdorff distance (mm)"]
+    dsc_row = summary["Volumetric Dice similarity coefficient"]
+    assert 2 == hd_row[3]
+    assert math.isclose(6.0, hd_row[4])
+    assert math.isclose(np.std([4.0, 8.0], ddof=1), hd_row[5])
+    assert math.isnan(hd_row[-1])
+    assert math.isclose(1.0, dsc_row[-1])
+    with pytest.raises(SystemExit):
+        Aggregate.pass_criteria({"Pass criteria":
+                                 {"Sensitivity": "at least 1"},
+                                 })
+
+def test_compute_stored_metrics():
+    """
+    GIVEN: two labelmaps copied in a mask store
+        
+    WHEN: running the function compute_stored_metrics in a worker process
+        
+    THEN: metrics are the same of compute_metrics and the shared memory is
+        freed when the store is closed, also after an error
+    
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    
+    ref_labelmap = np.zeros((30, 30, 10), dtype=bool)
+    comp_labelmap = np.zeros((30, 30, 10), dtype=bool)
+    ref_labelmap[5:20, 5:20, 2:8] = True
+    comp_labelmap[7:22, 6:21, 3:8] = True
+    spacing = [1.0, 1.0, 3.0]
+    expected = HD_DSC.compute_metrics(ref_labelmap,
+                                      comp_labelmap,
+                                      None,
+                                      voxel_spacing_mm=spacing,
+                                      )
+    
+    with pytest.raises(RuntimeError):
+        with HD_DSC.mask_store() as store:
+            handles = [HD_DSC.store_mask(store, "ref", ref_labelmap),
+                       HD_DSC.store_mask(store, "comp", comp_labelmap),
+                       ]
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                sdsc, dsc, hd, values = executor.submit(
+                    HD_DSC.compute_stored_metrics,
+                    handles[0],
+                    handles[1],
+                    spacing,
+                    False,
+                    ["Jaccard index"],
+                    ).result()
+            raise RuntimeError
+    
+    assert (sdsc, dsc, hd) == expected
+    assert math.isclose(dsc / (2 - dsc), values["Jaccard index"])
+    assert {} == store["blocks"]
+    for handle in handles:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=handle["name"])
+
+def test_extract_hausdorff_dice_with_metric_executor():
+    """
+    GIVEN: the test patient, a configuration file with two metric workers
+           and the pool of processes of the run
+        
+    WHEN: running the function extract_hausdorff_dice twice with the same
+          pool
+        
+    THEN: metrics are the same of the sequential computation and the pool
+          is not shut down, so that it computes the next patients
+    
+    """
+    manual_seg = ["Prostata",
+                  "Retto",
+                  "Vescica",
+                  "FemoreSinistro",
+                  "FemoreDestro",
+                  ]
+    config = HD_DSC.read_config(os.path.join("tests", "config.json"))
+    ct = os.path.join("tests", "test_patient", "CT")
+    rs = os.path.join("tests", "test_patient", "RTSTRUCT", "RS_002.dcm")
+    expected = HD_DSC.extract_hausdorff_dice(manual_seg,
+                                             config,
+                                             ct,
+                                             rs,
+                                             [],
+                                             )
+    
+    config["Metric workers"] = 2
+    executor = HD_DSC.create_metric_executor(config)
+    try:
+        for run in range(2):
+            observed = HD_DSC.extract_hausdorff_dice(manual_seg,
+                                                     config,
+                                                     ct,
+                                                     rs,
+                                                     [],
+                                                     executor=executor,
+                                                     )
+            
+            assert pd.DataFrame(expected).equals(pd.DataFrame(observed))
+        assert 1 == executor.submit(abs, -1).result()
+    finally:
+        executor.shutdown()
+    assert HD_DSC.create_metric_executor({}) is None
+    
+def test_contour_points_with_deferred_decoding():
+    """
+    GIVEN: the RTSTRUCT file of the test patient
+        
+    WHEN: running the functions read_rtstruct, rtstruct_metadata and
+          contour_points
+        
+    THEN: metadata are read without decoding the contours, which are
+          converted to the same values of ContourData
+    
+    """
+    rtstruct_dataset = HD_DSC.read_rtstruct(os.path.join("tests",
+                                                         "test_patient",
+                                                         "RTSTRUCT",
+                                                         "RS_002.dcm",
+                                                         ),
+                                            )
+    
+    metadata = HD_DSC.rtstruct_metadata(rtstruct_dataset)
+    contours = [contour
+                for roi_contour in rtstruct_dataset.ROIContourSequence
+                for contour in roi_contour.get("ContourSequence", [])
+                ]
+    
+    assert "Pelvic-Ref-002" == metadata["patient_id"]
+    assert (len(metadata["roi_names"])
+            == len(rtstruct_dataset.StructureSetROISequence)
+            )
+    assert all(isinstance(HD_DSC.raw_contour_data(contour), bytes)
+               for contour in contours
+               )
+    for contour in contours:
+        points = HD_DSC.contour_points(contour)
+        assert (3, len(contour.ContourData) // 3) == points.T.shape
+        assert np.array_equal(np.array(contour.ContourData, dtype=float),
+                              points.ravel(),
+                              )
+
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+def test_surface_distances_with_backend(backend):
+    """
+    GIVEN: two overlapping ellipsoids with anisotropic voxel spacing and an
+           empty labelmap
+        
+    WHEN: running the function surface_distances with a distance backend
+        
+    THEN: distances and areas are the same of
+          surface_distance.compute_surface_distances, distances to the empty
+          surface are infinite
+    
+    """
+    import surface_distance as sd
+    
+    if backend == "numba":
+        pytest.importorskip("numba")
+    grid = np.mgrid[:40, :40, :16]
+    ref_labelmap = (((grid[0] - 18) / 12) ** 2 + ((grid[1] - 20) / 9) ** 2
+                    + ((grid[2] - 8) / 5) ** 2 <= 1
+                    )
+    comp_labelmap = (((grid[0] - 22) / 10) ** 2 + ((grid[1] - 19) / 11) ** 2
+                     + ((grid[2] - 7) / 4) ** 2 <= 1
+                     )
+    empty_labelmap = np.zeros_like(ref_labelmap)
+    spacing = [0.8, 1.1, 3.0]
+    
+    expected = sd.compute_surface_distances(ref_labelmap,
+                                            comp_labelmap,
+                                            spacing,
+                                            )
+    observed = HD_DSC.surface_distances(ref_labelmap,
+                                        comp_labelmap,
+                                        spacing,
+                                        backend,
+                                        )
+    empty_observed = HD_DSC.surface_distances(ref_labelmap,
+                                              empty_labelmap,
+                                              spacing,
+                                              backend,
+                                              )
+    
+    for key in expected:
+        assert np.allclose(expected[key],
+                           observed[key],
+                           rtol=1e-12,
+                           atol=0,
+                           )
+    assert np.all(np.isinf(empty_observed["distances_gt_to_pred"]))
+    assert np.isclose(expected["surfel_areas_gt"].sum(),
+                      empty_observed["surfel_areas_gt"].sum(),
+                      )
+    assert 0 == len(empty_observed["distances_pred_to_gt"])
+
+def test_banded_surface_dice():
+    """
+    GIVEN: two overlapping ellipsoids with anisotropic voxel spacing
+        
+    WHEN: running the function banded_surface_dice with several tolerances
+          and the function compute_metrics without Hausdorff distance
+        
+    THEN: surface Dice is the one computed from all the surface distances
+          and Hausdorff distance is NaN
+    
+    """
+    import surface_distance as sd
+    
+    grid = np.mgrid[:40, :40, :16]
+    ref_labelmap = (((grid[0] - 18) / 12) ** 2 + ((grid[1] - 20) / 9) ** 2
+                    + ((grid[2] - 8) / 5) ** 2 <= 1
+                    )
+    comp_labelmap = (((grid[0] - 22) / 10) ** 2 + ((grid[1] - 19) / 11) ** 2
+                     + ((grid[2] - 7) / 4) ** 2 <= 1
+                     )
+    spacing = [0.8, 1.1, 3.0]
+    surf_dists = sd.compute_surface_distances(ref_labelmap,
+                                              comp_labelmap,
+                                              spacing,
+                                              )
+    
+    for tolerance in (0.5, 1.1, 2.0, 4.5):
+        assert np.isclose(sd.compute_surface_dice_at_tolerance(surf_dists,
+                                                               tolerance,
+                                                               ),
+                          HD_DSC.banded_surface_dice(ref_labelmap,
+                                                     comp_labelmap,
+                                                     spacing,
+                                                     tolerance,
+                                                     ),
+                          rtol=1e-12,
+                          atol=0,
+                          )
+    sdsc, dsc, hd = HD_DSC.compute_metrics(ref_labelmap,
+                                           comp_labelmap,
+                                           None,
+                                           voxel_spacing_mm=spacing,
+                                           hausdorff=False,
+                                           )
+    assert np.isclose(sd.compute_surface_dice_at_tolerance(surf_dists,
+                                                           max(spacing),
+                                                           ),
+                      sdsc,
+                      rtol=1e-12,
+                      atol=0,
+                      )
+    assert np.isnan(hd)
+
+def test_progress_json_lines():
+    """
+    GIVEN: a progress of 4 patients started one minute ago, with 2
+           patients and 30 comparisons done and a worker computing metrics
+        
+    WHEN: running the function close_progress
+        
+    THEN: the JSON lines file ends with 2 patients per minute, 0.5
+          comparisons per second and one minute left, and the worker stage
+          was reported before closing
+    
+    """
+    # Create a temporary folder for the JSON lines file
+    temp_folder = tempfile.TemporaryDirectory()
+    json_path = os.path.join(temp_folder.name, "progress.jsonl")
+    
+    progress = Progress.create_progress(4,
+                                        json_path,
+                                        interval_s=0,
+                                        )
+    progress["started"] -= 60
+    Progress.set_progress_stage(progress,
+                                "metrics Bladder",
+                                "patient_a",
+                                "worker-0",
+                                )
+    Progress.add_progress(progress,
+                          patients=2,
+                          comparisons=30,
+                          )
+    Progress.close_progress(progress)
+    with open(json_path) as json_file:
+        lines = [json.loads(line) for line in json_file]
+    
+    assert {"stage": "metrics Bladder",
+            "patient": "patient_a",
+            } == {key: lines[-2]["workers"]["worker-0"][key]
+                  for key in ("stage", "patient")
+                  }
+    assert {} == lines[-1]["workers"]
+    assert 2 == lines[-1]["patients_done"]
+    assert np.isclose(2, lines[-1]["patients_per_min"], rtol=1e-3)
+    assert np.isclose(0.5, lines[-1]["comparisons_per_s"], rtol=1e-3)
+    assert np.isclose(60, lines[-1]["eta_s"], rtol=1e-3)
+    
+    # Remove the folder
+    temp_folder.cleanup()
+
+def test_discovered_patients():
+    """
+    GIVEN: a progress without a number of patients and three patient folders
+           found lazily
+        
+    WHEN: running the function discovered_patients
+        
+    THEN: the total grows with the folders yielded so far and is shown with
+          a "+" until the search ends
+    
+    """
+    progress = Progress.create_progress()
+    patient_folders = Progress.discovered_patients(
+        progress,
+        iter(["patient_a", "patient_b", "patient_c"]),
+        )
+    
+    assert "patient_a" == next(patient_folders)
+    snapshot = Progress.progress_snapshot(progress)
+    assert 1 == snapshot["patients_total"]
+    assert snapshot["discovering"]
+    assert Progress.progress_bar(snapshot).startswith("[----------] 0/1+ ")
+    
+    assert ["patient_b", "patient_c"] == list(patient_folders)
+    snapshot = Progress.progress_snapshot(progress)
+    assert 3 == snapshot["patients_total"]
+    assert not snapshot["discovering"]
+    assert " 0/3 " in Progress.progress_bar(snapshot)
+
+def test_pipeline_metrics_server():
+    """
+    GIVEN: a stage of 0.7 seconds, a failure and three lookups of a cache,
+           two of which hit
+        
+    WHEN: reading /metrics from the server started by the function
+          start_metrics_server
+        
+    THEN: the failure is counted, the stage histogram has cumulative buckets
+          and the cache hit ratio is 2/3
+    
+    """
+    PipelineMetrics.record_stage(None,
+                                 "test stage",
+                                 0.7,
+                                 )
+    PipelineMetrics.increment_metric("hd_dsc_failures_total",
+                                     labels={"stage": "test stage"},
+                                     )
+    for hit in (True, False, True):
+        PipelineMetrics.count_cache_lookup("test cache",
+                                           hit,
+                                           )
+    server = PipelineMetrics.start_metrics_server(0)
+    url = f"http://127.0.0.1:{server.server_port}/metrics"
+    
+    with urllib.request.urlopen(url) as response:
+        content_type = response.headers["Content-Type"]
+        lines = response.read().decode().splitlines()
+    samples = dict(line.rsplit(" ", 1) for line in lines
+                   if not line.startswith("#")
+                   )
+    
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert "1" == samples['hd_dsc_failures_total{stage="test stage"}']
+    assert "0" == samples['hd_dsc_stage_duration_seconds_bucket'
+                          '{stage="test stage",le="0.5"}']
+    assert "1" == samples['hd_dsc_stage_duration_seconds_bucket'
+                          '{stage="test stage",le="1"}']
+    assert "1" == samples['hd_dsc_stage_duration_seconds_bucket'
+                          '{stage="test stage",le="+Inf"}']
+    assert np.isclose(2 / 3,
+                      float(samples['hd_dsc_cache_hit_ratio'
+                                    '{cache="test cache"}']),
+                      )
+    
+    server.shutdown()
+    server.server_close()
+
+def test_golden_corpus():
+    """
+    GIVEN: the regression corpus, with the test patient, its variants with
+        absent and empty segments, resampling and additional metrics, and
+        box phantoms whose metrics are known analytically
+        
+    WHEN: analysing every patient of the corpus
+        
+    THEN: metrics are the expected ones and no stage exceeds its duration
+        and peak memory budgets by more than Benchmark.LOOSE_BUDGET_FACTOR
+        or, if the HD_DSC_CHECK_BUDGETS environment variable is 1, by more
+        than the factor of the HD_DSC_BUDGET_FACTOR environment variable
+        (default 2)
+    
+    """
+    phantom = Benchmark.PHANTOM_CASES["Phantom-Translated"]
+    assert (2.0, 0.9, 1.0) == Benchmark.translated_box_metrics(
+        phantom["Bladder"],
+        phantom["Bladder_DL"],
+        )
+    
+    # Tight budgets are only checked on demand, as on a known machine
+    if os.environ.get("HD_DSC_CHECK_BUDGETS") == "1":
+        budget_factor = float(os.environ.get("HD_DSC_BUDGET_FACTOR", 2))
+    else:
+        budget_factor = Benchmark.LOOSE_BUDGET_FACTOR
+    assert [] == Benchmark.check_golden_corpus(budget_factor=budget_factor)
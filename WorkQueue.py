@@ -0,0 +1,844 @@
+import os
+import functools
+import json
+import threading
+import time
+import socket
+import sqlite3
+import multiprocessing
+from contextlib import closing
+
+import Aggregate
+import HD_DSC
+import PipelineMetrics
+import Progress
+import Results
+
+
+def connect_work_queue(queue_path):
+    """
+    Opening the work queue, a SQLite database on storage shared by all the
+    nodes (the file system must support file locks).
+    The table of the queue is created if it does not exist.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue (Ex. "path/to/queue.sqlite").
+
+    Returns
+    -------
+    connection : sqlite3.Connection
+        Connection to the queue in autocommit mode, transactions are opened
+        explicitly.
+
+    """
+    connection = sqlite3.connect(queue_path,
+                                 timeout=60,
+                                 isolation_level=None,
+                                 )
+    connection.execute("""CREATE TABLE IF NOT EXISTS patients (
+                              patient_folder TEXT PRIMARY KEY,
+                              status TEXT NOT NULL DEFAULT 'pending',
+                              worker TEXT,
+                              lease_expires REAL,
+                              attempts INTEGER NOT NULL DEFAULT 0,
+                              error TEXT
+                              )"""
+                       )
+    
+    return connection
+
+def studies_to_analyse(input_folder_path,
+                       patient_folders,
+                       skip_study=None,
+                       new_folder_path=False,
+                       ):
+    """
+    Finding the patient folders whose study must be analysed, before they
+    are added to the work queue.
+    
+    The RTSTRUCT file of every patient is read without moving files. Folders
+    of skipped studies are moved as HD_DSC.process_patient would do. Folders
+    whose RTSTRUCT file can not be found or read are kept, so that the
+    workers report their errors.
+    
+    Parameters
+    ----------
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    patient_folders : iterable
+        Names of the patient folders in the input directory.
+    skip_study : callable, optional
+        Function taking patient ID, frame of reference UID and RTSTRUCT
+        dataset and returning True if the study must not be analysed (see
+        HD_DSC.skip_analysed_study). If None (default) every folder is kept.
+    new_folder_path : str or bool, optional
+        Path where the folders of skipped studies are moved, False (default)
+        to leave them in the input folder.
+    
+    Yields
+    ------
+    patient_folder : str
+        Name of a patient folder to analyse.
+    
+    """
+    for patient_folder in patient_folders:
+        if skip_study is None:
+            yield patient_folder
+            continue
+        patient_folder_path = os.path.join(input_folder_path,
+                                           patient_folder,
+                                           )
+        try:
+            _, rtstruct_file_path = HD_DSC.locate_patient_files(
+                patient_folder_path,
+                )
+            rtstruct_dataset = HD_DSC.read_rtstruct(rtstruct_file_path)
+        except (Exception, SystemExit):
+            yield patient_folder
+            continue
+        
+        if skip_study(rtstruct_dataset.get("PatientID"),
+                      rtstruct_dataset.get("FrameOfReferenceUID"),
+                      rtstruct_dataset,
+                      ):
+            HD_DSC.move_patient_folder(new_folder_path,
+                                       patient_folder_path,
+                                       patient_folder,
+                                       )
+            PipelineMetrics.increment_metric("hd_dsc_studies_skipped_total")
+        else:
+            yield patient_folder
+
+def enqueue_patients(queue_path,
+                     patient_folders,
+                     ):
+    """
+    Adding patient folders to the work queue.
+    Folders already in the queue are not added again, whatever their status.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    patient_folders : list
+        List containing the names of patient folders in the input directory.
+
+    Returns
+    -------
+    n_added : int
+        Number of patient folders added.
+
+    """
+    with closing(connect_work_queue(queue_path)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        n_added = 0
+        for patient_folder in patient_folders:
+            cursor = connection.execute("""INSERT OR IGNORE INTO patients
+                                           (patient_folder) VALUES (?)""",
+                                        (patient_folder,),
+                                        )
+            n_added += cursor.rowcount
+        connection.execute("COMMIT")
+    
+    return n_added
+
+def claim_patient(queue_path,
+                  worker_id,
+                  lease_seconds=600,
+                  max_attempts=3,
+                  ):
+    """
+    Claiming the next patient folder of the work queue.
+    
+    Pending patients and running patients whose lease expired (Ex. their
+    worker crashed) can be claimed. The claim lasts lease_seconds seconds and
+    must be renewed with renew_lease. Patients claimed max_attempts times
+    without being completed are marked as failed.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    worker_id : str
+        Name of the worker.
+    lease_seconds : float, optional
+        Duration of the claim in seconds. Default is 600.
+    max_attempts : int, optional
+        Maximum number of claims of the same patient. Default is 3.
+
+    Returns
+    -------
+    patient_folder : str or None
+        Name of the claimed patient folder, None if no patient can be
+        claimed.
+
+    """
+    with closing(connect_work_queue(queue_path)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        
+        # Patients whose workers crashed too many times are not retried.
+        connection.execute("""UPDATE patients
+                              SET status = 'failed',
+                                  error = 'Lease expired too many times'
+                              WHERE status = 'running' AND lease_expires < ?
+                                    AND attempts >= ?""",
+                           (now, max_attempts),
+                           )
+        row = connection.execute("""SELECT patient_folder FROM patients
+                                    WHERE status = 'pending'
+                                          OR (status = 'running'
+                                              AND lease_expires < ?)
+                                    ORDER BY rowid LIMIT 1""",
+                                 (now,),
+                                 ).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+        
+        connection.execute("""UPDATE patients
+                              SET status = 'running', worker = ?,
+                                  lease_expires = ?, attempts = attempts + 1
+                              WHERE patient_folder = ?""",
+                           (worker_id, now + lease_seconds, row[0]),
+                           )
+        connection.execute("COMMIT")
+    
+    return row[0]
+
+def renew_lease(queue_path,
+                patient_folder,
+                worker_id,
+                lease_seconds=600,
+                ):
+    """
+    Extending the claim of a worker on a patient folder.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    patient_folder : str
+        Name of the claimed patient folder.
+    worker_id : str
+        Name of the worker.
+    lease_seconds : float, optional
+        New duration of the claim in seconds from now. Default is 600.
+
+    Returns
+    -------
+    renewed : bool
+        False if the patient is no longer claimed by the worker.
+
+    """
+    with closing(connect_work_queue(queue_path)) as connection:
+        cursor = connection.execute("""UPDATE patients SET lease_expires = ?
+                                       WHERE patient_folder = ? AND worker = ?
+                                             AND status = 'running'""",
+                                    (time.time() + lease_seconds,
+                                     patient_folder,
+                                     worker_id,
+                                     ),
+                                    )
+    
+    return cursor.rowcount == 1
+
+def complete_patient(queue_path,
+                     patient_folder,
+                     worker_id,
+                     error=None,
+                     ):
+    """
+    Marking a claimed patient folder as done, or as failed if an error is
+    given.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    patient_folder : str
+        Name of the claimed patient folder.
+    worker_id : str
+        Name of the worker.
+    error : str, optional
+        Description of the error that made the analysis fail (Ex. the error
+        created by HD_DSC.patient_error as JSON).
+
+    Returns
+    -------
+    completed : bool
+        False if the patient is no longer claimed by the worker (Ex. its
+        lease expired and another worker claimed it).
+
+    """
+    status = "done" if error is None else "failed"
+    with closing(connect_work_queue(queue_path)) as connection:
+        cursor = connection.execute("""UPDATE patients
+                                       SET status = ?, error = ?,
+                                           lease_expires = NULL
+                                       WHERE patient_folder = ? AND worker = ?
+                                             AND status = 'running'""",
+                                    (status, error, patient_folder, worker_id),
+                                    )
+    
+    return cursor.rowcount == 1
+
+def queue_status(queue_path):
+    """
+    Counting the patient folders of the work queue by status.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+
+    Returns
+    -------
+    status : dict
+        Number of patients for every status ("pending", "running", "done"
+        and "failed").
+
+    """
+    status = {"pending": 0,
+              "running": 0,
+              "done": 0,
+              "failed": 0,
+              }
+    with closing(connect_work_queue(queue_path)) as connection:
+        for name, count in connection.execute("""SELECT status, COUNT(*)
+                                                 FROM patients
+                                                 GROUP BY status"""
+                                              ):
+            status[name] = count
+    
+    return status
+
+def running_claims(queue_path):
+    """
+    Finding the patient folder claimed by every worker of the work queue.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+
+    Returns
+    -------
+    claims : dict
+        Patient folder being analysed by worker name.
+
+    """
+    with closing(connect_work_queue(queue_path)) as connection:
+        claims = dict(connection.execute("""SELECT worker, patient_folder
+                                            FROM patients
+                                            WHERE status = 'running'"""
+                                         ))
+    
+    return claims
+
+def queued_patients(queue_path,
+                    status="done",
+                    ):
+    """
+    Listing the patient folders of the work queue with a given status, in the
+    order they were added.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    status : str, optional
+        Status of the patients. Default is "done".
+
+    Returns
+    -------
+    patient_folders : list
+        Names of the patient folders.
+
+    """
+    with closing(connect_work_queue(queue_path)) as connection:
+        rows = connection.execute("""SELECT patient_folder FROM patients
+                                     WHERE status = ? ORDER BY rowid""",
+                                  (status,),
+                                  ).fetchall()
+    
+    return [row[0] for row in rows]
+
+def queued_errors(queue_path):
+    """
+    Reading the errors of the failed patient folders of the work queue.
+    
+    Errors of the workers are the errors created by HD_DSC.patient_error,
+    stored as JSON. Errors set by the queue itself (Ex. expired leases) are
+    plain text, their stage is "queue".
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+
+    Returns
+    -------
+    errors : dict
+        Error (see HD_DSC.patient_error) and number of claims of every failed
+        patient folder, by name.
+
+    """
+    with closing(connect_work_queue(queue_path)) as connection:
+        rows = connection.execute("""SELECT patient_folder, error, attempts
+                                     FROM patients WHERE status = 'failed'
+                                     ORDER BY rowid"""
+                                  ).fetchall()
+    
+    errors = {}
+    for patient_folder, error_text, attempts in rows:
+        try:
+            error = json.loads(error_text)
+        except (TypeError, ValueError):
+            error = {"stage": "queue",
+                     "message": error_text or "",
+                     "traceback": error_text or "",
+                     }
+        errors[patient_folder] = (error, attempts)
+    
+    return errors
+
+def worker_results_path(results_folder_path,
+                        patient_folder,
+                        ):
+    """
+    Returning the path of the results file written by a worker for a patient.
+
+    Parameters
+    ----------
+    results_folder_path : str
+        Path to the shared folder where workers write their results.
+    patient_folder : str
+        Name of the patient folder.
+
+    Returns
+    -------
+    results_path : str
+        Path to the results file of the patient.
+
+    """
+    return os.path.join(results_folder_path,
+                        f"{patient_folder}.csv",
+                        )
+
+def run_worker(queue_path,
+               input_folder_path,
+               config,
+               results_folder_path,
+               worker_id=None,
+               lease_seconds=600,
+               poll_seconds=5,
+               max_attempts=3,
+               new_folder_path=False,
+               read_workers=None,
+               old_data=None,
+               ):
+    """
+    Analysing patients claimed from the work queue until the queue is
+    finished.
+    
+    The lease of the current patient is renewed in background while it is
+    analysed. If the lease is lost (Ex. the worker was too slow and another
+    worker claimed the patient) the patient is abandoned: the lease is
+    checked again before saving the results and before moving the folder.
+    Results of every patient are written in a temporary file of the worker,
+    renamed to its own file in results_folder_path (with no rows if its
+    study is skipped), then its folder is moved. Unknown segments are
+    ignored, since no user can be asked. The worker stops when there are no
+    pending or running patients left; while other workers are running it
+    waits, since their leases could expire.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    results_folder_path : str
+        Path to the shared folder where results are written.
+    worker_id : str, optional
+        Name of the worker. If None (default) host name and process ID are
+        used.
+    lease_seconds : float, optional
+        Duration of the claims in seconds. Default is 600.
+    poll_seconds : float, optional
+        Waiting time in seconds when no patient can be claimed. Default is 5.
+    max_attempts : int, optional
+        Maximum number of claims of the same patient. Default is 3.
+    new_folder_path : str or bool, optional
+        Path where patient folders are moved after the analysis, False
+        (default) to leave them in the input folder.
+    read_workers : int, optional
+        Number of CT files read at the same time (see read_ct_slices).
+    old_data : DataFrame, optional
+        Previous results. Their studies are skipped unless their contours
+        were edited, and then only the edited comparisons are computed
+        again (see HD_DSC.skip_analysed_study). If None (default) every study
+        is analysed.
+
+    Returns
+    -------
+    n_analysed : int
+        Number of patients analysed by the worker.
+
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    os.makedirs(results_folder_path,
+                exist_ok=True,
+                )
+    segment_index = HD_DSC.compile_segment_index(config)
+    if old_data is not None:
+        skip_study = functools.partial(HD_DSC.skip_analysed_study,
+                                       old_data,
+                                       )
+    else:
+        skip_study = None
+    n_analysed = 0
+    
+    # Metrics of all the patients are computed by the same pool of
+    # processes, started once for the worker.
+    executor = HD_DSC.create_metric_executor(config)
+    while True:
+        patient_folder = claim_patient(queue_path,
+                                       worker_id,
+                                       lease_seconds,
+                                       max_attempts,
+                                       )
+        if patient_folder is None:
+            status = queue_status(queue_path)
+            if status["pending"] == 0 and status["running"] == 0:
+                break
+            time.sleep(poll_seconds)
+            continue
+        
+        print(f"Worker {worker_id} claimed {patient_folder}")
+        
+        # Renewing the lease while the patient is analysed, the heartbeat
+        # stops once the lease is lost.
+        analysed = threading.Event()
+        lease_lost = threading.Event()
+        def heartbeat():
+            while not analysed.wait(lease_seconds / 3):
+                if not renew_lease(queue_path,
+                                   patient_folder,
+                                   worker_id,
+                                   lease_seconds,
+                                   ):
+                    lease_lost.set()
+                    break
+        heartbeat_thread = threading.Thread(target=heartbeat,
+                                            daemon=True,
+                                            )
+        heartbeat_thread.start()
+        
+        # The lease is renewed when it is checked, so that it lasts while
+        # the results are saved or the folder is moved.
+        def holds_lease():
+            if lease_lost.is_set():
+                return False
+            if renew_lease(queue_path,
+                           patient_folder,
+                           worker_id,
+                           lease_seconds,
+                           ):
+                return True
+            lease_lost.set()
+            return False
+        
+        # Errors of the patient are stored in the queue, its folder is
+        # moved only once its results are saved.
+        error = None
+        stage = "prepare"
+        writer = None
+        try:
+            patient = HD_DSC.load_patient(input_folder_path,
+                                          patient_folder,
+                                          skip_study=skip_study,
+                                          read_workers=read_workers,
+                                          capture_errors=True,
+                                          )
+            if old_data is not None:
+                previous_rows = HD_DSC.previous_results(
+                    old_data,
+                    patient["frame_of_reference_uid"],
+                    )
+            else:
+                previous_rows = None
+            results_path = worker_results_path(results_folder_path,
+                                               patient_folder,
+                                               )
+            os.makedirs(os.path.dirname(results_path),
+                        exist_ok=True,
+                        )
+            # Workers with the same patient write different temporary files,
+            # the results file is replaced in a single rename.
+            root, extension = os.path.splitext(results_path)
+            writer = Results.open_results_writer(
+                results_path,
+                HD_DSC.results_columns(config),
+                temp_path=f"{root}.{worker_id}.partial{extension}",
+                )
+            error = HD_DSC.process_patient(patient,
+                                           config,
+                                           writer,
+                                           segment_index,
+                                           interactive=False,
+                                           previous_rows=previous_rows,
+                                           executor=executor,
+                                           )
+            if error is None and holds_lease():
+                stage = "save"
+                Results.close_results_writer(writer)
+                writer = None
+                if holds_lease():
+                    stage = "move"
+                    HD_DSC.move_patient_folder(new_folder_path,
+                                               patient["patient_folder_path"],
+                                               patient_folder,
+                                               )
+                    n_analysed += 1
+        except (Exception, SystemExit):
+            error = HD_DSC.patient_error(stage)
+        finally:
+            analysed.set()
+            heartbeat_thread.join()
+            
+            # Results not saved are discarded, also on errors.
+            if writer is not None:
+                Results.discard_results_writer(writer)
+        
+        # Another worker claimed the patient, it is left to that worker.
+        if lease_lost.is_set():
+            print(f"Worker {worker_id} lost the lease of {patient_folder},",
+                  "the patient is abandoned",
+                  )
+            continue
+        
+        if error is not None:
+            print(f"Worker {worker_id} failed to analyse {patient_folder}")
+            HD_DSC.print_patient_error(patient_folder,
+                                       error,
+                                       )
+        if not complete_patient(queue_path,
+                                patient_folder,
+                                worker_id,
+                                None if error is None else json.dumps(error),
+                                ):
+            print(f"Worker {worker_id} lost the lease of {patient_folder}",
+                  "before completing it",
+                  )
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+    
+    return n_analysed
+
+def start_local_workers(n_workers,
+                        queue_path,
+                        input_folder_path,
+                        config,
+                        results_folder_path,
+                        **worker_options,
+                        ):
+    """
+    Starting worker processes on the local machine.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of worker processes.
+    queue_path : str
+        Path to the SQLite file of the queue.
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    results_folder_path : str
+        Path to the shared folder where results are written.
+    **worker_options
+        Other arguments of run_worker.
+
+    Returns
+    -------
+    processes : list
+        Started multiprocessing.Process objects.
+
+    """
+    processes = []
+    for worker in range(n_workers):
+        process = multiprocessing.Process(target=run_worker,
+                                          args=(queue_path,
+                                                input_folder_path,
+                                                config,
+                                                results_folder_path,
+                                                ),
+                                          kwargs=worker_options,
+                                          name=f"worker-{worker}",
+                                          )
+        process.start()
+        processes.append(process)
+    
+    return processes
+
+def wait_for_queue(queue_path,
+                   poll_seconds=5,
+                   progress=None,
+                   ):
+    """
+    Waiting until no patient of the work queue is pending or running.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    poll_seconds : float, optional
+        Time in seconds between two checks of the queue. Default is 5.
+    progress : dict, optional
+        Progress created by Progress.create_progress, updated at every check
+        with the patients of the queue and the patient claimed by every
+        worker.
+
+    Returns
+    -------
+    status : dict
+        Final number of patients for every status.
+
+    """
+    previous_status = None
+    while True:
+        status = queue_status(queue_path)
+        if status != previous_status:
+            print("Queue status:",
+                  ", ".join(f"{count} {name}"
+                            for name, count in status.items()),
+                  )
+            previous_status = status
+        if progress is not None:
+            with progress["lock"]:
+                progress["n_patients"] = sum(status.values())
+                progress["patients"] = status["done"]
+                progress["failed"] = status["failed"]
+                claims = running_claims(queue_path)
+                for worker in list(progress["workers"]):
+                    if worker not in claims:
+                        Progress.set_progress_stage(progress,
+                                                    None,
+                                                    worker=worker,
+                                                    )
+                for worker, patient_folder in claims.items():
+                    Progress.set_progress_stage(progress,
+                                                "analysis",
+                                                patient_folder,
+                                                worker,
+                                                )
+        if status["pending"] == 0 and status["running"] == 0:
+            return status
+        time.sleep(poll_seconds)
+
+def merge_worker_results(queue_path,
+                         results_folder_path,
+                         writer,
+                         aggregate=None,
+                         patient_folders=None,
+                         old_data=None,
+                         updated_rows=None,
+                         ):
+    """
+    Writing the results of the patients done by the workers and collecting
+    the errors of the failed ones.
+    
+    Rows of studies in the previous results replace the previous rows, as
+    HD_DSC.process_patient does.
+
+    Parameters
+    ----------
+    queue_path : str
+        Path to the SQLite file of the queue.
+    results_folder_path : str
+        Path to the shared folder where workers write their results.
+    writer : dict
+        Writer created by Results.open_results_writer.
+    aggregate : dict, optional
+        Cohort statistics updated with the merged rows (see
+        Aggregate.create_aggregate).
+    patient_folders : list, optional
+        Patient folders of the current execution, patients done in previous
+        executions sharing the queue are not merged. If None (default) all
+        the patients done are merged.
+    old_data : DataFrame, optional
+        Previous results (see HD_DSC.previous_results).
+    updated_rows : dict, optional
+        New rows of the studies in the previous results, by (frame of
+        reference UID, compared methods, alias name) (see update_results).
+        Needed if old_data is given.
+
+    Returns
+    -------
+    failed_patients : dict
+        Row of the errors table (see HD_DSC.error_row) of every failed
+        patient, by patient folder.
+
+    """
+    import pandas as pd
+    
+    # Only the patients of the current execution are merged.
+    done_folders = queued_patients(queue_path)
+    errors = queued_errors(queue_path)
+    if patient_folders is not None:
+        current_folders = set(patient_folders)
+        done_folders = [patient_folder for patient_folder in done_folders
+                        if patient_folder in current_folders
+                        ]
+        errors = {patient_folder: error
+                  for patient_folder, error in errors.items()
+                  if patient_folder in current_folders
+                  }
+    
+    for patient_folder in done_folders:
+        patient_results = pd.read_csv(worker_results_path(results_folder_path,
+                                                          patient_folder,
+                                                          ),
+                                      dtype={column: str
+                                             for column in Results.TEXT_COLUMNS
+                                             },
+                                      )
+        rows = (patient_results.reindex(columns=writer["columns"])
+                .values.tolist())
+        
+        # Studies already in the results have their rows replaced.
+        if old_data is not None and rows:
+            previous_rows = HD_DSC.previous_results(old_data,
+                                                    rows[0][1],
+                                                    )
+        else:
+            previous_rows = {}
+        HD_DSC.save_patient_rows(rows,
+                                 writer,
+                                 previous_rows,
+                                 updated_rows if previous_rows else None,
+                                 aggregate,
+                                 )
+    
+    # Failed patients are saved in the same errors table of the local
+    # execution.
+    failed_patients = {}
+    for patient_folder, (error, attempts) in errors.items():
+        HD_DSC.print_patient_error(patient_folder,
+                                   error,
+                                   attempts,
+                                   )
+        failed_patients[patient_folder] = HD_DSC.error_row(patient_folder,
+                                                           error,
+                                                           attempts,
+                                                           )
+    
+    return failed_patients